@@ -2,13 +2,11 @@ from fastapi import APIRouter, Depends, Request, Form, HTTPException
 from fastapi.responses import HTMLResponse, RedirectResponse
 from sqlalchemy.orm import Session
 from database import get_db, User
-from auth import get_current_user_from_cookie, get_password_hash
-from fastapi.templating import Jinja2Templates
+from auth import get_current_user_from_cookie, get_password_hash_async, verify_password_async, token_cache
+from templating import templates
 
 router = APIRouter()
 
-templates = Jinja2Templates(directory="templates")
-
 @router.get("/account-settings", response_class=HTMLResponse)
 async def account_settings(request: Request, db: Session = Depends(get_db), current_user: User = Depends(get_current_user_from_cookie)):
     """Render the account settings page"""
@@ -64,18 +62,20 @@ async def update_account(
     if new_password:
         if not current_password:
             messages["errors"]["current_password"] = "Current password is required"
-        elif not current_user.verify_password(current_password):
+        elif not await verify_password_async(db, current_user, current_password):
             messages["errors"]["current_password"] = "Current password is incorrect"
         elif new_password != confirm_password:
             messages["errors"]["confirm_password"] = "Passwords do not match"
         else:
-            current_user.password_hash = get_password_hash(new_password)
+            current_user.hashed_password = await get_password_hash_async(new_password)
             if not messages["success"]:
                 messages["success"] = "Account updated successfully"
     
     # Save changes if there are no errors
     if not messages["errors"] and messages["success"]:
         db.commit()
+        # Tokens cached for the old details must be looked up again
+        token_cache.invalidate(current_user.id)
     
     return templates.TemplateResponse("account_settings.html", {
         "request": request,
@@ -1,39 +1,28 @@
-from fastapi import Request, Depends, HTTPException, Form
+from fastapi import Request, Depends, HTTPException, Form, BackgroundTasks
 from fastapi.responses import HTMLResponse, RedirectResponse
-from fastapi.templating import Jinja2Templates
+from templating import templates, template_metrics
+from page_cache import page_cache
+from lazy_imports import import_report
+from model_manager import model_manager
 from sqlalchemy.orm import Session
 from sqlalchemy import func, text
 import stripe
 import os
 from database import SessionLocal, Customer, User, APIKey, AIModel
 from auth import get_current_user_from_cookie, get_admin_user
+from usage_rollups import get_customer_usage_totals, get_daily_usage_totals, get_model_usage_stats
+from parquet_export import export_usage_parquet, get_export_watermarks
+from stripe_catalog import stripe_catalog
+from stripe_client import stripe_client
+from api_keys import issue_api_key, api_key_cache
 import logging
-from datetime import datetime
+from datetime import datetime, timedelta
 from typing import Optional
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Configure templates
-templates = Jinja2Templates(directory="templates")
-
-# Add custom Jinja2 filters
-def format_datetime(value, format="%Y-%m-%d %H:%M:%S"):
-    """Convert a datetime object to a formatted string"""
-    if not value:
-        return "N/A"
-    return value.strftime(format)
-
-def format_currency(value):
-    """Format a number as currency"""
-    if not value:
-        return "$0.00"
-    return f"${value:.2f}"
-
-templates.env.filters["format_datetime"] = format_datetime
-templates.env.filters["format_currency"] = format_currency
-
 # Initialize Stripe
 stripe.api_key = os.getenv("STRIPE_SECRET_KEY", "sk_test_example")
 
@@ -106,7 +95,7 @@ async def create_customer(
         logger.info(f"Creating new customer: {name} ({email})")
         
         # Create Stripe customer first
-        stripe_customer = stripe.Customer.create(
+        stripe_customer = await stripe_client.Customer.create(
             email=email,
             name=name,
             metadata={
@@ -160,7 +149,7 @@ async def sync_customer(
             logger.info(f"Customer {customer_id} has no Stripe customer ID, creating one")
             
             # Create Stripe customer
-            stripe_customer = stripe.Customer.create(
+            stripe_customer = await stripe_client.Customer.create(
                 email=customer.email,
                 name=customer.name,
                 metadata={
@@ -206,7 +195,7 @@ async def view_customer(
         stripe_details = None
         if customer.stripe_customer_id:
             try:
-                stripe_customer = stripe.Customer.retrieve(customer.stripe_customer_id)
+                stripe_customer = await stripe_client.Customer.retrieve(customer.stripe_customer_id)
                 stripe_details = {
                     "id": stripe_customer.id,
                     "name": stripe_customer.name,
@@ -233,6 +222,7 @@ async def view_customer(
 
 # API Key management
 async def create_api_key(
+    request: Request,
     customer_id: int = Form(...),
     name: str = Form(...),
     rate_limit: int = Form(60),
@@ -258,9 +248,7 @@ async def create_api_key(
             raise HTTPException(status_code=404, detail="Customer not found")
         
         # Create API key
-        import secrets
-        api_key = APIKey(
-            key=secrets.token_urlsafe(32),
+        api_key, raw_key = issue_api_key(
             name=name,
             customer_id=customer_id,
             rate_limit=rate_limit,
@@ -274,8 +262,17 @@ async def create_api_key(
         
         logger.info(f"Created API key {api_key.id} for customer {customer.id}")
         
-        # Return to admin dashboard
-        return RedirectResponse(url="/admin", status_code=302)
+        # Show the secret once; only its digest is stored
+        customers = db.query(Customer).all()
+        return templates.TemplateResponse(
+            "admin_api_key_form.html",
+            {
+                "request": request,
+                "user": current_user,
+                "customers": customers,
+                "created_key": {"name": api_key.name, "customer": customer, "key": raw_key}
+            }
+        )
     
     except Exception as e:
         logger.error(f"Error creating API key: {str(e)}")
@@ -514,6 +511,7 @@ async def toggle_api_key_status(
     # Toggle status
     api_key.is_active = not api_key.is_active
     db.commit()
+    api_key_cache.invalidate(api_key.id)
     
     return RedirectResponse(url="/admin/api-keys", status_code=303)
 
@@ -528,20 +526,15 @@ async def admin_stripe_products(
         raise HTTPException(status_code=403, detail="Not authorized to access admin dashboard")
     
     try:
-        # Get all active Stripe products with their prices
-        products = stripe.Product.list(limit=100, active=True)
-        
-        # Add pricing info to each product
-        for product in products:
-            product_id = product["id"]
-            product["prices"] = stripe.Price.list(product=product_id, active=True)["data"]
+        # Get all active Stripe products with their prices from the cached catalog
+        products = await stripe_catalog.products()
         
         return templates.TemplateResponse(
             "admin_stripe_products.html",
             {
                 "request": request,
                 "current_user": current_user,
-                "products": products.get("data", []),
+                "products": products,
                 "section": "stripe_products"
             }
         )
@@ -559,9 +552,55 @@ async def admin_stripe_products(
             }
         )
 
+@router.get("/admin/stripe/metrics")
+async def admin_stripe_metrics(current_user: User = Depends(get_current_user_from_cookie)):
+    """Stripe call counts, failures and latency for this worker"""
+    
+    if not current_user or current_user.role != "admin":
+        raise HTTPException(status_code=403, detail="Not authorized to access admin dashboard")
+    
+    return stripe_client.metrics()
+
+@router.get("/admin/templates/metrics")
+async def admin_template_metrics(current_user: User = Depends(get_current_user_from_cookie)):
+    """Template load and render times for this worker"""
+    
+    if not current_user or current_user.role != "admin":
+        raise HTTPException(status_code=403, detail="Not authorized to access admin dashboard")
+    
+    return template_metrics.snapshot()
+
+@router.get("/admin/import-report")
+async def admin_import_report(current_user: User = Depends(get_current_user_from_cookie)):
+    """Heavy packages loaded by this worker, lazy import times and memory"""
+    
+    if not current_user or current_user.role != "admin":
+        raise HTTPException(status_code=403, detail="Not authorized to access admin dashboard")
+    
+    return import_report()
+
+@router.get("/admin/models/batching")
+async def admin_model_batching(current_user: User = Depends(get_current_user_from_cookie)):
+    """Generation batches run per local model in this worker"""
+    
+    if not current_user or current_user.role != "admin":
+        raise HTTPException(status_code=403, detail="Not authorized to access admin dashboard")
+    
+    return model_manager.batch_metrics()
+
+@router.post("/admin/page-cache/purge")
+async def admin_purge_page_cache(path: Optional[str] = None, current_user: User = Depends(get_current_user_from_cookie)):
+    """Drop cached marketing pages (one path, or all) in this worker"""
+    
+    if not current_user or current_user.role != "admin":
+        raise HTTPException(status_code=403, detail="Not authorized to access admin dashboard")
+    
+    return {"purged": page_cache.purge(path), **page_cache.stats()}
+
 @router.get("/admin/usage")
 async def admin_usage(
     request: Request,
+    days: int = 7,
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_user_from_cookie)
 ):
@@ -570,30 +609,38 @@ async def admin_usage(
     if not current_user or current_user.role != "admin":
         raise HTTPException(status_code=403, detail="Not authorized to access admin dashboard")
     
+    if days not in (7, 30, 90):
+        days = 7
+    
     try:
-        # Get usage statistics
-        # This would be replaced with actual queries in a production environment
-        customers = db.query(Customer).all()
+        since = (datetime.utcnow() - timedelta(days=days - 1)).date()
+        customers = db.query(Customer).order_by(Customer.name).all()
+        
+        # All per-customer, per-day and per-model numbers come from grouped
+        # queries over the usage rollups rather than the raw usage table
+        customer_totals = get_customer_usage_totals(db, since)
+        daily_totals = get_daily_usage_totals(db, since)
+        model_stats = get_model_usage_stats(db, since)
         
-        # Placeholder statistics data - would be replaced with actual DB queries
         total_requests = 0
         total_tokens = 0
-        total_cost = 0
+        total_cost = 0.0
         active_customers = 0
+        active_since = datetime.utcnow() - timedelta(days=7)
         
         for customer in customers:
-            # This is placeholder logic - would need actual usage tracking
-            customer.requests = 0  # Placeholder
-            customer.tokens = customer.requests * 0  # Placeholder
-            customer.cost = customer.tokens * 0.00002  # Placeholder cost
-            customer.last_active = datetime.now()  # Placeholder
+            totals = customer_totals.get(customer.id, {})
+            customer.requests = totals.get("requests", 0)
+            customer.tokens = totals.get("tokens", 0)
+            customer.cost = round(totals.get("cost", 0.0), 2)
+            customer.last_active = totals.get("last_active")
             
             total_requests += customer.requests
             total_tokens += customer.tokens
-            total_cost += customer.cost
+            total_cost += totals.get("cost", 0.0)
             
             # Count customers active in the last 7 days
-            if (datetime.now() - customer.last_active).days < 7:
+            if customer.last_active and customer.last_active >= active_since:
                 active_customers += 1
         
         return templates.TemplateResponse(
@@ -604,8 +651,12 @@ async def admin_usage(
                 "customers": customers,
                 "total_requests": total_requests,
                 "total_tokens": total_tokens,
-                "total_cost": total_cost,
+                "total_cost": f"{total_cost:.2f}",
                 "active_customers": active_customers,
+                "daily_totals": daily_totals,
+                "model_stats": model_stats,
+                "exports": get_export_watermarks(db),
+                "days": days,
                 "section": "usage"
             }
         )
@@ -618,11 +669,51 @@ async def admin_usage(
                 "request": request,
                 "current_user": current_user,
                 "customers": [],
+                "daily_totals": [],
+                "model_stats": [],
+                "exports": [],
+                "days": days,
                 "error": str(e),
                 "section": "usage"
             }
         )
 
+@router.post("/admin/usage/export")
+async def admin_usage_export(
+    background_tasks: BackgroundTasks,
+    source: str = Form("usage"),
+    start: Optional[str] = Form(None),
+    end: Optional[str] = Form(None),
+    restart: bool = Form(False),
+    current_user: User = Depends(get_current_user_from_cookie)
+):
+    """Start a partitioned Parquet export of usage in the background"""
+    
+    if not current_user or current_user.role != "admin":
+        raise HTTPException(status_code=403, detail="Not authorized to export usage")
+    
+    if source not in ("usage", "records"):
+        raise HTTPException(status_code=400, detail="source must be 'usage' or 'records'")
+    
+    try:
+        start_at = datetime.fromisoformat(start) if start else None
+        end_at = datetime.fromisoformat(end) if end else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="start and end must be ISO 8601 dates")
+    
+    # Runs after the response is sent; re-submitting the same range resumes
+    # from the saved watermark unless restart is set
+    background_tasks.add_task(
+        export_usage_parquet,
+        source=source,
+        start=start_at,
+        end=end_at,
+        resume=not restart
+    )
+    logger.info(f"Parquet export of {source} queued by {current_user.username}")
+    
+    return RedirectResponse(url="/admin/usage", status_code=303)
+
 @router.get("/admin/settings")
 async def admin_settings(
     request: Request,
@@ -720,16 +811,16 @@ async def view_stripe_product(
     
     try:
         # Get product details from Stripe
-        product = stripe.Product.retrieve(product_id)
+        product = await stripe_client.Product.retrieve(product_id)
         
         # Get all prices for this product
-        prices = stripe.Price.list(product=product_id, active=None, limit=100)
+        prices = await stripe_client.Price.list(product=product_id, active=None, limit=100)
         
         # Get subscriptions for this product (this is a simplified approach)
         # In a real app, you would need to filter by price IDs related to this product
         subscriptions = []
         try:
-            subs = stripe.Subscription.list(limit=100)
+            subs = await stripe_client.Subscription.list(limit=100)
             for sub in subs.get('data', []):
                 # Check if any item in the subscription is for this product
                 for item in sub.get('items', {}).get('data', []):
@@ -1026,7 +1117,7 @@ async def update_stripe_product(
         features = form_data.get("features", "")
         
         # Update the product in Stripe
-        stripe.Product.modify(
+        await stripe_client.Product.modify(
             product_id,
             name=name,
             description=description,
@@ -1034,6 +1125,7 @@ async def update_stripe_product(
                 "features": features
             }
         )
+        stripe_catalog.invalidate()
         
         return RedirectResponse(url=f"/admin/stripe-product/{product_id}", status_code=303)
     except Exception as e:
@@ -1052,14 +1144,15 @@ async def toggle_stripe_price(
     
     try:
         # Get current price to check its status
-        price = stripe.Price.retrieve(price_id)
+        price = await stripe_client.Price.retrieve(price_id)
         
         # Toggle price status (active to inactive or vice versa)
         # Note: Stripe doesn't allow direct updates to a price's active status
         # Instead, we need to create a new price or archive the existing one
         # For simplicity, we'll just show how to archive a price (make inactive)
         if price.get('active', False):
-            stripe.Price.modify(price_id, active=False)
+            await stripe_client.Price.modify(price_id, active=False)
+            stripe_catalog.invalidate()
         else:
             # Cannot reactivate a price in Stripe, would need to create a new one
             # We'll redirect with an error message
@@ -1104,10 +1197,11 @@ async def admin_create_stripe_product_singular(
         raise HTTPException(status_code=403, detail="Not authorized to access admin dashboard")
         
     try:
-        product = stripe.Product.create(
+        product = await stripe_client.Product.create(
             name=name,
             description=description
         )
+        stripe_catalog.invalidate()
         return RedirectResponse(
             url=f"/admin/stripe-product/{product.id}",
             status_code=303
@@ -1139,7 +1233,7 @@ async def add_price_to_product_form(
     
     try:
         # Get product details from Stripe
-        product = stripe.Product.retrieve(product_id)
+        product = await stripe_client.Product.retrieve(product_id)
         
         return templates.TemplateResponse("admin/stripe_price_form.html", {
             "request": request,
@@ -1202,7 +1296,8 @@ async def add_price_to_product(
                 price_data["recurring"]["aggregate_usage"] = aggregation_type
         
         # Create the price in Stripe
-        price = stripe.Price.create(**price_data)
+        price = await stripe_client.Price.create(**price_data)
+        stripe_catalog.invalidate()
         
         # Redirect to the product page
         return RedirectResponse(
@@ -1213,7 +1308,7 @@ async def add_price_to_product(
         logger.error(f"Error creating price: {str(e)}")
         
         # Get product details for re-rendering the form
-        product = stripe.Product.retrieve(product_id)
+        product = await stripe_client.Product.retrieve(product_id)
         
         return templates.TemplateResponse("admin/stripe_price_form.html", {
             "request": request,
@@ -1,6 +1,6 @@
 from fastapi import APIRouter, Request, Depends, HTTPException, Form, status
 from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse
-from fastapi.templating import Jinja2Templates
+from templating import templates
 from sqlalchemy.orm import Session
 from sqlalchemy import text, func
 from database import get_db, Customer, User, APIKey
@@ -9,24 +9,13 @@ import logging
 import os
 import stripe
 from datetime import datetime
+from stripe_catalog import stripe_catalog
+from stripe_client import stripe_client
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Configure templates
-templates = Jinja2Templates(directory="templates")
-
-# Add custom Jinja2 filters
-def timestamp_to_datetime(timestamp):
-    """Convert a Unix timestamp to a formatted datetime string"""
-    if not timestamp:
-        return "N/A"
-    dt = datetime.fromtimestamp(timestamp)
-    return dt.strftime("%Y-%m-%d %H:%M:%S")
-
-templates.env.filters["timeformat"] = timestamp_to_datetime
-
 router = APIRouter()
 
 @router.get("/admin", response_class=HTMLResponse)
@@ -47,11 +36,10 @@ async def admin_dashboard(
         
         # Get Stripe stats if available
         try:
-            stripe_customers = stripe.Customer.list(limit=1)
+            stripe_customers = await stripe_client.Customer.list(limit=1)
             stripe_customers_count = stripe_customers.get('total_count', 0)
             
-            stripe_products = stripe.Product.list(limit=1, active=True)
-            stripe_products_count = stripe_products.get('total_count', 0)
+            stripe_products_count = len(await stripe_catalog.products())
         except Exception as e:
             logger.error(f"Error fetching Stripe stats: {str(e)}")
             stripe_customers_count = 0
@@ -107,17 +95,16 @@ async def admin_stripe_products(
 ):
     """Admin view for managing Stripe products"""
     try:
-        # Fetch products from Stripe
-        products = stripe.Product.list(limit=100, active=True)
-        
-        # Get prices for each product
-        for product in products:
-            product.prices = stripe.Price.list(product=product.id, active=True)
+        # Products and their prices come from the cached catalog
+        products = [
+            dict(product, prices={"data": product["prices"]})
+            for product in await stripe_catalog.products()
+        ]
         
         return templates.TemplateResponse("admin/stripe_products.html", {
             "request": request,
             "user": current_user,
-            "products": products.data,
+            "products": products,
             "section": "stripe_products"
         })
     except Exception as e:
@@ -150,10 +137,11 @@ async def admin_create_stripe_product(
 ):
     """Create a new Stripe product"""
     try:
-        product = stripe.Product.create(
+        product = await stripe_client.Product.create(
             name=name,
             description=description
         )
+        stripe_catalog.invalidate()
         return RedirectResponse(
             url=f"/admin/stripe-products/{product.id}",
             status_code=status.HTTP_303_SEE_OTHER
@@ -180,8 +168,8 @@ async def admin_view_stripe_product(
 ):
     """View details of a Stripe product"""
     try:
-        product = stripe.Product.retrieve(product_id)
-        prices = stripe.Price.list(product=product_id, active=True)
+        product = await stripe_client.Product.retrieve(product_id)
+        prices = await stripe_client.Price.list(product=product_id, active=True)
         
         return templates.TemplateResponse("admin/stripe_product_detail.html", {
             "request": request,
@@ -206,7 +194,7 @@ async def admin_add_stripe_price_form(
 ):
     """Form for adding a price to a Stripe product"""
     try:
-        product = stripe.Product.retrieve(product_id)
+        product = await stripe_client.Product.retrieve(product_id)
         
         return templates.TemplateResponse("admin/stripe_price_form.html", {
             "request": request,
@@ -254,7 +242,8 @@ async def admin_add_stripe_price(
                 "usage_type": "metered"
             }
         
-        price = stripe.Price.create(**price_data)
+        price = await stripe_client.Price.create(**price_data)
+        stripe_catalog.invalidate()
         
         return RedirectResponse(
             url=f"/admin/stripe-products/{product_id}",
@@ -263,7 +252,7 @@ async def admin_add_stripe_price(
     except Exception as e:
         logger.error(f"Error creating Stripe price: {str(e)}")
         try:
-            product = stripe.Product.retrieve(product_id)
+            product = await stripe_client.Product.retrieve(product_id)
             return templates.TemplateResponse("admin/stripe_price_form.html", {
                 "request": request,
                 "user": current_user,
@@ -0,0 +1,218 @@
+import os
+import sys
+import time
+import hashlib
+import secrets
+import threading
+import logging
+from collections import OrderedDict
+from typing import Dict, Any, Optional, Tuple
+
+from sqlalchemy import inspect, text
+from sqlalchemy.orm import Session, make_transient_to_detached
+
+from database import SessionLocal, APIKey, engine
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Characters of a key kept in clear for display ("Prefix: Ab3dE9xZ...")
+API_KEY_PREFIX_LENGTH = 8
+# How long a validated key is served from memory before it is read again
+API_KEY_CACHE_TTL_SECONDS = float(os.getenv("API_KEY_CACHE_TTL_SECONDS", "30"))
+# Upper bound on cached keys; the least recently used are dropped first
+API_KEY_CACHE_MAX_ENTRIES = int(os.getenv("API_KEY_CACHE_MAX_ENTRIES", "10000"))
+# Rows backfilled per transaction by the migration
+API_KEY_MIGRATION_BATCH_SIZE = int(os.getenv("API_KEY_MIGRATION_BATCH_SIZE", "500"))
+
+
+def hash_api_key(raw_key: str) -> bytes:
+    """Fixed-width digest a key is stored and looked up by"""
+    return hashlib.sha256(raw_key.encode("utf-8")).digest()
+
+
+def _set_secret(api_key: APIKey, raw_key: str):
+    api_key.key_digest = hash_api_key(raw_key)
+    api_key.key_prefix = raw_key[:API_KEY_PREFIX_LENGTH]
+    api_key.masked_key = f"{api_key.key_prefix}..."
+
+
+def issue_api_key(**fields) -> Tuple[APIKey, str]:
+    """A new APIKey (not yet added to a session) and its secret, which is shown once and never stored"""
+    raw_key = secrets.token_urlsafe(32)
+    api_key = APIKey(**fields)
+    _set_secret(api_key, raw_key)
+    return api_key, raw_key
+
+
+class APIKeyCache:
+    """
+    Validated API keys by digest, so API requests usually skip the api_keys table.
+
+    Entries hold a snapshot of the key's columns, never the secret, and are
+    attached to the request's session without a query. Keys issued before
+    digest storage are found by their raw value and converted on first
+    use, until `python api_keys.py migrate` has converted them all.
+    """
+
+    def __init__(self, ttl_seconds: float = API_KEY_CACHE_TTL_SECONDS, max_entries: int = API_KEY_CACHE_MAX_ENTRIES):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[bytes, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        # Bumped on every invalidation so a lookup that raced with a change is not stored
+        self._generation = 0
+        # Whether rows without a digest may still exist (checked once, then kept up to date)
+        self._legacy_keys: Optional[bool] = None
+        self._lock = threading.Lock()
+
+    def _snapshot(self, api_key: APIKey) -> Dict[str, Any]:
+        values = {column.key: getattr(api_key, column.key) for column in APIKey.__table__.columns}
+        values.pop("key", None)
+        return values
+
+    def _from_cache(self, db: Session, digest: bytes) -> Optional[APIKey]:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is None:
+                return None
+            if entry[0] <= now:
+                del self._entries[digest]
+                return None
+            self._entries.move_to_end(digest)
+            values = entry[1]
+        api_key = APIKey(**values)
+        make_transient_to_detached(api_key)
+        return db.merge(api_key, load=False)
+
+    def _legacy_lookup(self, db: Session, raw_key: str) -> Optional[APIKey]:
+        if self._legacy_keys is None:
+            self._legacy_keys = db.query(APIKey.id).filter(APIKey.key_digest.is_(None)).first() is not None
+        if not self._legacy_keys:
+            return None
+        api_key = db.query(APIKey).filter(APIKey.key == raw_key, APIKey.key_digest.is_(None)).first()
+        if api_key is not None:
+            # Convert the key on first use
+            _set_secret(api_key, raw_key)
+            db.commit()
+            logger.info(f"Converted API key {api_key.id} to digest storage")
+        else:
+            # Check again next time, so the fallback stops once every key is converted
+            self._legacy_keys = None
+        return api_key
+
+    def lookup(self, db: Session, raw_key: str) -> Optional[APIKey]:
+        """The APIKey for a presented secret (active or not), or None"""
+        if not raw_key:
+            return None
+        digest = hash_api_key(raw_key)
+        api_key = self._from_cache(db, digest)
+        if api_key is not None:
+            return api_key
+
+        with self._lock:
+            generation = self._generation
+        api_key = db.query(APIKey).filter(APIKey.key_digest == digest).first()
+        if api_key is None:
+            api_key = self._legacy_lookup(db, raw_key)
+        if api_key is None:
+            return None
+
+        values = self._snapshot(api_key)
+        with self._lock:
+            if self._generation == generation:
+                self._entries[digest] = (time.monotonic() + self.ttl_seconds, values)
+                self._entries.move_to_end(digest)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return api_key
+
+    def preload(self, db: Session) -> int:
+        """Cache the newest active keys ahead of traffic (at startup); returns how many"""
+        with self._lock:
+            generation = self._generation
+        api_keys = db.query(APIKey).filter(
+            APIKey.key_digest.isnot(None), APIKey.is_active.is_(True)
+        ).order_by(APIKey.id.desc()).limit(self.max_entries).all()
+        expires = time.monotonic() + self.ttl_seconds
+        with self._lock:
+            if self._generation != generation:
+                return 0
+            # Oldest first, so the newest keys end up most recently used
+            for api_key in reversed(api_keys):
+                self._entries[api_key.key_digest] = (expires, self._snapshot(api_key))
+                self._entries.move_to_end(api_key.key_digest)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return len(api_keys)
+
+    def invalidate(self, api_key_id: Optional[int] = None):
+        """Forget a key after it is changed or deleted (all keys if no id is given)"""
+        with self._lock:
+            if api_key_id is None:
+                self._entries.clear()
+            else:
+                for digest in [digest for digest, entry in self._entries.items() if entry[1]["id"] == api_key_id]:
+                    del self._entries[digest]
+            self._generation += 1
+
+
+# Create global API key cache instance
+api_key_cache = APIKeyCache()
+
+
+def _add_columns():
+    """Add the digest columns and index to an existing api_keys table"""
+    columns = {column["name"] for column in inspect(engine).get_columns("api_keys")}
+    binary = "BYTEA" if engine.dialect.name == "postgresql" else "BLOB"
+    with engine.begin() as connection:
+        if "key_digest" not in columns:
+            logger.info("Adding key_digest column to api_keys table")
+            connection.execute(text(f"ALTER TABLE api_keys ADD COLUMN key_digest {binary}"))
+        if "key_prefix" not in columns:
+            logger.info("Adding key_prefix column to api_keys table")
+            connection.execute(text("ALTER TABLE api_keys ADD COLUMN key_prefix VARCHAR(16)"))
+        connection.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS ix_api_keys_key_digest ON api_keys (key_digest)"))
+
+
+def migrate():
+    """Backfill digests and prefixes for keys issued before digest storage (safe while the app runs)"""
+    _add_columns()
+    db = SessionLocal()
+    try:
+        converted = 0
+        while True:
+            batch = db.query(APIKey).filter(
+                APIKey.key_digest.is_(None), APIKey.key.isnot(None)
+            ).order_by(APIKey.id).limit(API_KEY_MIGRATION_BATCH_SIZE).all()
+            if not batch:
+                break
+            for api_key in batch:
+                _set_secret(api_key, api_key.key)
+            db.commit()
+            converted += len(batch)
+        logger.info(f"Converted {converted} API keys to digest storage")
+    finally:
+        db.close()
+
+
+def purge():
+    """Drop the raw secrets of converted keys (once every app instance looks keys up by digest)"""
+    db = SessionLocal()
+    try:
+        purged = db.query(APIKey).filter(
+            APIKey.key_digest.isnot(None), APIKey.key.isnot(None)
+        ).update({"key": None}, synchronize_session=False)
+        db.commit()
+        logger.info(f"Removed the stored secret of {purged} API keys")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    # Usage: python api_keys.py [migrate|purge]
+    command = sys.argv[1] if len(sys.argv) > 1 else "migrate"
+    if command == "purge":
+        purge()
+    else:
+        migrate()
@@ -1,6 +1,7 @@
-from fastapi import APIRouter, Depends, HTTPException, Header, status
+from fastapi import APIRouter, Depends, HTTPException, Header, Query, status
+from fastapi.responses import StreamingResponse
 from sqlalchemy.orm import Session
-from datetime import datetime
+from datetime import datetime, timezone
 from typing import Dict, List, Optional, Any
 import time
 import os
@@ -8,6 +9,18 @@ import uuid
 import logging
 
 from database import get_db, APIKey, Usage, AIModel, UsageRecord, User
+from usage_rollups import record_usage
+from api_keys import api_key_cache
+from usage_export import (
+    DEFAULT_PAGE_SIZE,
+    MAX_PAGE_SIZE,
+    USAGE_SOURCES,
+    InvalidCursorError,
+    fetch_usage_page,
+    iter_usage_rows,
+    iter_ndjson,
+    iter_csv
+)
 
 router = APIRouter()
 
@@ -15,9 +28,9 @@ async def validate_api_key(x_api_key: str = Header(...), db: Session = Depends(g
     """
     Validate the API key provided in the request header.
     """
-    api_key = db.query(APIKey).filter(APIKey.key == x_api_key, APIKey.is_active == True).first()
+    api_key = api_key_cache.lookup(db, x_api_key)
     
-    if not api_key:
+    if not api_key or not api_key.is_active:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid or inactive API key",
@@ -127,19 +140,7 @@ async def generate_text(
         
         # Record the usage
         try:
-            usage = Usage(
-                api_key_id=api_key.id,
-                model_id=model.id,
-                request_type="generate",
-                prompt_tokens=prompt_tokens,
-                completion_tokens=completion_tokens,
-                total_tokens=total_tokens,
-                response_time=response_time,
-                cost=cost
-            )
-            db.add(usage)
-            
-            # Also add to the UsageRecord table
+            # Also add to the UsageRecord table (committed together with the usage)
             usage_record = UsageRecord(
                 api_key_id=api_key.id,
                 user_id=api_key.user_id,
@@ -149,7 +150,16 @@ async def generate_text(
             )
             db.add(usage_record)
             
-            db.commit()
+            record_usage(
+                db,
+                api_key_id=api_key.id,
+                customer_id=api_key.customer_id,
+                model_id=model.id,
+                request_type="generate",
+                tokens_used=total_tokens,
+                response_time=response_time,
+                cost=cost
+            )
         except:
             # If the tables don't exist yet, just skip tracking
             db.rollback()
@@ -171,55 +181,93 @@ async def generate_text(
         # Return an error response
         raise HTTPException(status_code=500, detail=f"Error generating text: {str(e)}")
 
+def _as_naive_utc(value: Optional[datetime]) -> Optional[datetime]:
+    """Usage timestamps are stored as naive UTC; normalize aware query parameters"""
+    if value is not None and value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
 @router.get("/api/v1/usage")
 async def get_usage(
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    records_cursor: Optional[str] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
     api_key: APIKey = Depends(validate_api_key),
     db: Session = Depends(get_db)
 ):
     """
-    Get the usage data for a specific API key.
+    Get the usage data for a specific API key, oldest first.
+    
+    Results are paginated on (timestamp, id); pass `next_cursor` from the
+    previous response as `cursor` to get the next page. `records` is kept
+    for existing clients and is paged separately with `records_cursor` /
+    `next_records_cursor` (deprecated: use /api/v1/usage/records).
     """
+    start, end = _as_naive_utc(start), _as_naive_utc(end)
     try:
-        # Get usage from the Usage table
-        usage = db.query(Usage).filter(Usage.api_key_id == api_key.id).all()
-        
-        # If the UsageRecord table exists, get data from there too
-        usage_records = db.query(UsageRecord).filter(UsageRecord.api_key_id == api_key.id).all()
-        
-        # Combine the data
-        usage_data = [
-            {
-                "timestamp": u.timestamp.isoformat(),
-                "model_id": u.model_id,
-                "prompt_tokens": u.prompt_tokens,
-                "completion_tokens": u.completion_tokens,
-                "total_tokens": u.total_tokens,
-                "response_time": u.response_time,
-                "cost": u.cost
-            }
-            for u in usage
-        ]
-        
-        # Add usage records data if it exists
-        try:
-            usage_records_data = [
-                {
-                    "timestamp": r.timestamp.isoformat(),
-                    "service": r.service,
-                    "request_count": r.request_count,
-                    "cost": r.cost
-                }
-                for r in usage_records
-            ]
-            
-            # Return both types of usage data
-            return {
-                "usage": usage_data,
-                "records": usage_records_data
-            }
-        except:
-            # If UsageRecord table doesn't exist or has errors, just return Usage data
-            return usage_data
-    except:
-        # If both tables don't exist or have errors, return empty data
-        return []
+        usage, next_cursor = fetch_usage_page(db, "usage", api_key.id, limit, cursor, start, end)
+        records, next_records_cursor = fetch_usage_page(db, "records", api_key.id, limit, records_cursor, start, end)
+    except InvalidCursorError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    return {
+        "usage": usage,
+        "next_cursor": next_cursor,
+        "records": records,
+        "next_records_cursor": next_records_cursor
+    }
+
+@router.get("/api/v1/usage/records")
+async def get_usage_records(
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    api_key: APIKey = Depends(validate_api_key),
+    db: Session = Depends(get_db)
+):
+    """
+    Get the per-request usage records for a specific API key, oldest first.
+    
+    Paginated the same way as /api/v1/usage.
+    """
+    try:
+        records, next_cursor = fetch_usage_page(
+            db, "records", api_key.id, limit, cursor, _as_naive_utc(start), _as_naive_utc(end)
+        )
+    except InvalidCursorError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    return {"records": records, "next_cursor": next_cursor}
+
+@router.get("/api/v1/usage/export")
+async def export_usage(
+    format: str = Query("ndjson", pattern="^(ndjson|csv)$"),
+    source: str = Query("usage", pattern="^(usage|records)$"),
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    api_key: APIKey = Depends(validate_api_key)
+):
+    """
+    Stream all usage for a specific API key as NDJSON or CSV.
+    
+    Rows are read from a server-side cursor and written as they arrive, so
+    memory use does not grow with the size of the history.
+    """
+    rows = iter_usage_rows(source, api_key.id, _as_naive_utc(start), _as_naive_utc(end))
+    filename = f"{source}-{api_key.id}.{format}"
+    
+    if format == "csv":
+        body = iter_csv(rows, USAGE_SOURCES[source][1])
+        media_type = "text/csv"
+    else:
+        body = iter_ndjson(rows)
+        media_type = "application/x-ndjson"
+    
+    return StreamingResponse(
+        body,
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
@@ -1,13 +1,16 @@
 import os
+import time
+import threading
+from collections import OrderedDict
 from datetime import datetime, timedelta
-from typing import Optional, Union, Dict, Any
+from typing import Optional, Union, Dict, Any, Tuple
 from fastapi import Depends, FastAPI, HTTPException, status, Request, Cookie
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from jose import JWTError, jwt
-from passlib.context import CryptContext
 from pydantic import BaseModel
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, make_transient_to_detached
 from database import User, Customer, SessionLocal, get_db, UserRole
+from password_hasher import pwd_context, password_hasher, PasswordHasherBusy
 import logging
 logger = logging.getLogger(__name__)
 
@@ -16,8 +19,10 @@ SECRET_KEY = os.getenv("SECRET_KEY", "09d25e094faa6ca2556c818166b7a9563b93f7099f
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24  # 24 hours
 
-# Password hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Verified tokens are trusted without re-reading the user for at most this long
+AUTH_CACHE_TTL_SECONDS = float(os.getenv("AUTH_CACHE_TTL_SECONDS", "60"))
+# Upper bound on cached tokens; the least recently used are dropped first
+AUTH_CACHE_MAX_ENTRIES = int(os.getenv("AUTH_CACHE_MAX_ENTRIES", "10000"))
 
 # OAuth2 scheme for token authentication
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token", auto_error=False)
@@ -51,22 +56,49 @@ class UserResponse(BaseModel):
     role: str
     is_active: bool
 
-# Helper functions
+# Helper functions (blocking; async handlers use the awaitable versions below)
 def verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
 
 def get_password_hash(password):
     return pwd_context.hash(password)
 
+def _hasher_busy():
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="Too many sign-in requests, please try again shortly",
+        headers={"Retry-After": "1"},
+    )
+
+async def verify_password_async(db: Session, user: User, password: str) -> bool:
+    """Check a user's password on the hashing pool, upgrading the stored hash if its cost changed (the caller commits)"""
+    try:
+        valid, new_hash = await password_hasher.verify_and_update(password, user.hashed_password)
+    except PasswordHasherBusy:
+        raise _hasher_busy()
+    if valid and new_hash:
+        user.hashed_password = new_hash
+    return valid
+
+async def get_password_hash_async(password: str) -> str:
+    try:
+        return await password_hasher.hash(password)
+    except PasswordHasherBusy:
+        raise _hasher_busy()
+
 def get_user(db: Session, username: str):
     return db.query(User).filter(User.username == username).first()
 
-def authenticate_user(db: Session, username: str, password: str):
+async def authenticate_user(db: Session, username: str, password: str):
     user = get_user(db, username)
     if not user:
         return False
-    if not verify_password(password, user.hashed_password):
+    if not await verify_password_async(db, user, password):
         return False
+    if db.is_modified(user):
+        # Save the upgraded hash
+        db.commit()
+        token_cache.invalidate(user.id)
     return user
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
@@ -79,6 +111,101 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
+class TokenCache:
+    """
+    Verified JWT -> user snapshot, so authenticated requests skip the users table.
+
+    An entry lives until the token expires or for AUTH_CACHE_TTL_SECONDS,
+    whichever comes first, and is dropped when the user is changed through
+    invalidate(). The snapshot is attached to the request's session without
+    a query, so callers get a normal User they can update and commit.
+    """
+
+    def __init__(self, ttl_seconds: float = AUTH_CACHE_TTL_SECONDS, max_entries: int = AUTH_CACHE_MAX_ENTRIES):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Tuple[float, int, Dict[str, Any]]]" = OrderedDict()
+        # Bumped on every invalidation so a lookup that raced with an update is not stored
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get(self, db: Session, token: str) -> Optional[User]:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None:
+                return None
+            if entry[0] <= now:
+                del self._entries[token]
+                return None
+            self._entries.move_to_end(token)
+            values = entry[2]
+        user = User(**values)
+        make_transient_to_detached(user)
+        return db.merge(user, load=False)
+
+    def generation(self) -> int:
+        with self._lock:
+            return self._generation
+
+    def put(self, token: str, payload: Dict[str, Any], user: User, generation: int):
+        now = time.monotonic()
+        expires = now + self.ttl_seconds
+        if payload.get("exp") is not None:
+            expires = min(expires, now + (payload["exp"] - time.time()))
+        if expires <= now:
+            return
+        values = {column.key: getattr(user, column.key) for column in User.__table__.columns}
+        with self._lock:
+            if self._generation != generation:
+                return
+            self._entries[token] = (expires, user.id, values)
+            self._entries.move_to_end(token)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id: Optional[int]):
+        """Forget every cached token of a user after the user is changed"""
+        if user_id is None:
+            return
+        with self._lock:
+            for token in [token for token, entry in self._entries.items() if entry[1] == user_id]:
+                del self._entries[token]
+            self._generation += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+
+
+# Create global token cache instance
+token_cache = TokenCache()
+
+def get_user_from_token(db: Session, token: str) -> Optional[User]:
+    """Resolve a JWT to its user, from the token cache when possible"""
+    user = token_cache.get(db, token)
+    if user is not None:
+        return user
+    generation = token_cache.generation()
+
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        username: str = payload.get("sub")
+        if username is None:
+            logger.debug("No username found in token payload")
+            return None
+    except JWTError as e:
+        logger.debug(f"JWT error decoding token: {str(e)}")
+        return None
+
+    user = db.query(User).filter(User.username == username).first()
+    if user is None:
+        logger.debug(f"No user found for username: {username}")
+        return None
+    token_cache.put(token, payload, user, generation)
+    return user
+
 # Get token from either cookie OR authorization header
 async def get_token(
     request: Request,
@@ -107,23 +234,7 @@ async def get_current_user(
     if token is None:
         return None
         
-    credentials_exception = HTTPException(
-        status_code=status.HTTP_401_UNAUTHORIZED,
-        detail="Could not validate credentials",
-        headers={"WWW-Authenticate": "Bearer"},
-    )
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
-            return None
-    except JWTError:
-        return None
-    
-    user = db.query(User).filter(User.username == username).first()
-    if user is None:
-        return None
-    return user
+    return get_user_from_token(db, token)
 
 async def get_current_active_user(current_user: User = Depends(get_current_user)):
     if not current_user:
@@ -140,12 +251,12 @@ async def get_admin_user(current_user: User = Depends(get_current_active_user)):
         )
     return current_user
 
-def create_user(db: Session, user: UserCreate):
+async def create_user(db: Session, user: UserCreate):
     """Create a new user in the database"""
     db_user = User(
         username=user.username,
         email=user.email,
-        hashed_password=get_password_hash(user.password),
+        hashed_password=await get_password_hash_async(user.password),
         role=user.role
     )
     db.add(db_user)
@@ -161,59 +272,26 @@ async def get_token_from_cookie(
     request: Request,
     access_token: Optional[str] = Cookie(None)
 ):
-    logger.info(f"Cookie access_token present: {access_token is not None}")
-    logger.info(f"Request cookies keys: {request.cookies.keys()}")
-    
-    if access_token:
-        # Check if it already has "Bearer " prefix
-        if access_token.startswith("Bearer "):
-            token = access_token.replace("Bearer ", "")
-            logger.info(f"Extracted token from cookie parameter")
-            return token
-        else:
-            logger.info(f"Using raw token from cookie parameter")
-            return access_token
-    
-    # Also try to get from request.cookies directly as a fallback
-    cookie_token = request.cookies.get("access_token")
-    if cookie_token:
-        if cookie_token.startswith("Bearer "):
-            token = cookie_token.replace("Bearer ", "")
-            logger.info(f"Extracted token from request.cookies")
-            return token
-        else:
-            logger.info(f"Using raw token from request.cookies")
-            return cookie_token
+    # Fall back to request.cookies in case the parameter was not bound
+    token = access_token or request.cookies.get("access_token")
+    if not token:
+        logger.debug("No token found in cookies")
+        return None
     
-    logger.warning("No token found in cookies")
-    return None
+    # Check if it already has "Bearer " prefix
+    if token.startswith("Bearer "):
+        return token.replace("Bearer ", "")
+    return token
 
 async def get_current_user_from_cookie(
     request: Request,
     token: Optional[str] = Depends(get_token_from_cookie),
     db: Session = Depends(get_db)
 ):
-    logger.info(f"get_current_user_from_cookie called with token present: {token is not None}")
-    
     if token is None:
-        logger.warning("No token provided to get_current_user_from_cookie")
-        return None
-    
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
-            logger.warning("No username found in token payload")
-            return None
-        logger.info(f"Token decoded successfully for user: {username}")
-    except JWTError as e:
-        logger.error(f"JWT error decoding token: {str(e)}")
-        return None
-    
-    user = db.query(User).filter(User.username == username).first()
-    if user is None:
-        logger.warning(f"No user found for username: {username}")
         return None
     
-    logger.info(f"User authenticated: {user.username} (role: {user.role})")
+    user = get_user_from_token(db, token)
+    if user is not None:
+        logger.debug(f"User authenticated: {user.username} (role: {user.role})")
     return user
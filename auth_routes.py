@@ -1,6 +1,5 @@
 from fastapi import APIRouter, Depends, HTTPException, status, Request, Form, Response
 from fastapi.responses import HTMLResponse, RedirectResponse
-from fastapi.templating import Jinja2Templates
 from fastapi.security import OAuth2PasswordRequestForm
 from sqlalchemy.orm import Session
 from typing import Optional
@@ -21,9 +20,10 @@ from csrf_protection import verify_csrf_token, get_csrf_token
 from password_policy import validate_password_strength
 from rate_limiter import rate_limiter, check_auth_rate_limit
 from security_logger import SecurityLogger
-
-# Configure templates
-templates = Jinja2Templates(directory=str(os.path.join(os.path.dirname(__file__), "templates")))
+from stripe_catalog import stripe_catalog, landing_products
+from stripe_client import stripe_client
+from templating import templates
+from page_cache import page_cache
 
 # Initialize Stripe
 stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
@@ -34,7 +34,7 @@ router = APIRouter()
 # API Routes for authentication
 @router.post("/token", response_model=Token)
 async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
-    user = authenticate_user(db, form_data.username, form_data.password)
+    user = await authenticate_user(db, form_data.username, form_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -61,7 +61,7 @@ async def register_user(user: UserCreate, db: Session = Depends(get_db)):
     if not is_admin_exists(db):
         user.role = UserRole.ADMIN.value
     
-    return create_user(db=db, user=user)
+    return await create_user(db=db, user=user)
 
 @router.get("/api/users/me", response_model=UserResponse)
 async def read_users_me(current_user: User = Depends(get_current_active_user)):
@@ -77,7 +77,29 @@ async def root():
 async def landing_page(request: Request, current_user: User = Depends(get_current_user_from_cookie)):
     print(f"Landing page - Current user: {current_user}")
     logging.info(f"Landing page - Current user: {current_user}")
-    return templates.TemplateResponse("landing.html", {"request": request, "user": current_user})
+    # Pricing comes from the cached Stripe catalog; the template has static pricing as a fallback
+    if stripe.api_key:
+        try:
+            # Cheap once loaded; also starts a background refresh when the snapshot is stale
+            await stripe_catalog.products()
+        except Exception as e:
+            logging.error(f"Error loading Stripe products: {str(e)}")
+
+    async def context():
+        products = []
+        if stripe.api_key:
+            try:
+                products = await landing_products()
+            except Exception as e:
+                logging.error(f"Error loading Stripe products: {str(e)}")
+        pricing_table = page_cache.fragment(
+            "pricing_table",
+            lambda: templates.get_template("partials/pricing_table.html").render(products=products),
+            version=stripe_catalog.version
+        )
+        return {"products": products, "pricing_table": pricing_table}
+
+    return await page_cache.render(request, "landing.html", current_user, context, version=stripe_catalog.version)
 
 # Login route
 @router.get("/login", response_class=HTMLResponse)
@@ -93,7 +115,7 @@ async def login_submit(
     _: bool = Depends(verify_csrf_token),
     client_ip: str = Depends(check_auth_rate_limit)
 ):
-    user = authenticate_user(db, username, password)
+    user = await authenticate_user(db, username, password)
     if not user:
         # Record failed login attempt
         rate_limiter.record_auth_attempt(client_ip, success=False)
@@ -199,13 +221,13 @@ async def register_submit(
         role = UserRole.ADMIN.value
     
     user = UserCreate(username=username, email=email, password=password, role=role)
-    db_user = create_user(db=db, user=user)
+    db_user = await create_user(db=db, user=user)
     
     # If user is a customer, create a customer record
     if role == UserRole.CUSTOMER.value:
         # Create Stripe customer first
         try:
-            stripe_customer = stripe.Customer.create(
+            stripe_customer = await stripe_client.Customer.create(
                 email=email,
                 name=username,
                 metadata={"company": company}
@@ -312,15 +334,15 @@ async def admin_redirect(request: Request, current_user: User = Depends(get_curr
     db = next(get_db())  # Get a proper DB session
     return await admin_dashboard(request, db, current_user)
 
-# Landing page routes for features, pricing, etc.
+# Landing page routes for features, pricing, etc. (served from the page cache)
 @router.get("/features", response_class=HTMLResponse)
 async def features_page(request: Request, current_user: User = Depends(get_current_user_from_cookie)):
-    return templates.TemplateResponse("features.html", {"request": request, "user": current_user})
+    return await page_cache.render(request, "features.html", current_user)
 
 @router.get("/pricing", response_class=HTMLResponse)
 async def pricing_page(request: Request, current_user: User = Depends(get_current_user_from_cookie)):
-    return templates.TemplateResponse("pricing.html", {"request": request, "user": current_user, "current_user": current_user})
+    return await page_cache.render(request, "pricing.html", current_user)
 
 @router.get("/contact", response_class=HTMLResponse)
 async def contact_page(request: Request, current_user: User = Depends(get_current_user_from_cookie)):
-    return templates.TemplateResponse("contact.html", {"request": request, "user": current_user, "current_user": current_user})
+    return await page_cache.render(request, "contact.html", current_user)
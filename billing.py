@@ -1,6 +1,9 @@
 import stripe
 from sqlalchemy.orm import Session
 from database import Customer, Invoice, Usage, SessionLocal
+from usage_partitions import partition_manager
+from cost_ledger import get_customer_cost
+from stripe_client import stripe_client
 from datetime import datetime, timedelta
 from sqlalchemy import func
 import secrets
@@ -23,7 +26,7 @@ class BillingService:
             # Create customer in Stripe if configured
             if self.stripe_key:
                 try:
-                    stripe_customer = stripe.Customer.create(
+                    stripe_customer = await stripe_client.Customer.create(
                         name=name,
                         email=email,
                         description=f"Customer from {company}"
@@ -56,16 +59,17 @@ class BillingService:
             thirty_days_ago = datetime.utcnow() - timedelta(days=30)
             
             # Query usage data grouped by date
+            usage_source = partition_manager.usage_source(db, thirty_days_ago)
             usage_by_day = db.query(
-                func.date(Usage.timestamp).label('date'),
-                func.count(Usage.id).label('count'),
-                func.sum(Usage.tokens_used).label('tokens'),
-                func.sum(Usage.cost).label('cost')
-            ).join(Usage.api_key)\
+                func.date(usage_source.timestamp).label('date'),
+                func.count(usage_source.id).label('count'),
+                func.sum(usage_source.tokens_used).label('tokens'),
+                func.sum(usage_source.cost).label('cost')
+            ).join(usage_source.api_key)\
             .filter(
-                Usage.api_key.has(customer_id=customer_id),
-                Usage.timestamp >= thirty_days_ago
-            ).group_by(func.date(Usage.timestamp))\
+                usage_source.api_key.has(customer_id=customer_id),
+                usage_source.timestamp >= thirty_days_ago
+            ).group_by(func.date(usage_source.timestamp))\
             .order_by('date')\
             .all()
             
@@ -89,19 +93,12 @@ class BillingService:
             raise ValueError("Customer not found")
             
         # Calculate total usage for the period
-        usage = db.query(func.sum(Usage.cost).label('total_cost'))\
-            .join(Usage.api_key)\
-            .filter(
-                Usage.api_key.has(customer_id=customer_id),
-                Usage.timestamp.between(period_start, period_end)
-            ).scalar()
-            
-        total_amount = usage or 0.0
+        total_amount = get_customer_cost(db, customer_id, period_start, period_end + timedelta(microseconds=1))
         
         # Create invoice in Stripe if configured
         if self.stripe_key:
             try:
-                stripe_invoice = stripe.Invoice.create(
+                stripe_invoice = await stripe_client.Invoice.create(
                     customer=customer.stripe_customer_id,
                     amount=int(total_amount * 100),  # Convert to cents
                     currency='usd',
@@ -139,7 +136,7 @@ class BillingService:
 
             # Create payment intent in Stripe
             if self.stripe_key:
-                intent = stripe.PaymentIntent.create(
+                intent = await stripe_client.PaymentIntent.create(
                     amount=int(amount * 100),  # Convert to cents
                     currency='usd',
                     customer=customer.stripe_customer_id,
@@ -162,7 +159,7 @@ class BillingService:
                 return type('MockPaymentMethods', (), {'data': []})()
 
             try:
-                payment_methods = stripe.PaymentMethod.list(
+                payment_methods = await stripe_client.PaymentMethod.list(
                     customer=customer.stripe_customer_id,
                     type='card'
                 )
@@ -183,7 +180,7 @@ class BillingService:
                 raise ValueError("Customer not found")
 
             if self.stripe_key:
-                payment_method = stripe.PaymentMethod.attach(
+                payment_method = await stripe_client.PaymentMethod.attach(
                     payment_method_id,
                     customer=customer.stripe_customer_id,
                 )
@@ -201,7 +198,7 @@ class BillingService:
                 raise ValueError("Customer not found")
 
             if self.stripe_key:
-                charges = stripe.Charge.list(
+                charges = await stripe_client.Charge.list(
                     customer=customer.stripe_customer_id,
                     limit=100
                 )
@@ -220,7 +217,7 @@ class BillingService:
 
             if self.stripe_key:
                 # Set the default payment method for the customer
-                stripe.Customer.modify(
+                await stripe_client.Customer.modify(
                     customer.stripe_customer_id,
                     invoice_settings={
                         'default_payment_method': payment_method_id
@@ -0,0 +1,283 @@
+import os
+import sys
+import time
+import random
+import secrets
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from typing import Dict, Any, Optional, Tuple
+
+import stripe
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from database import SessionLocal, Customer, Invoice, BillingRun, BillingRunItem
+from cost_ledger import get_customer_costs
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Stripe calls in flight at once during a billing run
+BILLING_RUN_CONCURRENCY = int(os.getenv("BILLING_RUN_CONCURRENCY", "8"))
+# Attempts per Stripe call on rate limiting or connection errors
+BILLING_RUN_MAX_ATTEMPTS = int(os.getenv("BILLING_RUN_MAX_ATTEMPTS", "4"))
+# Customers owing less than this (in cents) are not invoiced
+BILLING_MIN_INVOICE_CENTS = int(os.getenv("BILLING_MIN_INVOICE_CENTS", "50"))
+
+# Initialize Stripe
+stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
+
+# Placeholder Stripe ids used for local development customers
+MOCK_STRIPE_PREFIXES = ("cus_mock_", "cus_example")
+
+
+def previous_month(now: Optional[datetime] = None) -> Tuple[datetime, datetime]:
+    """Start and (exclusive) end of the month before `now`"""
+    now = now or datetime.utcnow()
+    period_end = datetime(now.year, now.month, 1)
+    if period_end.month == 1:
+        return datetime(period_end.year - 1, 12, 1), period_end
+    return datetime(period_end.year, period_end.month - 1, 1), period_end
+
+
+def _uses_stripe(stripe_customer_id: Optional[str]) -> bool:
+    return bool(
+        stripe.api_key
+        and stripe.api_key != "sk_test_example"
+        and stripe_customer_id
+        and not stripe_customer_id.startswith(MOCK_STRIPE_PREFIXES)
+    )
+
+
+def with_stripe_retries(call, *args, **kwargs):
+    """Call Stripe, backing off on rate limits and connection errors"""
+    for attempt in range(1, BILLING_RUN_MAX_ATTEMPTS + 1):
+        try:
+            return call(*args, **kwargs)
+        except (stripe.error.RateLimitError, stripe.error.APIConnectionError) as e:
+            if attempt == BILLING_RUN_MAX_ATTEMPTS:
+                raise
+            delay = min(2 ** attempt, 30) * random.uniform(0.5, 1.0)
+            logger.warning(f"Stripe call failed ({str(e)}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+
+def _save_invoice_id(item_id: int, stripe_invoice_id: str):
+    """Checkpoint a created invoice before its line item is added"""
+    db = SessionLocal()
+    try:
+        db.query(BillingRunItem).filter(BillingRunItem.id == item_id).update(
+            {"stripe_invoice_id": stripe_invoice_id}, synchronize_session=False
+        )
+        db.commit()
+    finally:
+        db.close()
+
+
+def _invoice_customer(
+    run_id: int,
+    item_id: int,
+    customer_id: int,
+    stripe_customer_id: Optional[str],
+    amount: int,
+    description: str,
+    stripe_invoice_id: Optional[str] = None
+) -> Tuple[str, Optional[str]]:
+    """
+    Create one customer's Stripe invoice; runs on a worker thread.
+
+    The invoice is created as a draft and its id checkpointed before the
+    line item is added, so a resumed run (even after Stripe's 24 hour
+    idempotency window) completes that draft instead of creating another.
+    Within the window, the idempotency keys also make retries return the
+    objects created before.
+    """
+    if not _uses_stripe(stripe_customer_id):
+        return f"in_mock_{secrets.token_hex(10)}", None
+
+    key = f"billing-run-{run_id}-customer-{customer_id}"
+    if stripe_invoice_id is None:
+        # Not auto-advanced yet: Stripe must not finalize it before the line item is on it
+        invoice = with_stripe_retries(
+            stripe.Invoice.create,
+            customer=stripe_customer_id,
+            auto_advance=False,
+            pending_invoice_items_behavior="exclude",
+            description=description,
+            metadata={"billing_run_id": run_id, "customer_id": customer_id},
+            idempotency_key=f"{key}-invoice"
+        )
+        _save_invoice_id(item_id, invoice.id)
+        has_item = False
+    else:
+        invoice = with_stripe_retries(stripe.Invoice.retrieve, stripe_invoice_id)
+        has_item = bool(with_stripe_retries(stripe.InvoiceItem.list, invoice=invoice.id, limit=1).data)
+
+    if not has_item:
+        with_stripe_retries(
+            stripe.InvoiceItem.create,
+            customer=stripe_customer_id,
+            invoice=invoice.id,
+            amount=amount,
+            currency="usd",
+            description=description,
+            idempotency_key=f"{key}-item"
+        )
+    if not invoice.auto_advance:
+        invoice = with_stripe_retries(
+            stripe.Invoice.modify,
+            invoice.id,
+            auto_advance=True,
+            idempotency_key=f"{key}-advance"
+        )
+    return invoice.id, invoice.get("hosted_invoice_url")
+
+
+def _record_invoice(db: Session, item: BillingRunItem, stripe_invoice_id: str, invoice_url: Optional[str], description: str):
+    """Insert or update the local row of an invoiced item (the webhook mirror may have stored it already)"""
+    record = db.query(Invoice).filter(Invoice.stripe_invoice_id == stripe_invoice_id).first()
+    if record is None:
+        record = Invoice(customer_id=item.customer_id, stripe_invoice_id=stripe_invoice_id, status="open")
+        db.add(record)
+    record.amount = item.amount
+    record.description = description
+    record.invoice_url = invoice_url or record.invoice_url
+    # Keep a status the mirror already knows (e.g. paid); only fill a missing one
+    record.status = record.status or "open"
+
+
+def run_billing(
+    period_start: datetime,
+    period_end: datetime,
+    concurrency: int = BILLING_RUN_CONCURRENCY
+) -> Dict[str, Any]:
+    """
+    Invoice every customer for usage in [period_start, period_end).
+
+    Amounts for all customers come from the cost ledger and are stored as
+    BillingRunItem checkpoints before any Stripe call is made. Invoices are
+    then created with bounded concurrency, and each result is committed as
+    it arrives, so running the same period again only retries customers that
+    are still pending or failed.
+    """
+    db = SessionLocal()
+    try:
+        run = db.query(BillingRun).filter_by(period_start=period_start, period_end=period_end).first()
+        if run is None:
+            run = BillingRun(period_start=period_start, period_end=period_end, status="running")
+            db.add(run)
+            db.commit()
+        elif run.status == "completed":
+            logger.info(f"Billing run {run.id} for {period_start:%Y-%m-%d} to {period_end:%Y-%m-%d} already completed")
+            return _summary(run)
+        else:
+            logger.info(f"Resuming billing run {run.id}")
+            run.status = "running"
+            db.commit()
+
+        # Amounts are fixed the first time a customer is seen, so retries send
+        # Stripe exactly the same request under the same idempotency key
+        checkpointed = {customer_id for (customer_id,) in db.query(BillingRunItem.customer_id).filter_by(run_id=run.id)}
+        totals = get_customer_costs(db, period_start, period_end)
+        for customer_id, usage in totals.items():
+            if customer_id is None or customer_id in checkpointed:
+                continue
+            amount = int(round(usage["cost"] * 100))
+            db.add(BillingRunItem(
+                run_id=run.id,
+                customer_id=customer_id,
+                amount=amount,
+                status="pending" if amount >= BILLING_MIN_INVOICE_CENTS else "skipped"
+            ))
+        db.commit()
+
+        pending = db.query(BillingRunItem, Customer.stripe_customer_id).join(
+            Customer, BillingRunItem.customer_id == Customer.id
+        ).filter(
+            BillingRunItem.run_id == run.id,
+            BillingRunItem.status.in_(["pending", "failed"])
+        ).all()
+        logger.info(f"Billing run {run.id}: invoicing {len(pending)} customers with concurrency {concurrency}")
+
+        description = f"API Usage {period_start.strftime('%Y-%m-%d')} to {period_end.strftime('%Y-%m-%d')}"
+        started = time.monotonic()
+        done = 0
+
+        # Workers talk to Stripe (and checkpoint a new invoice's id); results
+        # are written here, one commit per finished customer
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+            futures = {
+                pool.submit(
+                    _invoice_customer, run.id, item.id, item.customer_id, stripe_customer_id,
+                    item.amount, description, item.stripe_invoice_id
+                ): item
+                for item, stripe_customer_id in pending
+            }
+            for future in as_completed(futures):
+                item = futures[future]
+                try:
+                    stripe_invoice_id, invoice_url = future.result()
+                    item.attempts = (item.attempts or 0) + 1
+                    item.status = "invoiced"
+                    item.stripe_invoice_id = stripe_invoice_id
+                    item.error = None
+                    _record_invoice(db, item, stripe_invoice_id, invoice_url, description)
+                    db.commit()
+                except Exception as e:
+                    db.rollback()
+                    logger.error(f"Billing run {run.id}: invoicing customer {item.customer_id} failed: {str(e)}")
+                    item.attempts = (item.attempts or 0) + 1
+                    item.status = "failed"
+                    item.error = str(e)[:500]
+                    db.commit()
+                    continue
+
+                done += 1
+                if done % 100 == 0:
+                    logger.info(f"Billing run {run.id}: {done}/{len(pending)} invoiced ({time.monotonic() - started:.0f}s)")
+
+        counts = dict(db.query(BillingRunItem.status, func.count(BillingRunItem.id)).filter(
+            BillingRunItem.run_id == run.id
+        ).group_by(BillingRunItem.status).all())
+        run.customer_count = sum(counts.values())
+        run.invoiced_count = counts.get("invoiced", 0)
+        run.failed_count = counts.get("failed", 0)
+        run.status = "completed_with_errors" if run.failed_count else "completed"
+        run.completed_at = datetime.utcnow()
+        db.commit()
+
+        logger.info(
+            f"Billing run {run.id} {run.status}: {run.invoiced_count} invoiced, "
+            f"{run.failed_count} failed, {counts.get('skipped', 0)} below minimum "
+            f"in {time.monotonic() - started:.0f}s"
+        )
+        return _summary(run)
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Error in billing run: {str(e)}")
+        raise
+    finally:
+        db.close()
+
+
+def _summary(run: BillingRun) -> Dict[str, Any]:
+    return {
+        "id": run.id,
+        "period_start": run.period_start.isoformat(),
+        "period_end": run.period_end.isoformat(),
+        "status": run.status,
+        "customers": run.customer_count,
+        "invoiced": run.invoiced_count,
+        "failed": run.failed_count
+    }
+
+
+if __name__ == "__main__":
+    # Usage: python billing_run.py [YYYY-MM]  (defaults to the previous month)
+    if len(sys.argv) > 1:
+        start = datetime.strptime(sys.argv[1], "%Y-%m")
+        end = datetime(start.year + start.month // 12, start.month % 12 + 1, 1)
+    else:
+        start, end = previous_month()
+    logger.info(f"Billing run result: {run_billing(start, end)}")
@@ -1,8 +1,10 @@
 import stripe
-from datetime import datetime
+from datetime import datetime, timedelta
 from typing import Optional
 from sqlalchemy.orm import Session
-from database import Customer, Invoice, Usage
+from database import Invoice, APIKey
+from usage_rollups import record_usage
+from cost_ledger import get_customer_cost
 
 class BillingService:
     def __init__(self, session: Session, stripe_key: Optional[str] = None):
@@ -16,16 +18,17 @@ class BillingService:
     
     def record_usage(self, api_key_id: int, model_id: int, request_type: str, tokens_used: int, response_time: float, cost: float):
         """Record API usage for billing"""
-        usage = Usage(
+        customer_id = self.session.query(APIKey.customer_id).filter_by(id=api_key_id).scalar()
+        record_usage(
+            self.session,
             api_key_id=api_key_id,
+            customer_id=customer_id,
             model_id=model_id,
             request_type=request_type,
             tokens_used=tokens_used,
             response_time=response_time,
             cost=cost
         )
-        self.session.add(usage)
-        self.session.commit()
     
     def create_invoice(self, customer_id: int, amount: float, period_start: datetime, period_end: datetime):
         """Create an invoice for a customer"""
@@ -42,19 +45,5 @@ class BillingService:
     
     def get_customer_usage(self, customer_id: int, start_date: datetime, end_date: datetime) -> float:
         """Get total usage cost for a customer in a given period"""
-        total_cost = 0.0
-        customer = self.session.query(Customer).filter_by(id=customer_id).first()
-        if not customer:
-            return total_cost
-            
-        for api_key in customer.api_keys:
-            usages = self.session.query(Usage).filter(
-                Usage.api_key_id == api_key.id,
-                Usage.timestamp >= start_date,
-                Usage.timestamp <= end_date
-            ).all()
-            
-            for usage in usages:
-                total_cost += usage.cost
-                
-        return total_cost
+        # The ledger answers whole hours; only the partial hours at the edges are read raw
+        return get_customer_cost(self.session, customer_id, start_date, end_date + timedelta(microseconds=1))
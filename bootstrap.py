@@ -0,0 +1,117 @@
+import os
+import sys
+import time
+import logging
+from contextlib import contextmanager
+
+from sqlalchemy import text
+
+from database import Base, SessionLocal, SchemaVersion, SCHEMA_VERSION, engine, get_schema_version, seed_db, SQLALCHEMY_DATABASE_URL
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Let a worker bootstrap an empty or outdated database itself (default: only for SQLite, i.e. local development)
+DATABASE_AUTO_BOOTSTRAP = os.getenv(
+    "DATABASE_AUTO_BOOTSTRAP", "true" if SQLALCHEMY_DATABASE_URL.startswith("sqlite") else "false"
+).lower() == "true"
+
+# Arbitrary key of the PostgreSQL advisory lock held while bootstrapping
+BOOTSTRAP_LOCK_KEY = 7242016
+
+
+class SchemaNotReady(RuntimeError):
+    """Raised at startup when the database is behind the code's schema version"""
+
+
+@contextmanager
+def _bootstrap_lock():
+    """Serialize concurrent bootstraps (PostgreSQL); SQLite is single-host and relies on the version re-check"""
+    if engine.dialect.name != "postgresql":
+        yield
+        return
+    with engine.connect() as connection:
+        connection.execute(text("SELECT pg_advisory_lock(:key)"), {"key": BOOTSTRAP_LOCK_KEY})
+        try:
+            yield
+        finally:
+            connection.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": BOOTSTRAP_LOCK_KEY})
+
+
+def _upgrade(version):
+    """Bring the schema from `version` (None: empty or pre-versioning database) to SCHEMA_VERSION"""
+    # Creates any missing tables; existing ones (and their indexes) are left alone
+    Base.metadata.create_all(bind=engine)
+    if version is None:
+        # Databases from before versioning may lack the API key digest columns
+        from api_keys import migrate as migrate_api_keys
+        migrate_api_keys()
+    if version is None or version < 2:
+        # Version 2: SQLite usage ids must not be reused after rotation
+        from usage_partitions import partition_manager
+        partition_manager.enable_autoincrement()
+    if version is None or version < 3:
+        # Version 3: one daily rollup per API key for requests without a model
+        from usage_rollups import add_no_model_index
+        add_no_model_index()
+    if version is None or version < 4:
+        # Version 4: keyset pagination indexes, which create_all skips on tables that already existed
+        from migrate_database import add_pagination_indexes
+        add_pagination_indexes()
+
+
+def bootstrap(force: bool = False, show_seeded_key: bool = False) -> int:
+    """
+    Create, upgrade and seed the database once; a no-op when it is already at SCHEMA_VERSION.
+
+    The seeded test customer's API key is stored only as a digest and never
+    logged; with `show_seeded_key` (the CLI) it is printed to stdout once.
+    Otherwise an admin issues the test customer a key from /admin/api-keys.
+    """
+    with _bootstrap_lock():
+        version = get_schema_version()
+        if version is not None and version >= SCHEMA_VERSION and not force:
+            logger.info(f"Database schema is at version {version}; nothing to do")
+            return version
+
+        started = time.monotonic()
+        logger.info(f"Bootstrapping database schema from version {version} to {SCHEMA_VERSION}")
+        _upgrade(version)
+        seeded_key = seed_db()
+        if seeded_key and show_seeded_key:
+            print(f"Default API key for the test customer (shown once): {seeded_key}")
+
+        db = SessionLocal()
+        try:
+            row = db.query(SchemaVersion).get(1)
+            if row is None:
+                db.add(SchemaVersion(id=1, version=SCHEMA_VERSION))
+            else:
+                row.version = max(row.version, SCHEMA_VERSION)
+            db.commit()
+        finally:
+            db.close()
+        logger.info(f"Database schema is at version {SCHEMA_VERSION} ({time.monotonic() - started:.2f}s)")
+        return SCHEMA_VERSION
+
+
+def check_schema() -> int:
+    """Startup check: one read of the version row (bootstraps first if DATABASE_AUTO_BOOTSTRAP is set)"""
+    version = get_schema_version()
+    if version is not None and version >= SCHEMA_VERSION:
+        if version > SCHEMA_VERSION:
+            # Normal during a rolling deploy: newer code already upgraded the schema
+            logger.warning(f"Database schema version {version} is newer than this code's ({SCHEMA_VERSION})")
+        return version
+    if DATABASE_AUTO_BOOTSTRAP:
+        return bootstrap()
+    raise SchemaNotReady(
+        f"Database schema is at version {version}, this code needs {SCHEMA_VERSION}; run `python bootstrap.py` first"
+    )
+
+
+if __name__ == "__main__":
+    # Usage: python bootstrap.py [--force]
+    # database.py logs at import, which already configured the root logger at WARNING
+    logging.getLogger().setLevel(logging.INFO)
+    bootstrap(force="--force" in sys.argv[1:], show_seeded_key=True)
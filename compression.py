@@ -0,0 +1,173 @@
+import os
+import zlib
+import logging
+from typing import Optional, Tuple
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+# Responses smaller than this are sent as they are
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))
+# gzip level and brotli quality; low values keep per-request CPU small
+COMPRESSION_GZIP_LEVEL = int(os.getenv("COMPRESSION_GZIP_LEVEL", "6"))
+COMPRESSION_BROTLI_QUALITY = int(os.getenv("COMPRESSION_BROTLI_QUALITY", "4"))
+
+# Content types worth compressing (images, archives etc. already are)
+COMPRESSIBLE_TYPES = (
+    "text/html", "text/css", "text/plain", "text/csv", "text/javascript", "text/xml",
+    "application/json", "application/x-ndjson", "application/javascript", "application/xml",
+    "image/svg+xml"
+)
+
+
+def accepted_encodings(headers: Headers) -> set:
+    """Codings the client accepts (q=0 excluded)"""
+    accepted = set()
+    for item in headers.get("accept-encoding", "").split(","):
+        coding, _, params = item.strip().partition(";")
+        params = params.replace(" ", "")
+        if coding and params not in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            accepted.add(coding.lower())
+    return accepted
+
+
+def choose_encoding(headers: Headers) -> Optional[str]:
+    accepted = accepted_encodings(headers)
+    if brotli is not None and "br" in accepted:
+        return "br"
+    if "gzip" in accepted:
+        return "gzip"
+    return None
+
+
+class _Encoder:
+    """Incremental gzip or brotli stream; flush() makes everything so far decodable"""
+
+    def __init__(self, encoding: str, gzip_level: int, brotli_quality: int):
+        if encoding == "br":
+            self._compressor = brotli.Compressor(quality=brotli_quality)
+            self._flush = self._compressor.flush
+            self._finish = self._compressor.finish
+            self._process = self._compressor.process
+        else:
+            # wbits 31: gzip container
+            self._compressor = zlib.compressobj(gzip_level, zlib.DEFLATED, 31)
+            self._flush = lambda: self._compressor.flush(zlib.Z_SYNC_FLUSH)
+            self._finish = self._compressor.flush
+            self._process = self._compressor.compress
+
+    def chunk(self, data: bytes) -> bytes:
+        return self._process(data) + self._flush()
+
+    def last(self, data: bytes) -> bytes:
+        return self._process(data) + self._finish()
+
+
+class CompressionMiddleware:
+    """
+    Compresses responses with brotli (when installed) or gzip.
+
+    Plain ASGI: nothing is buffered beyond the first body message. A body
+    sent in one message is compressed whole if it reaches the size
+    threshold; a streamed body is compressed chunk by chunk, each chunk
+    flushed so clients see it at once. Only allowlisted content types are
+    compressed, and server-sent event streams never are.
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        minimum_size: int = COMPRESSION_MIN_SIZE,
+        gzip_level: int = COMPRESSION_GZIP_LEVEL,
+        brotli_quality: int = COMPRESSION_BROTLI_QUALITY,
+        compressible_types: Tuple[str, ...] = COMPRESSIBLE_TYPES
+    ):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.compressible_types = tuple(compressible_types)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = choose_encoding(Headers(scope=scope))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        await _CompressedResponder(self, encoding, send)(scope, receive)
+
+
+class _CompressedResponder:
+    def __init__(self, middleware: CompressionMiddleware, encoding: str, send: Send):
+        self.middleware = middleware
+        self.encoding = encoding
+        self.send = send
+        self.start_message: Optional[Message] = None
+        self.encoder: Optional[_Encoder] = None
+        # None until the first body message decides it
+        self.compressing: Optional[bool] = None
+
+    async def __call__(self, scope: Scope, receive: Receive):
+        await self.middleware.app(scope, receive, self.send_compressed)
+
+    def _compressible(self, message: Message) -> bool:
+        headers = Headers(raw=message.get("headers", []))
+        if message.get("status", 200) in (204, 206, 304) or "content-encoding" in headers:
+            return False
+        content_type = headers.get("content-type", "").split(";")[0].strip().lower()
+        return content_type in self.middleware.compressible_types
+
+    async def send_compressed(self, message: Message):
+        if message["type"] == "http.response.start":
+            if self._compressible(message):
+                # Hold the headers until the first body message shows the size
+                self.start_message = message
+            else:
+                self.compressing = False
+                await self.send(message)
+            return
+
+        if message["type"] != "http.response.body" or self.compressing is False:
+            await self.send(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+
+        if self.compressing is None:
+            headers = MutableHeaders(raw=self.start_message["headers"])
+            if not more_body and len(body) < self.middleware.minimum_size:
+                self.compressing = False
+                await self.send(self.start_message)
+                await self.send(message)
+                return
+
+            self.compressing = True
+            self.encoder = _Encoder(self.encoding, self.middleware.gzip_level, self.middleware.brotli_quality)
+            headers["Content-Encoding"] = self.encoding
+            headers.add_vary_header("Accept-Encoding")
+            if more_body:
+                # Streamed: the length is unknown until the end
+                del headers["Content-Length"]
+                await self.send(self.start_message)
+                await self.send({"type": "http.response.body", "body": self.encoder.chunk(body), "more_body": True})
+            else:
+                compressed = self.encoder.last(body)
+                headers["Content-Length"] = str(len(compressed))
+                await self.send(self.start_message)
+                await self.send({"type": "http.response.body", "body": compressed})
+            return
+
+        if more_body:
+            await self.send({"type": "http.response.body", "body": self.encoder.chunk(body), "more_body": True})
+        else:
+            await self.send({"type": "http.response.body", "body": self.encoder.last(body)})
@@ -0,0 +1,227 @@
+import sys
+import logging
+from datetime import datetime, timedelta
+from typing import Dict, Any, Optional, Tuple
+
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from database import SessionLocal, APIKey, CostLedgerEntry
+from usage_partitions import partition_manager
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Width of one ledger bucket; ranges are answered from whole buckets plus raw
+# usage for at most one partial bucket at each end
+LEDGER_BUCKET = timedelta(hours=1)
+
+
+def bucket_floor(timestamp: datetime) -> datetime:
+    """Start of the ledger bucket containing `timestamp`"""
+    return timestamp.replace(minute=0, second=0, microsecond=0)
+
+
+def bucket_ceil(timestamp: datetime) -> datetime:
+    """Start of the first ledger bucket at or after `timestamp`"""
+    start = bucket_floor(timestamp)
+    return start if start == timestamp else start + LEDGER_BUCKET
+
+
+def update_cost_ledger(
+    db: Session,
+    timestamp: datetime,
+    customer_id: Optional[int],
+    tokens_used: int,
+    cost: float
+):
+    """Add one request to its customer's ledger bucket (in the caller's transaction; not committed)"""
+    if customer_id is None:
+        return
+    tokens_used = tokens_used or 0
+    cost = cost or 0.0
+    bucket_start = bucket_floor(timestamp)
+
+    for attempt in range(2):
+        try:
+            # A savepoint, so a lost insert race only undoes this upsert
+            with db.begin_nested():
+                entry = db.query(CostLedgerEntry).filter_by(
+                    customer_id=customer_id,
+                    bucket_start=bucket_start
+                ).with_for_update().first()
+
+                if entry is None:
+                    db.add(CostLedgerEntry(
+                        customer_id=customer_id,
+                        bucket_start=bucket_start,
+                        request_count=1,
+                        tokens_used=tokens_used,
+                        cost=cost
+                    ))
+                else:
+                    # Increment in SQL so concurrent writers never lose an update
+                    entry.request_count = CostLedgerEntry.request_count + 1
+                    entry.tokens_used = CostLedgerEntry.tokens_used + tokens_used
+                    entry.cost = CostLedgerEntry.cost + cost
+            return
+        except IntegrityError:
+            # Another worker created the same bucket first; retry as an update
+            if attempt:
+                raise
+
+
+def _split_range(start: datetime, end: datetime) -> Tuple[datetime, datetime]:
+    """The whole-bucket part [first, last) of [start, end); first >= last if there is none"""
+    return bucket_ceil(start), bucket_floor(end)
+
+
+def _raw_totals(db: Session, customer_id: Optional[int], start: datetime, end: datetime) -> Dict[int, Dict[str, Any]]:
+    """Totals per customer straight from usage in [start, end) (used for partial buckets)"""
+    if start >= end:
+        return {}
+    usage = partition_manager.usage_source(db, start, end)
+    query = db.query(
+        APIKey.customer_id,
+        func.count(usage.id).label("requests"),
+        func.coalesce(func.sum(usage.tokens_used), 0).label("tokens"),
+        func.coalesce(func.sum(usage.cost), 0.0).label("cost")
+    ).join(
+        APIKey, usage.api_key_id == APIKey.id
+    ).filter(
+        usage.timestamp >= start,
+        usage.timestamp < end
+    )
+    if customer_id is not None:
+        query = query.filter(APIKey.customer_id == customer_id)
+    return {
+        row.customer_id: {"requests": int(row.requests), "tokens": int(row.tokens), "cost": float(row.cost)}
+        for row in query.group_by(APIKey.customer_id).all()
+        if row.customer_id is not None
+    }
+
+
+def _ledger_totals(db: Session, customer_id: Optional[int], first: datetime, last: datetime) -> Dict[int, Dict[str, Any]]:
+    """Totals per customer from the ledger buckets in [first, last)"""
+    if first >= last:
+        return {}
+    query = db.query(
+        CostLedgerEntry.customer_id,
+        func.coalesce(func.sum(CostLedgerEntry.request_count), 0).label("requests"),
+        func.coalesce(func.sum(CostLedgerEntry.tokens_used), 0).label("tokens"),
+        func.coalesce(func.sum(CostLedgerEntry.cost), 0.0).label("cost")
+    ).filter(
+        CostLedgerEntry.bucket_start >= first,
+        CostLedgerEntry.bucket_start < last
+    )
+    if customer_id is not None:
+        query = query.filter(CostLedgerEntry.customer_id == customer_id)
+    return {
+        row.customer_id: {"requests": int(row.requests), "tokens": int(row.tokens), "cost": float(row.cost)}
+        for row in query.group_by(CostLedgerEntry.customer_id).all()
+    }
+
+
+def get_customer_costs(
+    db: Session,
+    start: datetime,
+    end: datetime,
+    customer_id: Optional[int] = None
+) -> Dict[int, Dict[str, Any]]:
+    """
+    Requests, tokens and cost per customer for usage in [start, end).
+
+    Whole hours come from the ledger; only the partial hours at either end
+    of the range (none for hour-aligned ranges) are read from raw usage.
+    Pass `customer_id` to restrict the result to one customer.
+    """
+    if start >= end:
+        return {}
+    first, last = _split_range(start, end)
+    if first >= last:
+        # The range lies within a single bucket
+        return _raw_totals(db, customer_id, start, end)
+
+    totals = _ledger_totals(db, customer_id, first, last)
+    for part in (_raw_totals(db, customer_id, start, first), _raw_totals(db, customer_id, last, end)):
+        for cid, values in part.items():
+            entry = totals.setdefault(cid, {"requests": 0, "tokens": 0, "cost": 0.0})
+            entry["requests"] += values["requests"]
+            entry["tokens"] += values["tokens"]
+            entry["cost"] += values["cost"]
+    return totals
+
+
+def get_customer_cost(db: Session, customer_id: int, start: datetime, end: datetime) -> float:
+    """Total cost of one customer's usage in [start, end)"""
+    return get_customer_costs(db, start, end, customer_id).get(customer_id, {}).get("cost", 0.0)
+
+
+def rebuild_cost_ledger(since: Optional[datetime] = None, until: Optional[datetime] = None):
+    """Recompute the ledger for [since, until) from the raw usage rows (for existing data or repair)"""
+    db = SessionLocal()
+    try:
+        # Raw rows of archived partitions are gone; never discard their buckets
+        archived_until = partition_manager.archived_until(db)
+        if archived_until is not None and (since is None or since < archived_until):
+            since = archived_until
+        since = bucket_ceil(since) if since else None
+        until = bucket_floor(until) if until else None
+
+        logger.info(f"Rebuilding cost ledger{f' since {since}' if since else ''}{f' until {until}' if until else ''}")
+
+        ledger_query = db.query(CostLedgerEntry)
+        if since is not None:
+            ledger_query = ledger_query.filter(CostLedgerEntry.bucket_start >= since)
+        if until is not None:
+            ledger_query = ledger_query.filter(CostLedgerEntry.bucket_start < until)
+        ledger_query.delete(synchronize_session=False)
+
+        # Buckets are summed in Python so the hour truncation works on every dialect
+        usage = partition_manager.usage_source(db, since, until)
+        query = db.query(
+            APIKey.customer_id,
+            usage.timestamp,
+            usage.tokens_used,
+            usage.cost
+        ).join(
+            APIKey, usage.api_key_id == APIKey.id
+        ).filter(
+            APIKey.customer_id.isnot(None)
+        )
+        if since is not None:
+            query = query.filter(usage.timestamp >= since)
+        if until is not None:
+            query = query.filter(usage.timestamp < until)
+
+        buckets: Dict[Tuple[int, datetime], CostLedgerEntry] = {}
+        for customer_id, timestamp, tokens_used, cost in query.yield_per(10000):
+            key = (customer_id, bucket_floor(timestamp))
+            entry = buckets.get(key)
+            if entry is None:
+                entry = buckets[key] = CostLedgerEntry(
+                    customer_id=customer_id,
+                    bucket_start=key[1],
+                    request_count=0,
+                    tokens_used=0,
+                    cost=0.0
+                )
+            entry.request_count += 1
+            entry.tokens_used += tokens_used or 0
+            entry.cost += cost or 0.0
+
+        db.add_all(buckets.values())
+        db.commit()
+        logger.info(f"Rebuilt {len(buckets)} cost ledger buckets")
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Error rebuilding cost ledger: {str(e)}")
+        raise
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    # Usage: python cost_ledger.py [since YYYY-MM-DD]  (backfills from raw usage)
+    rebuild_cost_ledger(datetime.strptime(sys.argv[1], "%Y-%m-%d") if len(sys.argv) > 1 else None)
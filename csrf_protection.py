@@ -3,6 +3,8 @@ import time
 from typing import Optional
 from fastapi import Request, HTTPException, status, Cookie, Depends
 from pydantic import BaseModel
+from starlette.requests import cookie_parser
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
 
 # CSRF token expiration time in seconds (30 minutes)
 CSRF_TOKEN_EXPIRE_SECONDS = 1800
@@ -33,9 +35,12 @@ def get_csrf_token(request: Request) -> str:
         # For simplicity, we're just checking if it exists
         return existing_token
     
-    # Generate a new token
-    new_token = _generate_csrf_token()
-    return new_token.value
+    # Generate a new token, once per request, so the cookie set by
+    # CSRFCookieMiddleware matches the token rendered into the form
+    new_token = getattr(request.state, "csrf_token", None)
+    if new_token is None:
+        new_token = request.state.csrf_token = _generate_csrf_token().value
+    return new_token
 
 async def verify_csrf_token(
     request: Request,
@@ -95,3 +100,48 @@ def csrf_protect(func):
         return await func(*args, **kwargs)
     
     return wrapper
+
+class CSRFCookieMiddleware:
+    """
+    Sets the CSRF token cookie on HTML responses.
+
+    Plain ASGI middleware: only the headers of the http.response.start
+    message are touched, so streamed responses are not buffered.
+    """
+
+    def __init__(self, app: ASGIApp, max_age: int = CSRF_TOKEN_EXPIRE_SECONDS):
+        self.app = app
+        # Everything after the token value is the same on every response
+        self._cookie_attributes = f"; HttpOnly; Max-Age={max_age}; Path=/; SameSite=lax; Secure".encode("latin-1")
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        async def send_with_cookie(message: Message):
+            if message["type"] == "http.response.start":
+                headers = message.get("headers", [])
+                content_type = next((value for name, value in headers if name.lower() == b"content-type"), b"")
+                # Only add CSRF token to HTML responses
+                if content_type.startswith(b"text/html"):
+                    token = self._token(scope)
+                    message["headers"] = list(headers) + [
+                        (b"set-cookie", CSRF_TOKEN_COOKIE_NAME.encode("latin-1") + b"=" + token.encode("latin-1") + self._cookie_attributes)
+                    ]
+            await send(message)
+
+        await self.app(scope, receive, send_with_cookie)
+
+    @staticmethod
+    def _token(scope: Scope) -> str:
+        # The token rendered into the page during this request, if one was generated
+        token = scope.get("state", {}).get("csrf_token")
+        if token:
+            return token
+        for name, value in scope["headers"]:
+            if name == b"cookie":
+                existing_token = cookie_parser(value.decode("latin-1")).get(CSRF_TOKEN_COOKIE_NAME)
+                if existing_token:
+                    return existing_token
+        return _generate_csrf_token().value
@@ -0,0 +1,164 @@
+import os
+import threading
+import time
+import logging
+from datetime import datetime, timedelta
+from typing import Dict, Any, Optional, Tuple
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from database import APIKey, AIModel
+from usage_partitions import partition_manager
+
+logger = logging.getLogger(__name__)
+
+# How long an aggregated dashboard stays valid if no new usage arrives
+DASHBOARD_CACHE_TTL_SECONDS = float(os.getenv("DASHBOARD_CACHE_TTL_SECONDS", "30"))
+# Number of calendar days (including today) shown in the daily charts
+DASHBOARD_WINDOW_DAYS = 30
+
+
+def _day_key(value) -> str:
+    """Normalize the result of func.date() to a YYYY-MM-DD string"""
+    # SQLite returns a string, PostgreSQL returns a date object
+    if isinstance(value, str):
+        return value[:10]
+    return value.strftime("%Y-%m-%d")
+
+
+class DashboardService:
+    """Per-customer usage aggregates for the dashboards, cached with a short TTL"""
+
+    def __init__(self, ttl_seconds: float = DASHBOARD_CACHE_TTL_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        self._cache: Dict[int, Tuple[float, Dict[str, Any]]] = {}
+        # Bumped on every invalidation so an aggregation that raced with new
+        # usage is not stored over the fresher state
+        self._generations: Dict[int, int] = {}
+        self._lock = threading.Lock()
+
+    def get_customer_usage(self, db: Session, customer_id: int) -> Dict[str, Any]:
+        """Return the dashboard aggregates for a customer, from cache when fresh"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._cache.get(customer_id)
+            if entry and entry[0] > now:
+                return entry[1]
+            generation = self._generations.get(customer_id, 0)
+
+        data = self._aggregate(db, customer_id)
+
+        with self._lock:
+            if self._generations.get(customer_id, 0) == generation:
+                self._cache[customer_id] = (now + self.ttl_seconds, data)
+        return data
+
+    def invalidate(self, customer_id: Optional[int]):
+        """Drop the cached aggregates for a customer after new usage is recorded"""
+        if customer_id is None:
+            return
+        with self._lock:
+            self._cache.pop(customer_id, None)
+            self._generations[customer_id] = self._generations.get(customer_id, 0) + 1
+
+    def clear(self):
+        """Drop all cached aggregates"""
+        with self._lock:
+            self._cache.clear()
+            for customer_id in self._generations:
+                self._generations[customer_id] += 1
+
+    def _aggregate(self, db: Session, customer_id: int) -> Dict[str, Any]:
+        """Compute every dashboard series from a single grouped query (plus one for the customer's keys)"""
+        now = datetime.utcnow()
+        today = datetime(now.year, now.month, now.day)
+        window_start = today - timedelta(days=DASHBOARD_WINDOW_DAYS - 1)
+        month_start = today.replace(day=1)
+        since = min(window_start, month_start)
+
+        usage = partition_manager.usage_source(db, since)
+        day = func.date(usage.timestamp)
+        rows = db.query(
+            day.label("day"),
+            usage.model_id,
+            AIModel.name.label("model_name"),
+            usage.api_key_id,
+            APIKey.name.label("key_name"),
+            func.count(usage.id).label("requests"),
+            func.coalesce(func.sum(usage.tokens_used), 0).label("tokens"),
+            func.coalesce(func.sum(usage.cost), 0.0).label("cost"),
+            func.max(usage.id).label("last_usage_id")
+        ).join(
+            APIKey, usage.api_key_id == APIKey.id
+        ).outerjoin(
+            AIModel, usage.model_id == AIModel.id
+        ).filter(
+            APIKey.customer_id == customer_id,
+            usage.timestamp >= since
+        ).group_by(
+            day, usage.model_id, AIModel.name, usage.api_key_id, APIKey.name
+        ).all()
+
+        window_start_key = window_start.strftime("%Y-%m-%d")
+        month_start_key = month_start.strftime("%Y-%m-%d")
+        days = [(window_start + timedelta(days=i)).strftime("%Y-%m-%d") for i in range(DASHBOARD_WINDOW_DAYS)]
+
+        daily_tokens = dict.fromkeys(days, 0)
+        daily_requests = dict.fromkeys(days, 0)
+        model_totals: Dict[Any, Dict[str, Any]] = {}
+        # Every key of the customer is listed, including keys unused in the window
+        key_totals: Dict[Any, Dict[str, Any]] = {
+            key_id: {"id": key_id, "name": key_name, "tokens": 0}
+            for key_id, key_name in db.query(APIKey.id, APIKey.name).filter(
+                APIKey.customer_id == customer_id
+            ).order_by(APIKey.id)
+        }
+        total_tokens = 0
+        total_cost = 0.0
+        last_usage_id = 0
+        month = {"requests": 0, "tokens": 0, "cost": 0.0}
+
+        for row in rows:
+            day_key = _day_key(row.day)
+            tokens = int(row.tokens or 0)
+            cost = float(row.cost or 0.0)
+            requests = int(row.requests or 0)
+            last_usage_id = max(last_usage_id, row.last_usage_id or 0)
+
+            if day_key >= month_start_key:
+                month["requests"] += requests
+                month["tokens"] += tokens
+                month["cost"] += cost
+
+            if day_key < window_start_key:
+                continue
+
+            total_tokens += tokens
+            total_cost += cost
+            daily_tokens[day_key] = daily_tokens.get(day_key, 0) + tokens
+            daily_requests[day_key] = daily_requests.get(day_key, 0) + requests
+
+            if row.model_name is not None:
+                model = model_totals.setdefault(row.model_name, {"name": row.model_name, "tokens": 0, "cost": 0.0})
+                model["tokens"] += tokens
+                model["cost"] += cost
+
+            key = key_totals.setdefault(row.api_key_id, {"id": row.api_key_id, "name": row.key_name, "tokens": 0})
+            key["tokens"] += tokens
+
+        return {
+            "total_tokens": total_tokens,
+            "total_cost": total_cost,
+            "model_usage": list(model_totals.values()),
+            "daily_usage": [{"date": d, "tokens": daily_tokens[d]} for d in days],
+            "daily_requests": [{"date": d, "requests": daily_requests[d]} for d in days],
+            "key_usage": list(key_totals.values()),
+            "current_month": month,
+            # Newest usage row counted, so live deltas can pick up after it
+            "last_usage_id": last_usage_id
+        }
+
+
+# Create global dashboard service instance
+dashboard_service = DashboardService()
@@ -1,9 +1,10 @@
-from sqlalchemy import create_engine, Column, Integer, String, Float, Boolean, ForeignKey, DateTime, JSON, Enum
+from sqlalchemy import create_engine, event, DDL, Column, Integer, String, Float, Boolean, ForeignKey, DateTime, Date, JSON, Enum, UniqueConstraint, Index, LargeBinary, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.exc import DBAPIError
+from typing import Optional
 from datetime import datetime
 import os
-import secrets
 import enum
 import logging
 
@@ -30,6 +31,13 @@ SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 Base = declarative_base()
 
+# Version of the schema these models describe; bump it with every schema change (see bootstrap.py)
+SCHEMA_VERSION = 4
+
+# On PostgreSQL the usage table is natively range-partitioned by timestamp;
+# on SQLite closed periods are moved to per-period tables (see usage_partitions.py)
+USAGE_PARTITIONED = SQLALCHEMY_DATABASE_URL.startswith("postgresql")
+
 class UserRole(enum.Enum):
     ADMIN = "admin"
     CUSTOMER = "customer"
@@ -98,7 +106,11 @@ class APIKey(Base):
     __tablename__ = "api_keys"
 
     id = Column(Integer, primary_key=True, index=True)
-    key = Column(String, unique=True, index=True)
+    # Raw secret of keys issued before digest storage; cleared by `python api_keys.py purge`
+    key = Column(String, unique=True, index=True, nullable=True)
+    # SHA-256 of the secret (the lookup index) and its first characters for display
+    key_digest = Column(LargeBinary(32), unique=True, index=True, nullable=True)
+    key_prefix = Column(String(16), nullable=True)
     customer_id = Column(Integer, ForeignKey("customers.id"), nullable=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=True)
     name = Column(String)
@@ -115,6 +127,10 @@ class APIKey(Base):
 
 class UsageRecord(Base):
     __tablename__ = "usage_records"
+    # Supports keyset pagination of a key's records on (timestamp, id)
+    __table_args__ = (
+        Index("ix_usage_records_api_key_timestamp", "api_key_id", "timestamp", "id"),
+    )
     
     id = Column(Integer, primary_key=True, autoincrement=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
@@ -129,19 +145,186 @@ class UsageRecord(Base):
 
 class Usage(Base):
     __tablename__ = "usage"
+    # Supports keyset pagination of a key's usage on (timestamp, id).
+    # AUTOINCREMENT keeps SQLite from reusing ids once rotation empties the hot table.
+    __table_args__ = (
+        Index("ix_usage_api_key_timestamp", "api_key_id", "timestamp", "id"),
+        {"postgresql_partition_by": "RANGE (timestamp)", "sqlite_autoincrement": True}
+    )
 
-    id = Column(Integer, primary_key=True, index=True)
+    id = Column(Integer, primary_key=True, index=True, autoincrement=True)
     api_key_id = Column(Integer, ForeignKey("api_keys.id"))
     model_id = Column(Integer, ForeignKey("ai_models.id"))
     request_type = Column(String)
     tokens_used = Column(Integer)
     response_time = Column(Float)
     cost = Column(Float)
-    timestamp = Column(DateTime, default=datetime.utcnow)
+    # A partitioned table's primary key must include the partition column
+    timestamp = Column(DateTime, default=datetime.utcnow, primary_key=USAGE_PARTITIONED)
     
     api_key = relationship("APIKey", back_populates="usage")
     model = relationship("AIModel", back_populates="usage")
 
+# Catch-all partition so inserts never fail before a period's partition exists
+event.listen(
+    Usage.__table__,
+    "after_create",
+    DDL("CREATE TABLE IF NOT EXISTS usage_default PARTITION OF usage DEFAULT").execute_if(dialect="postgresql")
+)
+
+# One time period of usage data and where it currently lives
+class UsagePartition(Base):
+    __tablename__ = "usage_partitions"
+
+    id = Column(Integer, primary_key=True, index=True)
+    name = Column(String, unique=True, nullable=False)
+    period_start = Column(DateTime, nullable=False, index=True)
+    period_end = Column(DateTime, nullable=False)
+    status = Column(String, default="active")  # active, archived
+    row_count = Column(Integer, default=0)
+    archive_path = Column(String, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    archived_at = Column(DateTime, nullable=True)
+
+# Daily usage totals per API key and model, maintained as usage is recorded
+class UsageRollup(Base):
+    __tablename__ = "usage_rollups"
+    __table_args__ = (
+        UniqueConstraint("bucket_date", "api_key_id", "model_id", name="uq_usage_rollups_bucket"),
+        # NULLs never collide in the constraint above, so requests without a model need their own index
+        Index(
+            "uq_usage_rollups_bucket_no_model", "bucket_date", "api_key_id", unique=True,
+            sqlite_where=text("model_id IS NULL"), postgresql_where=text("model_id IS NULL")
+        ),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    bucket_date = Column(Date, nullable=False, index=True)
+    customer_id = Column(Integer, ForeignKey("customers.id"), nullable=True, index=True)
+    api_key_id = Column(Integer, ForeignKey("api_keys.id"), nullable=False)
+    model_id = Column(Integer, ForeignKey("ai_models.id"), nullable=True)
+    request_count = Column(Integer, default=0)
+    tokens_used = Column(Integer, default=0)
+    cost = Column(Float, default=0.0)
+    last_request_at = Column(DateTime, nullable=True)
+
+# Daily response-time sketch per model (see quantile_sketch.DDSketch)
+class ModelLatencyRollup(Base):
+    __tablename__ = "model_latency_rollups"
+    __table_args__ = (
+        UniqueConstraint("bucket_date", "model_id", name="uq_model_latency_rollups_bucket"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    bucket_date = Column(Date, nullable=False, index=True)
+    model_id = Column(Integer, ForeignKey("ai_models.id"), nullable=False)
+    request_count = Column(Integer, default=0)
+    sketch = Column(JSON, nullable=True)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+# Running hourly cost totals per customer (see cost_ledger)
+class CostLedgerEntry(Base):
+    __tablename__ = "cost_ledger"
+    __table_args__ = (
+        UniqueConstraint("customer_id", "bucket_start", name="uq_cost_ledger_bucket"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    customer_id = Column(Integer, ForeignKey("customers.id"), nullable=False)
+    bucket_start = Column(DateTime, nullable=False, index=True)
+    request_count = Column(Integer, default=0)
+    tokens_used = Column(Integer, default=0)
+    cost = Column(Float, default=0.0)
+
+# Position reached by a resumable bulk export, keyed by job name
+class ExportWatermark(Base):
+    __tablename__ = "export_watermarks"
+
+    id = Column(Integer, primary_key=True, index=True)
+    name = Column(String, unique=True, nullable=False)
+    last_timestamp = Column(DateTime, nullable=True)
+    last_id = Column(Integer, nullable=True)
+    chunk_count = Column(Integer, default=0)
+    row_count = Column(Integer, default=0)
+    completed_at = Column(DateTime, nullable=True)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+# A customer's Stripe subscription item with a metered price, kept in sync by webhooks
+class MeteredSubscriptionItem(Base):
+    __tablename__ = "metered_subscription_items"
+
+    id = Column(Integer, primary_key=True, index=True)
+    customer_id = Column(Integer, ForeignKey("customers.id"), unique=True, nullable=False)
+    stripe_subscription_id = Column(String, nullable=False)
+    stripe_subscription_item_id = Column(String, unique=True, nullable=False)
+    active = Column(Boolean, default=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+# One cost ledger bucket of a subscription item, queued for reporting to Stripe
+class MeteredUsageReport(Base):
+    __tablename__ = "metered_usage_reports"
+    __table_args__ = (
+        UniqueConstraint("stripe_subscription_item_id", "bucket_start", name="uq_metered_usage_reports_bucket"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    stripe_subscription_item_id = Column(String, nullable=False)
+    customer_id = Column(Integer, ForeignKey("customers.id"), nullable=False)
+    bucket_start = Column(DateTime, nullable=False)
+    quantity = Column(Integer, nullable=False)
+    status = Column(String, default="pending", index=True)  # pending, reported, failed
+    attempts = Column(Integer, default=0)
+    error = Column(String, nullable=True)
+    reported_at = Column(DateTime, nullable=True)
+
+# High-water mark of ledger buckets already queued for metered reporting
+class MeteredUsageWatermark(Base):
+    __tablename__ = "metered_usage_watermarks"
+
+    id = Column(Integer, primary_key=True, index=True)
+    name = Column(String, unique=True, nullable=False)
+    queued_until = Column(DateTime, nullable=True)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+# One invoicing pass over all customers for a billing period
+class BillingRun(Base):
+    __tablename__ = "billing_runs"
+    __table_args__ = (
+        UniqueConstraint("period_start", "period_end", name="uq_billing_runs_period"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    period_start = Column(DateTime, nullable=False)
+    period_end = Column(DateTime, nullable=False)
+    status = Column(String, default="running")  # running, completed, completed_with_errors
+    customer_count = Column(Integer, default=0)
+    invoiced_count = Column(Integer, default=0)
+    failed_count = Column(Integer, default=0)
+    started_at = Column(DateTime, default=datetime.utcnow)
+    completed_at = Column(DateTime, nullable=True)
+
+    items = relationship("BillingRunItem", back_populates="run")
+
+# Checkpoint of one customer's invoice within a billing run
+class BillingRunItem(Base):
+    __tablename__ = "billing_run_items"
+    __table_args__ = (
+        UniqueConstraint("run_id", "customer_id", name="uq_billing_run_items_customer"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    run_id = Column(Integer, ForeignKey("billing_runs.id"), nullable=False, index=True)
+    customer_id = Column(Integer, ForeignKey("customers.id"), nullable=False)
+    amount = Column(Integer, default=0)  # Amount in cents
+    status = Column(String, default="pending")  # pending, invoiced, skipped, failed
+    stripe_invoice_id = Column(String, nullable=True)
+    attempts = Column(Integer, default=0)
+    error = Column(String, nullable=True)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    run = relationship("BillingRun", back_populates="items")
+
 class Invoice(Base):
     __tablename__ = "invoices"
     
@@ -157,6 +340,59 @@ class Invoice(Base):
     # Relationships
     customer = relationship("Customer", back_populates="invoices")
 
+# Verified Stripe webhook event awaiting or done processing (see webhook_inbox)
+class WebhookEvent(Base):
+    __tablename__ = "webhook_events"
+    __table_args__ = (
+        Index("ix_webhook_events_status_created", "status", "event_created", "id"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    event_id = Column(String, unique=True, nullable=False)
+    event_type = Column(String, nullable=False)
+    payload = Column(JSON, nullable=False)
+    event_created = Column(DateTime, nullable=True)
+    status = Column(String, default="pending")  # pending, processing, processed, failed
+    attempts = Column(Integer, default=0)
+    error = Column(String, nullable=True)
+    claimed_by = Column(String, nullable=True)
+    claimed_at = Column(DateTime, nullable=True)
+    received_at = Column(DateTime, default=datetime.utcnow)
+    processed_at = Column(DateTime, nullable=True)
+
+# Local mirror of a Stripe customer's billing settings (see stripe_mirror)
+class StripeCustomerMirror(Base):
+    __tablename__ = "stripe_customer_mirror"
+
+    id = Column(Integer, primary_key=True, index=True)
+    stripe_customer_id = Column(String, unique=True, nullable=False)
+    customer_id = Column(Integer, ForeignKey("customers.id"), nullable=True, index=True)
+    default_payment_method_id = Column(String, nullable=True)
+    synced_at = Column(DateTime, nullable=True)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+# Local mirror of a card attached to a Stripe customer
+class StripePaymentMethodMirror(Base):
+    __tablename__ = "stripe_payment_method_mirror"
+
+    id = Column(Integer, primary_key=True, index=True)
+    stripe_payment_method_id = Column(String, unique=True, nullable=False)
+    stripe_customer_id = Column(String, nullable=False, index=True)
+    brand = Column(String, nullable=True)
+    last4 = Column(String, nullable=True)
+    exp_month = Column(Integer, nullable=True)
+    exp_year = Column(Integer, nullable=True)
+    created_at = Column(DateTime, nullable=True)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+# Schema version this database was bootstrapped to (a single row, written by bootstrap.py)
+class SchemaVersion(Base):
+    __tablename__ = "schema_version"
+
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
 def get_db():
     """Get database session"""
     db = SessionLocal()
@@ -170,17 +406,26 @@ def recreate_database():
     Base.metadata.drop_all(bind=engine)
     Base.metadata.create_all(bind=engine)
 
+def get_schema_version() -> Optional[int]:
+    """Stored schema version, or None if the database has not been bootstrapped"""
+    try:
+        with engine.connect() as connection:
+            return connection.execute(text("SELECT version FROM schema_version WHERE id = 1")).scalar()
+    except DBAPIError:
+        # No schema_version table yet
+        return None
+
 def init_db():
-    """Initialize the database if it doesn't exist"""
-    import os
+    """Create, upgrade and seed the database (run once per deploy via bootstrap.py)"""
+    from bootstrap import bootstrap
+    bootstrap()
+
+def seed_db() -> Optional[str]:
+    """Create the admin user and test customer if they don't exist; returns the test customer's new API key, if one was created"""
     from auth import get_password_hash, UserRole
+    from api_keys import issue_api_key
     
-    # Create tables
-    logging.info("Initializing database...")
-    # Always create tables if they don't exist
-    Base.metadata.create_all(bind=engine)
-    
-    # Create admin user and test customer if they don't exist
+    seeded_key = None
     db = SessionLocal()
     try:
         # Check if admin user exists
@@ -222,8 +467,7 @@ def init_db():
             db.commit()
             
             # Create API key for test customer
-            api_key = APIKey(
-                key=secrets.token_hex(16),
+            api_key, raw_key = issue_api_key(
                 customer_id=test_customer.id,
                 name="Default API Key",
                 rate_limit=60,
@@ -231,6 +475,9 @@ def init_db():
             )
             db.add(api_key)
             db.commit()
+            # Only the digest is stored; the caller decides whether to show the secret
+            logging.info(f"Created default API key {api_key.masked_key} for the test customer")
+            seeded_key = raw_key
             
             # Add sample AI models
             models = [
@@ -251,9 +498,10 @@ def init_db():
             
             db.commit()
             logging.info("Database initialization complete.")
-        
+        return seeded_key
     except Exception as e:
         db.rollback()
         logging.error(f"Error initializing database: {e}")
+        raise
     finally:
         db.close()
@@ -0,0 +1,54 @@
+import os
+import threading
+import logging
+from typing import Any, Dict, List, Optional
+
+from lazy_imports import import_module
+
+logger = logging.getLogger(__name__)
+
+# Sentence-transformers model used to embed documents
+KNOWLEDGE_EMBEDDING_MODEL = os.getenv("KNOWLEDGE_EMBEDDING_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+# Where Chroma keeps the collection (in memory when unset)
+KNOWLEDGE_PERSIST_DIRECTORY = os.getenv("KNOWLEDGE_PERSIST_DIRECTORY") or None
+
+
+class KnowledgeBase:
+    """
+    Vector store behind /add-knowledge.
+
+    langchain, chromadb and sentence-transformers (with torch) are imported
+    and the embedding model is loaded on first use, not when the app starts.
+    """
+
+    def __init__(self, embedding_model: str = KNOWLEDGE_EMBEDDING_MODEL, persist_directory: Optional[str] = KNOWLEDGE_PERSIST_DIRECTORY):
+        self.embedding_model = embedding_model
+        self.persist_directory = persist_directory
+        self._embeddings = None
+        self._store = None
+        self._lock = threading.Lock()
+
+    def _get_embeddings(self):
+        if self._embeddings is None:
+            embeddings = import_module("langchain_community.embeddings")
+            self._embeddings = embeddings.HuggingFaceEmbeddings(model_name=self.embedding_model)
+        return self._embeddings
+
+    def add_texts(self, texts: List[str], metadatas: Optional[List[Optional[Dict[str, Any]]]] = None) -> int:
+        """Embed and store documents (blocking); returns how many were added"""
+        with self._lock:
+            if self._store is None:
+                vectorstores = import_module("langchain_community.vectorstores")
+                self._store = vectorstores.Chroma.from_texts(
+                    texts=texts,
+                    embedding=self._get_embeddings(),
+                    metadatas=metadatas,
+                    persist_directory=self.persist_directory
+                )
+            else:
+                self._store.add_texts(texts=texts, metadatas=metadatas)
+        return len(texts)
+
+
+# Create global knowledge base instance
+knowledge_base = KnowledgeBase()
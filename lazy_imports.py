@@ -0,0 +1,144 @@
+import os
+import re
+import sys
+import time
+import types
+import threading
+import importlib
+import subprocess
+import logging
+from typing import Any, Dict, List, Tuple
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Packages only local inference, the knowledge base and the Parquet export need; `import main` never imports them
+HEAVY_PACKAGES = ("torch", "transformers", "sentence_transformers", "langchain", "langchain_community", "chromadb", "pyarrow")
+# Seconds `import main` may take before `python lazy_imports.py --check` fails
+IMPORT_TIME_BUDGET_SECONDS = float(os.getenv("IMPORT_TIME_BUDGET_SECONDS", "3.0"))
+
+_started = time.time()
+_loads: Dict[str, float] = {}
+_lock = threading.Lock()
+
+
+class LazyModule(types.ModuleType):
+    """
+    Stand-in for a module that is imported on first attribute access.
+
+        transformers = LazyModule("transformers")
+        transformers.AutoTokenizer  # imports transformers now
+
+    The import time is recorded for import_report().
+    """
+
+    def __init__(self, name: str):
+        super().__init__(name)
+        self.__dict__["_module"] = None
+
+    def _load(self) -> types.ModuleType:
+        module = self.__dict__["_module"]
+        if module is None:
+            module = import_module(self.__name__)
+            self.__dict__["_module"] = module
+        return module
+
+    def __getattr__(self, attribute: str) -> Any:
+        return getattr(self._load(), attribute)
+
+    def __repr__(self) -> str:
+        state = "loaded" if self.__dict__["_module"] is not None else "not loaded"
+        return f"<lazy module {self.__name__!r} ({state})>"
+
+
+def import_module(name: str) -> types.ModuleType:
+    """importlib.import_module, logging and recording how long a first import took"""
+    if name in sys.modules:
+        return sys.modules[name]
+    started = time.perf_counter()
+    module = importlib.import_module(name)
+    elapsed = time.perf_counter() - started
+    with _lock:
+        _loads[name] = elapsed
+    logger.info(f"Imported {name} on first use in {elapsed:.2f}s")
+    return module
+
+
+def _rss_mb() -> float:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return None
+
+
+def import_report() -> Dict[str, Any]:
+    """Which heavy packages this process has imported, what lazy imports cost, and its memory"""
+    with _lock:
+        loads = dict(_loads)
+    return {
+        "uptime_seconds": round(time.time() - _started, 1),
+        "rss_mb": _rss_mb(),
+        "heavy_packages_loaded": [name for name in HEAVY_PACKAGES if name in sys.modules],
+        "lazy_imports": {name: round(seconds, 3) for name, seconds in loads.items()}
+    }
+
+
+def profile_imports(module: str = "main") -> Tuple[float, List[Tuple[str, float]]]:
+    """Import a module in a fresh interpreter (-X importtime); returns total seconds and seconds per package, slowest first"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr.strip() else f"import {module} failed")
+
+    packages: Dict[str, float] = {}
+    total = 0.0
+    for line in result.stderr.splitlines():
+        match = re.match(r"import time:\s+(\d+) \|\s+(\d+) \| *(\S+)", line)
+        if not match:
+            continue
+        own, cumulative, name = int(match.group(1)), int(match.group(2)), match.group(3)
+        # Each module's own time, summed per top-level package, wherever it was imported from
+        package = name.split(".")[0]
+        packages[package] = packages.get(package, 0.0) + own / 1e6
+        if name == module:
+            total = cumulative / 1e6
+    return total, sorted(packages.items(), key=lambda item: item[1], reverse=True)
+
+
+def check_import_budget(module: str = "main", budget: float = IMPORT_TIME_BUDGET_SECONDS) -> List[str]:
+    """Problems with a fresh import of `module`: over the time budget, or heavy packages imported eagerly"""
+    total, packages = profile_imports(module)
+    problems = []
+    if total > budget:
+        slowest = ", ".join(f"{package} {seconds:.2f}s" for package, seconds in packages[:5])
+        problems.append(f"import {module} took {total:.2f}s, over the {budget:.2f}s budget (slowest: {slowest})")
+    heavy = [package for package, _ in packages if package in HEAVY_PACKAGES]
+    if heavy:
+        problems.append(f"import {module} imported {', '.join(heavy)} eagerly")
+    return problems
+
+
+if __name__ == "__main__":
+    # Usage: python lazy_imports.py [module] [--check]
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    module = args[0] if args else "main"
+    if "--check" in sys.argv[1:]:
+        problems = check_import_budget(module)
+        for problem in problems:
+            print(problem)
+        if not problems:
+            print(f"import {module} is within the {IMPORT_TIME_BUDGET_SECONDS:.2f}s budget")
+        sys.exit(1 if problems else 0)
+    total, packages = profile_imports(module)
+    print(f"import {module}: {total:.2f}s")
+    for package, seconds in packages[:15]:
+        marker = "  (heavy)" if package in HEAVY_PACKAGES else ""
+        print(f"  {seconds:8.3f}s  {package}{marker}")
+    heavy = [package for package, _ in packages if package in HEAVY_PACKAGES]
+    print(f"Heavy packages imported: {', '.join(heavy) if heavy else 'none'}")
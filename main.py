@@ -1,23 +1,26 @@
 from fastapi import FastAPI, Request, Response, status, HTTPException, Depends, Form, Cookie, Body, Header
-from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse
-from fastapi.staticfiles import StaticFiles
-from fastapi.templating import Jinja2Templates
+from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse, StreamingResponse
 from sqlalchemy.orm import Session
 from typing import List, Optional, Dict, Any
-from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel, ConfigDict
 import stripe
+import json
 import logging
 import os
 import sys
+import time
 import warnings
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm, SecurityScopes
 from datetime import datetime, timedelta
 from sqlalchemy import func
-from csrf_protection import get_csrf_token, verify_csrf_token
+from csrf_protection import get_csrf_token, verify_csrf_token, CSRFCookieMiddleware
+from lazy_imports import LazyModule
 
-from database import get_db, Customer, User, init_db, AIModel, APIKey, Usage
+from database import get_db, SessionLocal, Customer, User, AIModel, APIKey
+from bootstrap import check_schema
 from auth import (
     get_current_user, 
     get_current_active_user, 
@@ -34,6 +37,23 @@ from customers import router as customer_router
 from payment_routes import router as payment_router
 from account_routes import router as account_router
 from security_middleware import add_security_middleware
+from dashboard_service import dashboard_service
+from usage_rollups import record_usage, latency_recorder
+from usage_partitions import partition_manager
+from usage_stream import usage_broadcaster, sse_events
+from stripe_catalog import landing_products
+from stripe_client import stripe_client
+from webhook_inbox import webhook_inbox
+from api_keys import issue_api_key, api_key_cache
+from password_hasher import password_hasher
+from compression import CompressionMiddleware
+from static_assets import PrecompressedStaticFiles, asset_manifest
+from templating import templates
+from rate_limiter import rate_limiter
+# Cheap to import: torch, transformers and langchain load on first use of a local model or the knowledge base
+from model_manager import model_manager, ModelBusy
+from knowledge_base import knowledge_base
+from warmup import warmup
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -57,6 +77,9 @@ load_dotenv()
 # Initialize Stripe
 stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
 
+# Only used to forward /query to the knowledge service; imported on first use
+httpx = LazyModule("httpx")
+
 # Initialize FastAPI app
 app = FastAPI(
     title="NexusAI Forge",
@@ -65,58 +88,14 @@ app = FastAPI(
     debug=True
 )
 
-# Explicitly initialize the database
-init_db()
-
-# Configure templates and static files
-app.mount("/static", StaticFiles(directory="static"), name="static")
-templates = Jinja2Templates(directory="templates")
-
-# Add custom filters for templates
-def format_datetime(value, format="%Y-%m-%d"):
-    """Format a datetime object to a string"""
-    if value is None:
-        return ""
-    if isinstance(value, str):
-        try:
-            value = datetime.fromisoformat(value)
-        except ValueError:
-            pass
-    return value.strftime(format)
-
-def format_currency(value):
-    """Format a currency value to 2 decimal places"""
-    if value is None:
-        return "0.00"
-    try:
-        # Convert cents to dollars
-        if isinstance(value, int) and value > 100:
-            value = value / 100.0
-        return "{:.2f}".format(float(value))
-    except (ValueError, TypeError):
-        return "0.00"
+# Only check the schema version; `python bootstrap.py` creates, upgrades and seeds the database once per deploy
+check_schema()
 
-templates.env.filters["format_datetime"] = format_datetime
-templates.env.filters["format_currency"] = format_currency
+# Configure static files
+app.mount("/static", PrecompressedStaticFiles(directory="static"), name="static")
 
 # Add CSRF token to all templates
-@app.middleware("http")
-async def add_csrf_token_to_response(request: Request, call_next):
-    response = await call_next(request)
-    
-    # Only add CSRF token to HTML responses
-    if response.headers.get("content-type", "").startswith("text/html"):
-        csrf_token = get_csrf_token(request)
-        response.set_cookie(
-            key="csrf_token",
-            value=csrf_token,
-            httponly=True,
-            secure=True,
-            samesite="lax",
-            max_age=1800  # 30 minutes
-        )
-    
-    return response
+app.add_middleware(CSRFCookieMiddleware)
 
 # Add security headers middleware
 app = add_security_middleware(app, 
@@ -155,6 +134,9 @@ app.add_middleware(
     allow_headers=["Authorization", "Content-Type", "Accept"],
 )
 
+# Compress large text responses (outermost, so it sees the final headers)
+app.add_middleware(CompressionMiddleware)
+
 # Include routers from other modules
 app.include_router(admin_router)
 app.include_router(admin_routes.router)
@@ -231,83 +213,71 @@ class GenerateRequest(BaseModel):
     top_p: Optional[float] = 0.9
     top_k: Optional[int] = 50
 
-# Health check endpoint
+# Make sure the current and upcoming usage partitions exist
+@app.on_event("startup")
+async def prepare_usage_partitions():
+    try:
+        partition_manager.ensure_partitions()
+    except Exception as e:
+        logging.error(f"Error preparing usage partitions: {str(e)}")
+
+# Hash the static assets before serving, so no page (or page_cache entry) links to unversioned URLs
+@app.on_event("startup")
+async def build_asset_manifest():
+    asset_manifest.build()
+
+# Warm pools, caches and templates in the background; /ready reports when it is done
+@app.on_event("startup")
+async def start_warmup():
+    warmup.start()
+
+@app.on_event("shutdown")
+async def stop_warmup():
+    warmup.stop()
+
+# Process stored Stripe webhook events in the background
+@app.on_event("startup")
+async def start_webhook_inbox():
+    webhook_inbox.start()
+
+@app.on_event("shutdown")
+async def stop_webhook_inbox():
+    await webhook_inbox.stop()
+
+# Start the password hashing processes before the first login
+@app.on_event("startup")
+async def start_password_hasher():
+    password_hasher.start()
+
+@app.on_event("shutdown")
+async def stop_password_hasher():
+    password_hasher.shutdown()
+
+# Merge latency sketches into the database periodically, and once more before the worker exits
+@app.on_event("startup")
+async def start_latency_recorder():
+    latency_recorder.start()
+
+@app.on_event("shutdown")
+async def stop_latency_recorder():
+    await latency_recorder.stop()
+
+# Health check endpoint (liveness: the process is up)
 @app.get("/health")
 async def health_check():
     return {"status": "healthy"}
 
+# Readiness: only route traffic here once the warm-up has finished
+@app.get("/ready")
+async def readiness_check():
+    status_code = 200 if warmup.ready and not warmup.draining else 503
+    return JSONResponse(status_code=status_code, content=warmup.status())
+
 # Landing page route
 @app.get("/landing", response_class=HTMLResponse)
 async def landing_page(request: Request):
     try:
-        # Get all active Stripe products with their prices
-        products = stripe.Product.list(limit=3, active=True)
-        
-        # Process products to format them for display
-        formatted_products = []
-        for product in products.get("data", []):
-            # Get prices for this product
-            prices = stripe.Price.list(product=product["id"], active=True, limit=1)
-            price_data = prices.get("data", [])
-            
-            # Extract features from metadata or description
-            features = []
-            if "metadata" in product and "features" in product["metadata"]:
-                # Try to get features from metadata if available
-                features = product["metadata"]["features"].split(",")
-            elif product.get("description"):
-                # Otherwise parse from description
-                features = [line.strip() for line in product.get("description", "").split("\n") if line.strip()]
-            
-            # Default features if none found
-            if not features and product.get("name", "").lower() == "starter":
-                features = [
-                    "Up to 5 API keys",
-                    "1M tokens per month",
-                    "Basic analytics",
-                    "Email support"
-                ]
-            elif not features and product.get("name", "").lower() == "professional":
-                features = [
-                    "Up to 20 API keys",
-                    "10M tokens per month",
-                    "Advanced analytics",
-                    "Priority support",
-                    "Custom rate limiting"
-                ]
-            elif not features and product.get("name", "").lower() == "enterprise":
-                features = [
-                    "Unlimited API keys",
-                    "Custom token limits",
-                    "Custom analytics",
-                    "Dedicated support",
-                    "SSO integration",
-                    "On-premises deployment"
-                ]
-                
-            # Format price display
-            price_display = "Custom"
-            price_interval = ""
-            if price_data:
-                price = price_data[0]
-                if price.get("unit_amount"):
-                    amount = price.get("unit_amount") / 100
-                    price_display = f"${amount}"
-                    
-                if price.get("recurring") and price.get("recurring").get("interval"):
-                    price_interval = f"/{price.get('recurring').get('interval')}"
-            
-            formatted_products.append({
-                "id": product["id"],
-                "name": product.get("name", "Unknown"),
-                "price_display": price_display,
-                "price_interval": price_interval,
-                "features": features,
-                "is_enterprise": product.get("name", "").lower() == "enterprise"
-            })
-        
-        # Sort products by price (custom/enterprise last)
-        formatted_products.sort(key=lambda p: 999999 if p["price_display"] == "Custom" else float(p["price_display"].replace("$", "")))
+        formatted_products = await landing_products()
         
         return templates.TemplateResponse(
             "landing.html", 
@@ -352,76 +322,16 @@ async def customer_dashboard(
     # Get available AI models
     models = db.query(AIModel).filter(AIModel.is_active == True).all()
     
-    # Get usage data
-    usage_data = {}
-    
-    # Calculate total tokens used in the last 30 days
-    thirty_days_ago = datetime.utcnow() - timedelta(days=30)
-    total_tokens = db.query(func.sum(Usage.tokens_used)).join(APIKey).filter(
-        APIKey.customer_id == customer_id,
-        Usage.timestamp >= thirty_days_ago
-    ).scalar() or 0
-    
-    # Get usage by model
-    model_usage = db.query(
-        AIModel.name, 
-        func.sum(Usage.tokens_used).label('tokens_used'),
-        func.sum(Usage.cost).label('total_cost')
-    ).join(
-        Usage, Usage.model_id == AIModel.id
-    ).join(
-        APIKey, Usage.api_key_id == APIKey.id
-    ).filter(
-        APIKey.customer_id == customer_id,
-        Usage.timestamp >= thirty_days_ago
-    ).group_by(
-        AIModel.name
-    ).all()
-    
-    model_usage_data = [{"name": name, "tokens": tokens, "cost": cost} for name, tokens, cost in model_usage]
-    
-    # Get usage by day for the past 30 days
-    daily_usage = []
-    for i in range(30):
-        day = datetime.utcnow() - timedelta(days=i)
-        day_start = datetime(day.year, day.month, day.day, 0, 0, 0)
-        day_end = datetime(day.year, day.month, day.day, 23, 59, 59)
-        
-        day_tokens = db.query(func.sum(Usage.tokens_used)).join(APIKey).filter(
-            APIKey.customer_id == customer_id,
-            Usage.timestamp >= day_start,
-            Usage.timestamp <= day_end
-        ).scalar() or 0
-        
-        daily_usage.append({
-            "date": day_start.strftime("%Y-%m-%d"),
-            "tokens": day_tokens
-        })
-    
-    # Reverse to show oldest to newest
-    daily_usage.reverse()
-    
-    # Get API key usage
-    key_usage = db.query(
-        APIKey.name,
-        func.sum(Usage.tokens_used).label('tokens_used')
-    ).outerjoin(
-        Usage, Usage.api_key_id == APIKey.id
-    ).filter(
-        APIKey.customer_id == customer_id,
-        Usage.timestamp >= thirty_days_ago if Usage else True
-    ).group_by(
-        APIKey.id
-    ).all()
-    
-    key_usage_data = [{"name": name, "tokens": tokens} for name, tokens in key_usage]
+    # Get usage data (one grouped query, cached per customer)
+    summary = dashboard_service.get_customer_usage(db, customer_id)
     
     # Prepare usage data for the template
     usage_data = {
-        "total_tokens": total_tokens,
-        "model_usage": model_usage_data,
-        "daily_usage": daily_usage,
-        "key_usage": key_usage_data
+        "total_tokens": summary["total_tokens"],
+        "total_cost": summary["total_cost"],
+        "model_usage": summary["model_usage"],
+        "daily_usage": summary["daily_usage"],
+        "key_usage": summary["key_usage"]
     }
     
     return templates.TemplateResponse(
@@ -453,8 +363,7 @@ async def create_api_key(request: CreateAPIKeyRequest, db: Session = Depends(get
         logging.info(f"Found customer {customer.id} ({customer.name})")
         
         # Create API key
-        api_key = APIKey(
-            key=secrets.token_urlsafe(32),
+        api_key, raw_key = issue_api_key(
             name=request.name,
             customer_id=request.customer_id,
             rate_limit=60,
@@ -479,7 +388,7 @@ async def create_api_key(request: CreateAPIKeyRequest, db: Session = Depends(get
             status_code=200,
             content={
                 "id": api_key.id,
-                "key": api_key.key,
+                "key": raw_key,
                 "name": api_key.name,
                 "customer_id": api_key.customer_id,
                 "rate_limit": api_key.rate_limit
@@ -507,6 +416,7 @@ async def toggle_api_key(key_id: int, db: Session = Depends(get_db)):
         
         key.is_active = not key.is_active
         db.commit()
+        api_key_cache.invalidate(key.id)
         logging.info(f"Toggled API key {key_id} to {key.is_active}")
         return JSONResponse(
             status_code=200,
@@ -544,9 +454,7 @@ async def create_user_api_key(
             raise HTTPException(status_code=400, detail="User must be associated with a customer to create API keys")
             
         # Create API key
-        import secrets
-        api_key = APIKey(
-            key=secrets.token_urlsafe(32),
+        api_key, raw_key = issue_api_key(
             name=name,
             customer_id=current_user.customer_id,
             user_id=current_user.id,  # Associate with the current user
@@ -561,10 +469,10 @@ async def create_user_api_key(
         
         logging.info(f"Created API key {api_key.id} for user {current_user.username}")
         
-        # Return the created key
+        # Return the created key (the only time its secret is available)
         return {
             "success": True,
-            "key": api_key.key,
+            "key": raw_key,
             "name": api_key.name,
             "created_at": api_key.created_at.isoformat() if api_key.created_at else None
         }
@@ -601,7 +509,7 @@ async def get_user_api_keys(
         return [
             {
                 "id": key.id,
-                "key": key.key,
+                "prefix": key.key_prefix,
                 "name": key.name,
                 "created_at": key.created_at.isoformat() if key.created_at else None,
                 "is_active": key.is_active
@@ -615,7 +523,7 @@ async def get_user_api_keys(
 # Delete API key
 @app.delete("/api/keys/{key_id}", response_model=dict)
 async def delete_api_key(
-    key_id: str,
+    key_id: int,
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_active_user)
 ):
@@ -627,7 +535,7 @@ async def delete_api_key(
     try:
         # Find the API key - user can delete keys associated with their customer_id OR directly with them
         api_key = db.query(APIKey).filter(
-            APIKey.key == key_id,
+            APIKey.id == key_id,
             ((APIKey.customer_id == current_user.customer_id) | (APIKey.user_id == current_user.id))
         ).first()
         
@@ -637,6 +545,7 @@ async def delete_api_key(
         # Delete the API key
         db.delete(api_key)
         db.commit()
+        api_key_cache.invalidate(api_key.id)
         
         logging.info(f"Deleted API key {api_key.id} for user {current_user.username}")
         
@@ -692,7 +601,7 @@ async def debug_routes():
 async def add_model(request: ModelRequest, db: Session = Depends(get_db)):
     """Add a new AI model to the system"""
     try:
-        model = ModelManager().add_model(
+        model = model_manager.add_model(
             request.name,
             request.provider,
             request.model_config,
@@ -736,7 +645,7 @@ async def add_model(request: ModelRequest, db: Session = Depends(get_db)):
 async def list_models(db: Session = Depends(get_db)):
     """List all available models"""
     try:
-        models = ModelManager().list_models(db)
+        models = model_manager.list_models(db)
         return JSONResponse(
             status_code=200,
             content=[{
@@ -778,37 +687,15 @@ async def dashboard_data(customer_id: int, db: Session = Depends(get_db)):
         api_keys = db.query(APIKey).filter_by(customer_id=customer_id).all()
         logging.info(f"Found {len(api_keys)} API keys")
         
-        # Calculate current month usage and cost
-        start_of_month = datetime.utcnow().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-        usage_stats = db.query(
-            func.count(Usage.id).label('request_count'),
-            func.coalesce(func.sum(Usage.cost), 0.0).label('total_cost'),
-            func.coalesce(func.sum(Usage.tokens_used), 0).label('total_tokens')
-        ).join(APIKey).filter(
-            APIKey.customer_id == customer_id,
-            Usage.timestamp >= start_of_month
-        ).first()
-        
-        logging.info(f"Usage stats: {usage_stats}")
-        
-        # Get usage data
-        try:
-            billing_service = BillingService(os.getenv("STRIPE_SECRET_KEY"))
-            usage_summary = await billing_service.get_customer_usage_summary(db, customer_id)
-            logging.info(f"Got usage summary: {usage_summary}")
-        except Exception as e:
-            logging.error(f"Error getting usage summary: {str(e)}")
-            usage_summary = {}
+        # Current month totals and the daily request series come from the
+        # shared (cached) dashboard aggregation
+        summary = dashboard_service.get_customer_usage(db, customer_id)
+        current_month = summary["current_month"]
         
-        # Format usage data for chart
-        today = datetime.utcnow()
-        last_30_days = [(today - timedelta(days=x)).strftime('%Y-%m-%d') for x in range(30)]
-        usage_data = [0] * 30  # Initialize with zeros
-        
-        # Convert usage summary to chart data
-        if usage_summary:
-            for i, date in enumerate(last_30_days):
-                usage_data[i] = usage_summary.get(date, 0)
+        # Format usage data for chart (most recent day first)
+        daily_requests = list(reversed(summary["daily_requests"]))
+        last_30_days = [day["date"] for day in daily_requests]
+        usage_data = [day["requests"] for day in daily_requests]
         
         return {
             "customer": {
@@ -820,7 +707,7 @@ async def dashboard_data(customer_id: int, db: Session = Depends(get_db)):
             "api_keys": [{
                 "id": key.id,
                 "name": key.name,
-                "key": key.key,
+                "masked_key": key.masked_key,
                 "rate_limit": key.rate_limit,
                 "is_active": key.is_active,
                 "created_at": key.created_at.strftime("%Y-%m-%d %H:%M:%S") if key.created_at else None
@@ -829,15 +716,46 @@ async def dashboard_data(customer_id: int, db: Session = Depends(get_db)):
             "usage_data": usage_data,
             "stripe_public_key": os.getenv("STRIPE_PUBLIC_KEY", ""),
             "stripe_secret_key": os.getenv("STRIPE_SECRET_KEY", ""),
-            "current_month_cost": float(usage_stats.total_cost if usage_stats and usage_stats.total_cost is not None else 0.0),
-            "total_requests": int(usage_stats.request_count if usage_stats and usage_stats.request_count is not None else 0),
-            "total_tokens": int(usage_stats.total_tokens if usage_stats and usage_stats.total_tokens is not None else 0)
+            "current_month_cost": float(current_month["cost"]),
+            "total_requests": int(current_month["requests"]),
+            "total_tokens": int(current_month["tokens"])
         }
         
     except Exception as e:
         logging.exception(f"Error in dashboard data: {str(e)}")
         raise HTTPException(status_code=500, detail="An internal server error occurred while fetching dashboard data.")
 
+# Live usage deltas for the customer dashboard (server-sent events)
+@app.get("/api/dashboard/{customer_id}/stream")
+async def dashboard_stream(
+    customer_id: int,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    """Stream a usage snapshot followed by incremental deltas as usage is recorded"""
+    if not current_user:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    
+    if current_user.role != "admin" and (not current_user.customer_id or current_user.customer_id != customer_id):
+        raise HTTPException(status_code=403, detail="Not authorized to access this dashboard")
+    
+    # Subscribe before taking the snapshot so no delta falls in between;
+    # deltas already counted in the snapshot are skipped by usage id
+    subscription = usage_broadcaster.subscribe(customer_id)
+    try:
+        snapshot = dict(dashboard_service.get_customer_usage(db, customer_id), type="snapshot")
+    except Exception:
+        usage_broadcaster.unsubscribe(subscription)
+        raise
+    
+    # The background task also unsubscribes if the client leaves before streaming starts
+    return StreamingResponse(
+        sse_events(subscription, snapshot),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        background=BackgroundTask(usage_broadcaster.unsubscribe, subscription)
+    )
+
 # API endpoints for model usage
 @app.post("/generate")
 async def generate_text(
@@ -848,7 +766,7 @@ async def generate_text(
     """Generate text using a specific model"""
     try:
         # Validate API key and rate limit
-        key_data = db.query(APIKey).filter_by(key=api_key).first()
+        key_data = api_key_cache.lookup(db, api_key)
         if not key_data or not key_data.is_active:
             return JSONResponse(
                 status_code=401,
@@ -862,14 +780,14 @@ async def generate_text(
                 content={"error": "Model not allowed for this API key"}
             )
         
-        if not rate_limiter.is_allowed(api_key, key_data.rate_limit):
+        if not rate_limiter.is_allowed(str(key_data.id), key_data.rate_limit):
             return JSONResponse(
                 status_code=429,
                 content={"error": "Rate limit exceeded"}
             )
         
         # Get model
-        model = ModelManager().get_model(request.model_id)
+        model = model_manager.get_model(request.model_id)
         if not model:
             return JSONResponse(
                 status_code=404,
@@ -884,7 +802,8 @@ async def generate_text(
         
         # Generate response
         start_time = datetime.utcnow()
-        response = ModelManager().generate_response(
+        response = await run_in_threadpool(
+            model_manager.generate_response,
             request.prompt, 
             request.model_id,
             max_length=request.max_length,
@@ -895,20 +814,21 @@ async def generate_text(
         response_time = (datetime.utcnow() - start_time).total_seconds()
         
         # Calculate cost
-        tokens_used = ModelManager().calculate_tokens(request.prompt, request.model_id)
+        # Tokenizing takes the model's tokenizer lock, which a running batch may hold
+        tokens_used = await run_in_threadpool(model_manager.calculate_tokens, request.prompt, request.model_id)
         cost = (tokens_used / 1000) * model.price_per_1k_tokens
         
         # Record usage
-        usage = Usage(
+        record_usage(
+            db,
             api_key_id=key_data.id,
+            customer_id=key_data.customer_id,
             model_id=request.model_id,
             request_type="generate",
             tokens_used=tokens_used,
             response_time=response_time,
             cost=cost
         )
-        db.add(usage)
-        db.commit()
         
         return JSONResponse(
             status_code=200,
@@ -918,6 +838,12 @@ async def generate_text(
                 "cost": cost
             }
         )
+    except ModelBusy:
+        return JSONResponse(
+            status_code=503,
+            content={"error": "Model is busy, please retry shortly"},
+            headers={"Retry-After": "1"}
+        )
     except Exception as e:
         db.rollback()
         return JSONResponse(
@@ -929,14 +855,14 @@ async def generate_text(
 async def query(request: Query, api_key: str = Header(..., alias="X-API-Key"), db: Session = Depends(get_db)):
     try:
         # Validate API key and rate limit
-        key_data = db.query(APIKey).filter_by(key=api_key).first()
+        key_data = api_key_cache.lookup(db, api_key)
         if not key_data or not key_data.is_active:
             return JSONResponse(
                 status_code=401,
                 content={"error": "Invalid or inactive API key"}
             )
         
-        if not rate_limiter.is_allowed(api_key, key_data.rate_limit):
+        if not rate_limiter.is_allowed(str(key_data.id), key_data.rate_limit):
             return JSONResponse(
                 status_code=429,
                 content={"error": "Rate limit exceeded"}
@@ -962,14 +888,16 @@ async def query(request: Query, api_key: str = Header(..., alias="X-API-Key"), d
                 )
 
         # Track usage
-        usage = Usage(
-            api_key=api_key,
+        record_usage(
+            db,
+            api_key_id=key_data.id,
+            customer_id=key_data.customer_id,
+            model_id=None,
             request_type="query",
             tokens_used=len(request.text.split()),  # Approximate
-            response_time=response.elapsed.total_seconds()
+            response_time=response.elapsed.total_seconds(),
+            cost=0.0
         )
-        db.add(usage)
-        db.commit()
 
         return JSONResponse(
             status_code=200,
@@ -990,35 +918,38 @@ async def add_knowledge(
 ):
     """Add documents to the knowledge base"""
     try:
+        key_data = api_key_cache.lookup(db, api_key)
+        if not key_data or not key_data.is_active:
+            return JSONResponse(
+                status_code=401,
+                content={"error": "Invalid or inactive API key"}
+            )
+        
         start_time = time.time()
         
-        with tracer.start_as_current_span("add_knowledge") as span:
-            global vector_store
-            texts = [doc.text for doc in documents]
-            metadatas = [doc.metadata for doc in documents]
-            
-            if vector_store is None:
-                vector_store = Chroma.from_texts(
-                    texts=texts,
-                    embedding=embeddings,
-                    metadatas=metadatas
-                )
-            else:
-                vector_store.add_texts(texts=texts, metadatas=metadatas)
-            
-            # Record usage
-            response_time = time.time() - start_time
-            usage = Usage(
-                api_key=api_key,
-                endpoint="/add-knowledge",
+        texts = [doc.text for doc in documents]
+        metadatas = [doc.metadata for doc in documents]
+        
+        # Embedding is blocking (and loads the vector store stack the first time)
+        await run_in_threadpool(knowledge_base.add_texts, texts, metadatas)
+        
+        # Record usage
+        response_time = time.time() - start_time
+        try:
+            record_usage(
+                db,
+                api_key_id=key_data.id,
+                customer_id=key_data.customer_id,
+                model_id=None,
+                request_type="add-knowledge",
                 tokens_used=sum(len(text.split()) for text in texts),
-                response_time=response_time
+                response_time=response_time,
+                cost=0.0
             )
-            db.add(usage)
-            db.commit()
-            
-            span.set_attribute("documents_added", len(texts))
-            span.set_attribute("response_time", response_time)
+        except Exception as e:
+            # The documents are stored; failing now would only make the client add them again
+            db.rollback()
+            logging.error(f"Error recording knowledge base usage: {str(e)}")
         
         return JSONResponse(
             status_code=200,
@@ -1060,25 +991,26 @@ def get_usage_metrics(
         api_key_ids = [key.id for key in customer.api_keys]
         
         # Query usage data
+        usage_source = partition_manager.usage_source(db, start_date)
         usage_data = db.query(
-            func.sum(Usage.tokens_used).label('total_tokens'),
+            func.sum(usage_source.tokens_used).label('total_tokens'),
             func.count().label('total_requests'),
-            func.avg(Usage.response_time).label('average_latency')
+            func.avg(usage_source.response_time).label('average_latency')
         ).filter(
-            Usage.api_key_id.in_(api_key_ids),
-            Usage.timestamp >= start_date
+            usage_source.api_key_id.in_(api_key_ids),
+            usage_source.timestamp >= start_date
         ).first()
 
         # Get daily usage
         daily_usage = db.query(
-            func.date(Usage.timestamp).label('date'),
-            func.sum(Usage.tokens_used).label('tokens'),
+            func.date(usage_source.timestamp).label('date'),
+            func.sum(usage_source.tokens_used).label('tokens'),
             func.count().label('requests')
         ).filter(
-            Usage.api_key_id.in_(api_key_ids),
-            Usage.timestamp >= start_date
+            usage_source.api_key_id.in_(api_key_ids),
+            usage_source.timestamp >= start_date
         ).group_by(
-            func.date(Usage.timestamp)
+            func.date(usage_source.timestamp)
         ).all()
 
         # Format response
@@ -1120,7 +1052,7 @@ async def create_setup_intent(customer_id: int, db: Session = Depends(get_db)):
         if stripe_customer_id:
             try:
                 # Verify the customer exists in Stripe
-                stripe_customer = stripe.Customer.retrieve(stripe_customer_id)
+                stripe_customer = await stripe_client.Customer.retrieve(stripe_customer_id)
                 if hasattr(stripe_customer, 'deleted') and stripe_customer.deleted:
                     # Customer was deleted in Stripe, create a new one
                     stripe_customer_id = None
@@ -1131,7 +1063,7 @@ async def create_setup_intent(customer_id: int, db: Session = Depends(get_db)):
         # Create new Stripe customer if needed
         if not stripe_customer_id:
             logging.info(f"Creating new Stripe customer for {customer.name}")
-            stripe_customer = stripe.Customer.create(
+            stripe_customer = await stripe_client.Customer.create(
                 name=customer.name,
                 email=customer.email,
                 description=f"Customer ID: {customer.id}"
@@ -1144,7 +1076,7 @@ async def create_setup_intent(customer_id: int, db: Session = Depends(get_db)):
             logging.info(f"Updated customer {customer.id} with new Stripe ID: {stripe_customer_id}")
         
         # Create setup intent using Stripe customer ID
-        setup_intent = stripe.SetupIntent.create(
+        setup_intent = await stripe_client.SetupIntent.create(
             customer=stripe_customer_id,
             payment_method_types=['card'],
             usage='off_session'  # Allow future off-session payments
@@ -1165,7 +1097,7 @@ async def create_setup_intent_no_customer():
         stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
         
         # Create setup intent without customer
-        setup_intent = stripe.SetupIntent.create(
+        setup_intent = await stripe_client.SetupIntent.create(
             payment_method_types=['card']
         )
         
@@ -1184,7 +1116,7 @@ async def create_setup_intent_simple():
         stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
         
         # Create setup intent with minimal configuration
-        setup_intent = stripe.SetupIntent.create(
+        setup_intent = await stripe_client.SetupIntent.create(
             payment_method_types=['card'],
             usage='off_session'
         )
@@ -1275,7 +1207,7 @@ async def attach_payment_method(
 
         try:
             # Attach payment method in Stripe
-            payment_method = stripe.PaymentMethod.attach(
+            payment_method = await stripe_client.PaymentMethod.attach(
                 payment_method_id,
                 customer=customer.stripe_customer_id,
             )
@@ -1365,7 +1297,7 @@ async def create_payment_intent(amount: dict):
         amount_cents = int(amount["amount"] * 100)
         logging.info(f"Converting ${amount['amount']} to {amount_cents} cents")
         
-        intent = stripe.PaymentIntent.create(
+        intent = await stripe_client.PaymentIntent.create(
             amount=amount_cents,
             currency="usd",
             metadata={"integration_check": "accept_a_payment"}
@@ -1402,11 +1334,13 @@ async def stripe_webhook(request: Request):
             logging.error("Invalid signature")
             raise HTTPException(status_code=400, detail="Invalid signature")
         
-        if event["type"] == "payment_intent.succeeded":
-            payment_intent = event["data"]["object"]
-            logging.info(f"Payment succeeded! Amount: ${payment_intent.amount/100:.2f} USD")
-            logging.info(f"Payment ID: {payment_intent.id}")
-            logging.info(f"Customer: {payment_intent.customer}")
+        # Store the event and acknowledge it; the webhook inbox worker applies it
+        db = SessionLocal()
+        try:
+            if webhook_inbox.receive(db, json.loads(payload)):
+                webhook_inbox.notify()
+        finally:
+            db.close()
         
         return {"status": "success"}
     except Exception as e:
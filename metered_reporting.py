@@ -0,0 +1,277 @@
+import os
+import sys
+import time
+import calendar
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+from typing import Dict, Any, Optional
+
+import stripe
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from database import SessionLocal, Customer, CostLedgerEntry, MeteredSubscriptionItem, MeteredUsageReport, MeteredUsageWatermark
+from cost_ledger import LEDGER_BUCKET, bucket_floor
+from billing_run import with_stripe_retries
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# What one unit of the metered price counts: tokens, requests or cents
+METERED_USAGE_UNIT = os.getenv("METERED_USAGE_UNIT", "tokens")
+# Seconds between reporting cycles when running as a worker
+METERED_REPORT_INTERVAL_SECONDS = float(os.getenv("METERED_REPORT_INTERVAL_SECONDS", "300"))
+# A ledger bucket is reported once it has been closed for this long
+METERED_REPORT_LAG_SECONDS = float(os.getenv("METERED_REPORT_LAG_SECONDS", "120"))
+# Usage records sent per batch, and Stripe calls in flight within a batch
+METERED_REPORT_BATCH_SIZE = int(os.getenv("METERED_REPORT_BATCH_SIZE", "200"))
+METERED_REPORT_CONCURRENCY = int(os.getenv("METERED_REPORT_CONCURRENCY", "8"))
+# Reports are given up on (left as failed) after this many cycles
+METERED_REPORT_MAX_ATTEMPTS = int(os.getenv("METERED_REPORT_MAX_ATTEMPTS", "10"))
+
+# Point the Stripe client at a local stand-in such as stripe-mock
+if os.getenv("STRIPE_API_BASE"):
+    stripe.api_base = os.getenv("STRIPE_API_BASE")
+
+# Subscription states in which usage is still billed
+ACTIVE_SUBSCRIPTION_STATUSES = ("active", "trialing", "past_due")
+
+WATERMARK_NAME = "stripe"
+
+
+def _quantity(entry: CostLedgerEntry, unit: str) -> int:
+    if unit == "requests":
+        return int(entry.request_count or 0)
+    if unit == "cents":
+        return int(round((entry.cost or 0.0) * 100))
+    return int(entry.tokens_used or 0)
+
+
+def _unix(timestamp: datetime) -> int:
+    # Ledger timestamps are naive UTC
+    return calendar.timegm(timestamp.utctimetuple())
+
+
+class MeteredUsageReporter:
+    """
+    Reports usage to Stripe metered prices from the cost ledger.
+
+    Each cycle queues every closed ledger bucket past the high-water mark as
+    one MeteredUsageReport per subscription item and bucket, advancing the
+    mark in the same transaction. Queued reports are then sent in batches
+    with bounded concurrency. Records use action="set" at the bucket's
+    start time with an idempotency key per item and bucket, so resending a
+    report (after a crash or a retry) never double-counts usage.
+    """
+
+    def __init__(
+        self,
+        unit: str = METERED_USAGE_UNIT,
+        batch_size: int = METERED_REPORT_BATCH_SIZE,
+        concurrency: int = METERED_REPORT_CONCURRENCY,
+        lag_seconds: float = METERED_REPORT_LAG_SECONDS
+    ):
+        self.unit = unit
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.lag = timedelta(seconds=lag_seconds)
+
+    def sync_subscription(self, db: Session, subscription: Dict[str, Any]) -> Optional[MeteredSubscriptionItem]:
+        """Record the metered item of a Stripe subscription (from a customer.subscription.* event); the caller commits"""
+        customer = db.query(Customer).filter(Customer.stripe_customer_id == subscription.get("customer")).first()
+        if customer is None:
+            logger.warning(f"No customer for Stripe ID {subscription.get('customer')}; ignoring subscription {subscription.get('id')}")
+            return None
+
+        metered_item_id = None
+        for item in (subscription.get("items") or {}).get("data", []):
+            recurring = (item.get("price") or {}).get("recurring") or {}
+            if recurring.get("usage_type") == "metered":
+                metered_item_id = item["id"]
+                break
+
+        record = db.query(MeteredSubscriptionItem).filter_by(customer_id=customer.id).first()
+        active = metered_item_id is not None and subscription.get("status") in ACTIVE_SUBSCRIPTION_STATUSES
+        if record is None:
+            if not active:
+                return None
+            record = MeteredSubscriptionItem(customer_id=customer.id)
+            db.add(record)
+        elif not active and record.stripe_subscription_id != subscription.get("id"):
+            # An unrelated subscription of the customer ended
+            return record
+
+        record.active = active
+        if metered_item_id is not None:
+            if record.stripe_subscription_item_id != metered_item_id:
+                # Reporting for a new item starts with its first full bucket
+                record.created_at = datetime.utcnow()
+            record.stripe_subscription_id = subscription["id"]
+            record.stripe_subscription_item_id = metered_item_id
+        db.flush()
+        logger.info(f"Metered item for customer {customer.id}: {record.stripe_subscription_item_id} (active: {record.active})")
+        return record
+
+    def enqueue(self, db: Session, now: Optional[datetime] = None) -> int:
+        """Queue reports for every ledger bucket closed since the high-water mark"""
+        cutoff = bucket_floor((now or datetime.utcnow()) - self.lag)
+        watermark = db.query(MeteredUsageWatermark).filter_by(name=WATERMARK_NAME).with_for_update().first()
+        if watermark is None:
+            watermark = MeteredUsageWatermark(name=WATERMARK_NAME)
+            db.add(watermark)
+        if watermark.queued_until is not None and watermark.queued_until >= cutoff:
+            db.rollback()
+            return 0
+
+        query = db.query(CostLedgerEntry, MeteredSubscriptionItem).join(
+            MeteredSubscriptionItem, CostLedgerEntry.customer_id == MeteredSubscriptionItem.customer_id
+        ).filter(
+            MeteredSubscriptionItem.active.is_(True),
+            CostLedgerEntry.bucket_start < cutoff
+        )
+        if watermark.queued_until is not None:
+            query = query.filter(CostLedgerEntry.bucket_start >= watermark.queued_until)
+
+        queued = 0
+        for entry, item in query.all():
+            # Buckets from before the item existed belong to another billing arrangement
+            if entry.bucket_start < bucket_floor(item.created_at):
+                continue
+            quantity = _quantity(entry, self.unit)
+            if quantity <= 0:
+                continue
+            db.add(MeteredUsageReport(
+                stripe_subscription_item_id=item.stripe_subscription_item_id,
+                customer_id=entry.customer_id,
+                bucket_start=entry.bucket_start,
+                quantity=quantity,
+                status="pending"
+            ))
+            queued += 1
+
+        watermark.queued_until = cutoff
+        try:
+            db.commit()
+        except IntegrityError:
+            # Another reporter queued the same buckets first
+            db.rollback()
+            return 0
+        if queued:
+            logger.info(f"Queued {queued} metered usage reports up to {cutoff}")
+        return queued
+
+    def _send(self, report_id: int, item_id: str, bucket_start: datetime, quantity: int) -> int:
+        """Send one usage record; runs on a worker thread"""
+        timestamp = _unix(bucket_start)
+        with_stripe_retries(
+            stripe.SubscriptionItem.create_usage_record,
+            item_id,
+            quantity=quantity,
+            timestamp=timestamp,
+            action="set",
+            idempotency_key=f"metered-{item_id}-{timestamp}"
+        )
+        return report_id
+
+    def send_pending(self, db: Session) -> Dict[str, int]:
+        """Send queued reports in batches; returns how many were reported and how many failed"""
+        # Failed reports get one more try per cycle until they run out of attempts
+        db.query(MeteredUsageReport).filter(
+            MeteredUsageReport.status == "failed",
+            MeteredUsageReport.attempts < METERED_REPORT_MAX_ATTEMPTS
+        ).update({"status": "pending"}, synchronize_session=False)
+        db.commit()
+
+        reported = failed = 0
+        with ThreadPoolExecutor(max_workers=max(1, self.concurrency)) as pool:
+            while True:
+                batch = db.query(MeteredUsageReport).filter(
+                    MeteredUsageReport.status == "pending"
+                ).order_by(
+                    MeteredUsageReport.bucket_start, MeteredUsageReport.id
+                ).limit(self.batch_size).all()
+                if not batch:
+                    break
+
+                futures = {
+                    pool.submit(self._send, report.id, report.stripe_subscription_item_id, report.bucket_start, report.quantity): report
+                    for report in batch
+                }
+                for future in as_completed(futures):
+                    report = futures[future]
+                    report.attempts = (report.attempts or 0) + 1
+                    try:
+                        future.result()
+                    except Exception as e:
+                        logger.error(f"Reporting usage for {report.stripe_subscription_item_id} at {report.bucket_start} failed: {str(e)}")
+                        report.status = "failed"
+                        report.error = str(e)[:500]
+                        failed += 1
+                    else:
+                        report.status = "reported"
+                        report.error = None
+                        report.reported_at = datetime.utcnow()
+                        reported += 1
+                # One commit per batch checkpoints it
+                db.commit()
+        return {"reported": reported, "failed": failed}
+
+    def run_once(self, now: Optional[datetime] = None) -> Dict[str, Any]:
+        """One reporting cycle: queue newly closed buckets, then send everything pending"""
+        if not stripe.api_key or stripe.api_key == "sk_test_example":
+            logger.warning("Stripe is not configured; skipping metered usage reporting")
+            return {"queued": 0, "reported": 0, "failed": 0}
+        db = SessionLocal()
+        try:
+            started = time.monotonic()
+            queued = self.enqueue(db, now)
+            result = dict(self.send_pending(db), queued=queued)
+            result["seconds"] = round(time.monotonic() - started, 3)
+            if result["reported"] or result["failed"]:
+                logger.info(f"Metered usage cycle: {result}")
+            return result
+        except Exception as e:
+            db.rollback()
+            logger.error(f"Error reporting metered usage: {str(e)}")
+            raise
+        finally:
+            db.close()
+
+    def sync_all(self):
+        """Load the metered items of every subscription from Stripe (initial setup)"""
+        db = SessionLocal()
+        try:
+            count = 0
+            for subscription in stripe.Subscription.list(status="all", limit=100).auto_paging_iter():
+                if self.sync_subscription(db, subscription) is not None:
+                    count += 1
+                db.commit()
+            logger.info(f"Synced {count} subscriptions with metered items")
+        finally:
+            db.close()
+
+    def run_forever(self, interval: float = METERED_REPORT_INTERVAL_SECONDS):
+        logger.info(f"Reporting metered usage ({self.unit}) every {interval:.0f}s")
+        while True:
+            try:
+                self.run_once()
+            except Exception:
+                # Already logged; the next cycle retries from the checkpoints
+                pass
+            time.sleep(interval)
+
+
+# Create global metered usage reporter instance
+metered_reporter = MeteredUsageReporter()
+
+
+if __name__ == "__main__":
+    # Usage: python metered_reporting.py [once|sync]  (runs as a worker by default)
+    command = sys.argv[1] if len(sys.argv) > 1 else "run"
+    if command == "once":
+        logger.info(f"Metered usage cycle result: {metered_reporter.run_once()}")
+    elif command == "sync":
+        metered_reporter.sync_all()
+    else:
+        metered_reporter.run_forever()
@@ -6,6 +6,21 @@ from pathlib import Path
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+def add_pagination_indexes():
+    """Create the (api_key_id, timestamp, id) indexes used for keyset pagination on existing usage tables"""
+    from sqlalchemy import inspect
+    from database import engine, Usage, UsageRecord
+    
+    with engine.begin() as conn:
+        tables = set(inspect(conn).get_table_names())
+        for model in (Usage, UsageRecord):
+            if model.__tablename__ not in tables:
+                continue
+            for index in model.__table__.indexes:
+                if index.name.endswith("_api_key_timestamp"):
+                    logger.info(f"Ensuring index {index.name} exists on {model.__tablename__}")
+                    index.create(bind=conn, checkfirst=True)
+
 def migrate_database():
     """Update the database schema to add missing columns"""
     try:
@@ -52,6 +67,9 @@ def migrate_database():
         
         # Close the connection
         conn.close()
+        
+        # Composite indexes used for keyset pagination of usage on (timestamp, id)
+        add_pagination_indexes()
         logger.info("Database migration completed successfully")
         
     except Exception as e:
@@ -1,8 +1,12 @@
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple
+from collections import deque
+from concurrent.futures import Future
 from sqlalchemy.orm import Session
 from database import AIModel, SessionLocal
-import torch
-from transformers import AutoModel, AutoTokenizer, AutoModelForCausalLM
+from lazy_imports import LazyModule
+import os
+import time
+import threading
 import logging
 import json
 import asyncio
@@ -10,11 +14,182 @@ import asyncio
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Imported (with torch) on first use of a local model, so workers that only proxy remote providers never load it
+transformers = LazyModule("transformers")
+torch = LazyModule("torch")
+
+# Most prompts one generate() call runs together
+MODEL_BATCH_MAX_SIZE = int(os.getenv("MODEL_BATCH_MAX_SIZE", "8"))
+# How long the first request of a batch waits for others to join it
+MODEL_BATCH_WINDOW_MS = float(os.getenv("MODEL_BATCH_WINDOW_MS", "10"))
+# Requests waiting per model beyond this are rejected at once instead of queueing
+MODEL_BATCH_MAX_PENDING = int(os.getenv("MODEL_BATCH_MAX_PENDING", "256"))
+
+
+class ModelBusy(Exception):
+    """Raised when too many generations are already waiting for a model"""
+
+
+class _GenerationRequest:
+    __slots__ = ("prompt", "max_length", "options", "future")
+
+    def __init__(self, prompt: str, max_length: int, options: Tuple):
+        self.prompt = prompt
+        self.max_length = max_length
+        self.options = options
+        self.future = Future()
+
+
+class ModelBatcher:
+    """
+    Dynamic micro-batching for one local Hugging Face model.
+
+    Callers block on submit(); a worker thread collects the requests that
+    arrive within MODEL_BATCH_WINDOW_MS of the first (up to
+    MODEL_BATCH_MAX_SIZE), left-pads them into one tensor and runs a single
+    generate() for all of them. Only requests with the same sampling
+    options share a batch. Each request keeps its own max_length (prompt
+    plus new tokens): the batch generates for the largest budget and every
+    output is cut to its own.
+    """
+
+    def __init__(self, model_id: int, model, tokenizer, tokenizer_lock: threading.Lock,
+                 max_batch_size: int = MODEL_BATCH_MAX_SIZE, window_ms: float = MODEL_BATCH_WINDOW_MS,
+                 max_pending: int = MODEL_BATCH_MAX_PENDING):
+        self.model_id = model_id
+        self.model = model
+        self.tokenizer = tokenizer
+        self.tokenizer_lock = tokenizer_lock
+        self.max_batch_size = max_batch_size
+        self.window = window_ms / 1000
+        self.max_pending = max_pending
+        self.batches = 0
+        self.requests = 0
+        self.generate_seconds = 0.0
+        self._pending: deque = deque()
+        self._condition = threading.Condition()
+        self._stopped = False
+        # Decoder-only models continue from the right, so padding goes on the left
+        self.tokenizer.padding_side = "left"
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        # Started by the first submit()
+        self._thread: Optional[threading.Thread] = None
+
+    def submit(self, prompt: str, max_length: int, **options) -> str:
+        """Generate for one prompt as part of the next batch (blocking)"""
+        request = _GenerationRequest(prompt, max_length, tuple(sorted(options.items())))
+        with self._condition:
+            if self._stopped:
+                raise RuntimeError(f"Model {self.model_id} was unloaded")
+            if len(self._pending) >= self.max_pending:
+                raise ModelBusy(f"{len(self._pending)} generations pending for model {self.model_id}")
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=f"model-batcher-{self.model_id}", daemon=True)
+                self._thread.start()
+            self._pending.append(request)
+            self._condition.notify()
+        return request.future.result()
+
+    def _next_batch(self) -> List[_GenerationRequest]:
+        with self._condition:
+            while not self._pending and not self._stopped:
+                self._condition.wait()
+            if self._stopped:
+                return []
+            first = self._pending.popleft()
+            batch = [first]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch_size:
+                # Take compatible requests already queued; leave the others in order for later batches
+                for request in list(self._pending):
+                    if request.options == first.options:
+                        self._pending.remove(request)
+                        batch.append(request)
+                        if len(batch) >= self.max_batch_size:
+                            break
+                remaining = deadline - time.monotonic()
+                if len(batch) >= self.max_batch_size or remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            return batch
+
+    def _generate(self, batch: List[_GenerationRequest]) -> List[str]:
+        with self.tokenizer_lock:
+            inputs = self.tokenizer([request.prompt for request in batch], return_tensors="pt", padding=True, truncation=True)
+        prompt_lengths = inputs["attention_mask"].sum(dim=1).tolist()
+        budgets = [max(0, request.max_length - length) for request, length in zip(batch, prompt_lengths)]
+        input_length = inputs["input_ids"].shape[1]
+
+        outputs = None
+        if max(budgets) > 0:
+            with torch.inference_mode():
+                outputs = self.model.generate(
+                    inputs["input_ids"],
+                    attention_mask=inputs["attention_mask"],
+                    max_new_tokens=max(budgets),
+                    pad_token_id=self.tokenizer.pad_token_id,
+                    **dict(batch[0].options)
+                )
+
+        responses = []
+        with self.tokenizer_lock:
+            for index, budget in enumerate(budgets):
+                if outputs is None or budget == 0:
+                    responses.append("")
+                    continue
+                new_tokens = outputs[index][input_length:input_length + budget]
+                responses.append(self.tokenizer.decode(new_tokens, skip_special_tokens=True).strip())
+        return responses
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if not batch:
+                return
+            started = time.monotonic()
+            try:
+                responses = self._generate(batch)
+            except Exception as e:
+                logger.error(f"Batched generation failed for model {self.model_id} ({len(batch)} prompts): {str(e)}")
+                for request in batch:
+                    request.future.set_exception(e)
+                continue
+            self.batches += 1
+            self.requests += len(batch)
+            self.generate_seconds += time.monotonic() - started
+            for request, response in zip(batch, responses):
+                request.future.set_result(response)
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            pending = list(self._pending)
+            self._pending.clear()
+            self._condition.notify_all()
+        for request in pending:
+            request.future.set_exception(RuntimeError(f"Model {self.model_id} was unloaded"))
+
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            "batches": self.batches,
+            "requests": self.requests,
+            "avg_batch_size": round(self.requests / self.batches, 2) if self.batches else None,
+            "avg_generate_ms": round(self.generate_seconds / self.batches * 1000, 1) if self.batches else None,
+            "pending": len(self._pending)
+        }
+
 class ModelManager:
+    """Local models, loaded on first use of each (or all at once with load_models)"""
+
     def __init__(self):
         self.models = {}
         self.tokenizers = {}
+        self.batchers: Dict[int, ModelBatcher] = {}
+        # Fast tokenizers must not be used from two threads at once
+        self._tokenizer_locks: Dict[int, threading.Lock] = {}
         self.logger = logging.getLogger(__name__)
+        self._load_lock = threading.Lock()
 
     async def load_models(self):
         """Load all models from the database"""
@@ -45,6 +220,18 @@ class ModelManager:
 
     async def load_model(self, model_id: int):
         """Load a specific model"""
+        self.load_model_sync(model_id)
+
+    def ensure_loaded(self, model_id: int):
+        """Load a model unless it already is; concurrent callers wait for the same load"""
+        if model_id in self.models:
+            return
+        with self._load_lock:
+            if model_id not in self.models:
+                self.load_model_sync(model_id)
+
+    def load_model_sync(self, model_id: int):
+        """Load a specific model (blocking; imports transformers the first time)"""
         db = SessionLocal()
         try:
             model = db.query(AIModel).filter_by(id=model_id).first()
@@ -54,24 +241,26 @@ class ModelManager:
             self.logger.info(f"Loading model {model_id} from {model.model_type}")
             
             if model.model_type == "huggingface":
-                from transformers import AutoModelForCausalLM, AutoTokenizer
-                
                 self.logger.info(f"Loading model {model.model_name}")
-                tokenizer = AutoTokenizer.from_pretrained(model.model_name)
-                model_instance = AutoModelForCausalLM.from_pretrained(model.model_name)
+                tokenizer = transformers.AutoTokenizer.from_pretrained(model.model_name)
+                model_instance = transformers.AutoModelForCausalLM.from_pretrained(model.model_name)
                 
-                self.models[model_id] = model_instance
+                # Tokenizer and batcher first: ensure_loaded() only checks self.models
+                model_instance.eval()
+                self._tokenizer_locks[model_id] = threading.Lock()
                 self.tokenizers[model_id] = tokenizer
+                self.batchers[model_id] = ModelBatcher(model_id, model_instance, tokenizer, self._tokenizer_locks[model_id])
+                self.models[model_id] = model_instance
                 
                 self.logger.info(f"Successfully loaded model {model_id}")
             elif model.model_type == "custom":
                 # For custom models, we'll just store the config
                 self.logger.info(f"Setting up custom model {model.name}")
-                self.models[model_id] = model.config
                 
                 # Use a basic tokenizer for custom models
-                from transformers import AutoTokenizer
-                self.tokenizers[model_id] = AutoTokenizer.from_pretrained("gpt2")
+                self._tokenizer_locks[model_id] = threading.Lock()
+                self.tokenizers[model_id] = transformers.AutoTokenizer.from_pretrained("gpt2")
+                self.models[model_id] = model.config
                 
                 self.logger.info(f"Successfully set up custom model {model_id}")
             else:
@@ -85,8 +274,12 @@ class ModelManager:
 
     async def unload_models(self):
         """Unload all models"""
-        self.models.clear()
-        self.tokenizers.clear()
+        with self._load_lock:
+            for batcher in self.batchers.values():
+                batcher.stop()
+            self.batchers.clear()
+            self.models.clear()
+            self.tokenizers.clear()
 
     def add_model(self, model_name: str, model_type: str, price_per_1k_tokens: float) -> AIModel:
         """Add a new model to the database"""
@@ -118,43 +311,41 @@ class ModelManager:
 
     def generate_response(self, prompt: str, model_id: int, max_length: int = 100,
                          temperature: float = 0.7, top_p: float = 0.9, top_k: int = 50) -> str:
-        """Generate a response using the specified model"""
-        if model_id not in self.models:
-            raise ValueError(f"Model {model_id} not loaded")
+        """Generate a response using the specified model (loading it first if needed)"""
+        self.ensure_loaded(model_id)
 
         model = self.models[model_id]
-        tokenizer = self.tokenizers[model_id]
 
         if isinstance(model, dict):  # Custom model
             # Handle custom model generation
             # This is a placeholder - implement your custom model logic here
             return f"Response from custom model: {prompt}"
-        else:  # Huggingface model
-            inputs = tokenizer(prompt, return_tensors="pt", padding=True, truncation=True)
-            
-            outputs = model.generate(
-                inputs["input_ids"],
-                max_length=max_length,
+        else:  # Huggingface model, batched with concurrent requests
+            return self.batchers[model_id].submit(
+                prompt,
+                max_length,
                 temperature=temperature,
                 top_p=top_p,
-                top_k=top_k,
-                pad_token_id=tokenizer.eos_token_id
+                top_k=top_k
             )
-            
-            response = tokenizer.decode(outputs[0], skip_special_tokens=True)
-            return response[len(prompt):].strip()
+
+    def batch_metrics(self) -> Dict[int, Dict[str, Any]]:
+        """Batches run, average batch size and generate time per local model"""
+        return {model_id: batcher.metrics() for model_id, batcher in self.batchers.items()}
 
     def calculate_tokens(self, text: str, model_id: int) -> int:
         """Calculate the number of tokens in the text"""
-        if model_id not in self.tokenizers:
-            raise ValueError(f"Tokenizer for model {model_id} not loaded")
+        self.ensure_loaded(model_id)
 
         tokenizer = self.tokenizers[model_id]
-        tokens = tokenizer(text)["input_ids"]
+        with self._tokenizer_locks[model_id]:
+            tokens = tokenizer(text)["input_ids"]
         return len(tokens)
 
+# Create global model manager instance
+model_manager = ModelManager()
+
 async def main():
-    model_manager = ModelManager()
     await model_manager.load_models()
 
 if __name__ == "__main__":
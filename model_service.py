@@ -1,13 +1,16 @@
 import os
 import json
 import logging
-import httpx
 import asyncio
 from typing import Dict, List, Any, Optional, Union
 from sqlalchemy.orm import Session
 
 from database import AIModel, get_db
 from settings import MODEL_PROVIDERS
+from lazy_imports import LazyModule
+
+# Only used to proxy requests to remote providers
+httpx = LazyModule("httpx")
 
 logger = logging.getLogger(__name__)
 
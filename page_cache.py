@@ -0,0 +1,143 @@
+import os
+import time
+import hashlib
+import threading
+import logging
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+from markupsafe import Markup
+from starlette.requests import Request
+from starlette.responses import HTMLResponse, Response
+
+from database import User
+from templating import templates
+
+logger = logging.getLogger(__name__)
+
+# Rendered pages and fragments are served from memory for at most this long
+PAGE_CACHE_TTL_SECONDS = float(os.getenv("PAGE_CACHE_TTL_SECONDS", "300"))
+# Upper bound on cached pages and fragments; the least recently used are dropped first
+PAGE_CACHE_MAX_ENTRIES = int(os.getenv("PAGE_CACHE_MAX_ENTRIES", "2000"))
+
+
+class PageCache:
+    """
+    Rendered HTML of public pages, keyed by path and viewer.
+
+    Anonymous visitors share one copy of each page; a signed-in user, whose
+    name and role appear in the navigation, gets their own. Every page has
+    a strong ETag, so a browser revalidating it gets a 304 without a body.
+    Entries expire after PAGE_CACHE_TTL_SECONDS or when purged. Fragments,
+    such as the pricing table, are cached under their own keys and shared
+    by every page and viewer.
+    """
+
+    def __init__(self, ttl_seconds: float = PAGE_CACHE_TTL_SECONDS, max_entries: int = PAGE_CACHE_MAX_ENTRIES):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Tuple, Tuple[float, Any]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _get(self, key: Tuple) -> Optional[Any]:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= now:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def _put(self, key: Tuple, value: Any):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    @staticmethod
+    def _viewer(user: Optional[User]) -> Hashable:
+        # Name and role are part of the key, so an account change never shows a stale header
+        if not user:
+            return None
+        return user.id, user.username, user.role
+
+    @staticmethod
+    def _not_modified(request: Request, etag: str) -> bool:
+        if_none_match = request.headers.get("if-none-match")
+        if not if_none_match:
+            return False
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+    async def render(
+        self,
+        request: Request,
+        name: str,
+        user: Optional[User] = None,
+        context: Optional[Callable[[], Awaitable[Dict[str, Any]]]] = None,
+        version: Hashable = None
+    ) -> Response:
+        """
+        The page rendered from a template, from memory when possible.
+
+        context is only awaited on a miss, so data needed just for rendering
+        is not loaded for cached pages. version is part of the key; pass the
+        version of any data the page shows (such as the Stripe catalog).
+        """
+        key = ("page", request.url.path, self._viewer(user), version)
+        page = self._get(key)
+        if page is None:
+            values = {"request": request, "user": user, "current_user": user}
+            if context is not None:
+                values.update(await context())
+            body = templates.get_template(name).render(values).encode("utf-8")
+            page = (body, f'"{hashlib.sha256(body).hexdigest()[:32]}"')
+            self._put(key, page)
+
+        body, etag = page
+        headers = {
+            "ETag": etag,
+            # Browsers keep the page but check the ETag before reusing it
+            "Cache-Control": "private, no-cache" if user else "no-cache"
+        }
+        if self._not_modified(request, etag):
+            return Response(status_code=304, headers=headers)
+        return HTMLResponse(body, headers=headers)
+
+    def fragment(self, name: str, render: Callable[[], str], version: Hashable = None) -> Markup:
+        """A rendered piece of a page, shared by all viewers until it expires or its version changes"""
+        key = ("fragment", name, version)
+        html = self._get(key)
+        if html is None:
+            html = Markup(render())
+            self._put(key, html)
+        return html
+
+    def purge(self, path: Optional[str] = None) -> int:
+        """Drop the cached copies of a page (every page and fragment if no path is given)"""
+        with self._lock:
+            if path is None:
+                purged = len(self._entries)
+                self._entries.clear()
+            else:
+                keys = [key for key in self._entries if key[0] == "page" and key[1] == path]
+                for key in keys:
+                    del self._entries[key]
+                purged = len(keys)
+        logger.info(f"Purged {purged} cached pages{f' for {path}' if path else ''}")
+        return purged
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+# Create global page cache instance
+page_cache = PageCache()
@@ -0,0 +1,276 @@
+import os
+import sys
+import glob
+import hashlib
+import logging
+from datetime import datetime
+from typing import Dict, Any, List, Optional, Tuple
+
+from sqlalchemy import func
+
+from database import SessionLocal, Usage, UsageRecord, APIKey, User, ExportWatermark
+from usage_partitions import partition_manager
+from usage_export import after_position, position_order
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Root directory for partitioned Parquet exports
+PARQUET_EXPORT_DIR = os.getenv("PARQUET_EXPORT_DIR", "exports/parquet")
+# Rows read and written out per chunk; the watermark advances once per chunk
+PARQUET_CHUNK_SIZE = int(os.getenv("PARQUET_CHUNK_SIZE", "50000"))
+# Hive convention for rows whose partition value is NULL
+NULL_PARTITION = "__HIVE_DEFAULT_PARTITION__"
+
+# Columns written to the Parquet files for each source. The day and
+# customer_id are encoded in the partition path rather than the file.
+PARQUET_COLUMNS = {
+    "usage": (
+        ("id", "int64"),
+        ("timestamp", "timestamp"),
+        ("api_key_id", "int64"),
+        ("model_id", "int64"),
+        ("request_type", "string"),
+        ("tokens_used", "int64"),
+        ("response_time", "float64"),
+        ("cost", "float64")
+    ),
+    "records": (
+        ("id", "int64"),
+        ("timestamp", "timestamp"),
+        ("api_key_id", "int64"),
+        ("user_id", "int64"),
+        ("service", "string"),
+        ("request_count", "int64"),
+        ("cost", "float64")
+    )
+}
+
+
+def _import_pyarrow():
+    """Import pyarrow lazily so the app does not need it unless exporting"""
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise RuntimeError("Parquet export requires pyarrow (pip install pyarrow)")
+    return pyarrow, pyarrow.parquet
+
+
+def _arrow_schema(pa, source: str):
+    types = {
+        "int64": pa.int64(),
+        "float64": pa.float64(),
+        "string": pa.string(),
+        "timestamp": pa.timestamp("us")
+    }
+    return pa.schema([(name, types[kind]) for name, kind in PARQUET_COLUMNS[source]])
+
+
+def watermark_name(source: str, start: Optional[datetime], end: Optional[datetime]) -> str:
+    """Name of the watermark tracking an export of one source and time range"""
+    start_key = start.isoformat() if start else "-"
+    end_key = end.isoformat() if end else "-"
+    return f"parquet:{source}:{start_key}:{end_key}"
+
+
+def _export_query(db, source: str, start, end, after: Optional[Tuple[datetime, int]]):
+    """Rows of a source with their customer, ordered by (timestamp, id) with rows without a timestamp last"""
+    if source == "usage":
+        model = partition_manager.usage_source(db, start, end)
+        columns = [getattr(model, name) for name, _ in PARQUET_COLUMNS["usage"]]
+        query = db.query(*columns, APIKey.customer_id.label("customer_id")).outerjoin(
+            APIKey, model.api_key_id == APIKey.id
+        )
+    elif source == "records":
+        model = UsageRecord
+        columns = [getattr(UsageRecord, name) for name, _ in PARQUET_COLUMNS["records"]]
+        # Records without an API key are attributed through the user
+        query = db.query(
+            *columns,
+            func.coalesce(APIKey.customer_id, User.customer_id).label("customer_id")
+        ).outerjoin(
+            APIKey, UsageRecord.api_key_id == APIKey.id
+        ).outerjoin(
+            User, UsageRecord.user_id == User.id
+        )
+    else:
+        raise ValueError(f"Unknown usage source: {source}")
+
+    if start is not None:
+        query = query.filter(model.timestamp >= start)
+    if end is not None:
+        query = query.filter(model.timestamp < end)
+    if after is not None:
+        query = query.filter(after_position(model, *after))
+
+    return query.order_by(*position_order(model))
+
+
+def _partition_dir(output_dir: str, source: str, day: Optional[str], customer_id) -> str:
+    return os.path.join(
+        output_dir,
+        source,
+        f"day={day or NULL_PARTITION}",
+        f"customer_id={customer_id if customer_id is not None else NULL_PARTITION}"
+    )
+
+
+def _part_name(name: str, chunk_index) -> str:
+    # Files are prefixed per export so different time ranges can share a directory
+    job_key = hashlib.sha1(name.encode()).hexdigest()[:10]
+    return f"part-{job_key}-{chunk_index}.parquet"
+
+
+def _remove_chunk_files(output_dir: str, source: str, name: str, chunk_index: str):
+    """Delete an export's files for a chunk index (or "*" for every chunk)"""
+    pattern = os.path.join(output_dir, source, "day=*", "customer_id=*", _part_name(name, chunk_index))
+    for path in glob.glob(pattern):
+        logger.info(f"Removing export file {path}")
+        os.remove(path)
+
+
+def _write_chunk(pa, pq, schema, rows: List[Any], output_dir: str, source: str, name: str, chunk_index: int) -> int:
+    """Write one chunk of rows as one record batch per (day, customer) partition"""
+    names = [column for column, _ in PARQUET_COLUMNS[source]]
+    partitions: Dict[Tuple[Optional[str], Any], Dict[str, list]] = {}
+
+    for row in rows:
+        day = row.timestamp.strftime("%Y-%m-%d") if row.timestamp else None
+        columns = partitions.get((day, row.customer_id))
+        if columns is None:
+            columns = partitions[(day, row.customer_id)] = {column: [] for column in names}
+        for column in names:
+            columns[column].append(getattr(row, column))
+
+    for (day, customer_id), columns in partitions.items():
+        directory = _partition_dir(output_dir, source, day, customer_id)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, _part_name(name, f"{chunk_index:06d}"))
+        batch = pa.RecordBatch.from_pydict(columns, schema=schema)
+
+        # Write to a temporary name first so readers never see a partial file
+        temp_path = path + ".tmp"
+        pq.write_table(pa.Table.from_batches([batch], schema=schema), temp_path, compression="snappy")
+        os.replace(temp_path, path)
+
+    return len(partitions)
+
+
+def export_usage_parquet(
+    source: str = "usage",
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    output_dir: str = PARQUET_EXPORT_DIR,
+    resume: bool = True,
+    chunk_size: int = PARQUET_CHUNK_SIZE
+) -> Dict[str, Any]:
+    """
+    Export a source ("usage" or "records") to Parquet partitioned by day and customer.
+
+    Rows are read in (timestamp, id) order, one server-side cursor per chunk,
+    and each chunk is written as Arrow record batches. After each chunk the
+    position is saved to an ExportWatermark, so an interrupted export picks
+    up where it stopped when run again with resume=True.
+    """
+    if source not in PARQUET_COLUMNS:
+        raise ValueError(f"Unknown usage source: {source}")
+    pa, pq = _import_pyarrow()
+    schema = _arrow_schema(pa, source)
+    name = watermark_name(source, start, end)
+
+    db = SessionLocal()
+    try:
+        watermark = db.query(ExportWatermark).filter(ExportWatermark.name == name).first()
+        if watermark is None:
+            watermark = ExportWatermark(name=name, chunk_count=0, row_count=0)
+            db.add(watermark)
+        elif not resume:
+            watermark.last_timestamp = None
+            watermark.last_id = None
+            watermark.chunk_count = 0
+            watermark.row_count = 0
+        watermark.completed_at = None
+        db.commit()
+
+        if watermark.last_id is not None:
+            logger.info(f"Resuming export {name} after chunk {watermark.chunk_count} ({watermark.row_count} rows)")
+        else:
+            logger.info(f"Starting export {name} into {output_dir}")
+
+        if watermark.chunk_count == 0:
+            # Starting over: drop everything an earlier run of this export wrote
+            _remove_chunk_files(output_dir, source, name, "*")
+        else:
+            # Drop files of a chunk that was interrupted before its watermark was saved
+            _remove_chunk_files(output_dir, source, name, f"{watermark.chunk_count:06d}")
+
+        rows_written = 0
+        files_written = 0
+        while True:
+            after = None
+            if watermark.last_id is not None:
+                after = (watermark.last_timestamp, watermark.last_id)
+
+            # Each chunk is its own keyset-bounded query read through a
+            # server-side cursor, so no transaction stays open across chunks
+            query = _export_query(db, source, start, end, after).limit(chunk_size)
+            rows = list(query.execution_options(stream_results=True).yield_per(min(chunk_size, 10000)))
+            if not rows:
+                break
+
+            files = _write_chunk(pa, pq, schema, rows, output_dir, source, name, watermark.chunk_count)
+            last = rows[-1]
+            watermark.last_timestamp = last.timestamp
+            watermark.last_id = last.id
+            watermark.chunk_count += 1
+            watermark.row_count += len(rows)
+            db.commit()
+
+            rows_written += len(rows)
+            files_written += files
+            logger.info(f"Export {name}: chunk {watermark.chunk_count} wrote {len(rows)} rows to {files} files")
+
+            if len(rows) < chunk_size:
+                break
+
+        watermark.completed_at = datetime.utcnow()
+        db.commit()
+        logger.info(f"Export {name} complete: {watermark.row_count} rows in {watermark.chunk_count} chunks")
+
+        return {
+            "name": name,
+            "rows_written": rows_written,
+            "files_written": files_written,
+            "total_rows": watermark.row_count,
+            "chunks": watermark.chunk_count,
+            "output_dir": os.path.join(output_dir, source)
+        }
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Error exporting {source} to Parquet: {str(e)}")
+        raise
+    finally:
+        db.close()
+
+
+def get_export_watermarks(db) -> List[ExportWatermark]:
+    """All Parquet export watermarks, most recently updated first"""
+    return db.query(ExportWatermark).filter(
+        ExportWatermark.name.like("parquet:%")
+    ).order_by(ExportWatermark.updated_at.desc()).all()
+
+
+def _parse_datetime(value: str) -> Optional[datetime]:
+    return datetime.fromisoformat(value) if value and value != "-" else None
+
+
+if __name__ == "__main__":
+    # Usage: python parquet_export.py [usage|records] [start] [end] [--restart]
+    args = [arg for arg in sys.argv[1:] if arg != "--restart"]
+    export_usage_parquet(
+        source=args[0] if len(args) > 0 else "usage",
+        start=_parse_datetime(args[1]) if len(args) > 1 else None,
+        end=_parse_datetime(args[2]) if len(args) > 2 else None,
+        resume="--restart" not in sys.argv
+    )
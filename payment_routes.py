@@ -2,12 +2,16 @@ from fastapi import APIRouter, Depends, HTTPException, Request, Body
 from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse
 from sqlalchemy.orm import Session
 from typing import Optional, List, Dict, Any
-from database import get_db, Customer, User, Invoice
+from database import get_db, SessionLocal, Customer, User
 from auth import get_current_active_user, get_current_user_from_cookie
+from stripe_client import stripe_client
+from stripe_mirror import stripe_mirror
+from webhook_inbox import webhook_inbox
 import os
+import json
 import stripe
 import logging
-from fastapi.templating import Jinja2Templates
+from templating import templates
 from datetime import datetime, timedelta
 
 # Configure logging
@@ -32,35 +36,6 @@ else:
 # Create router
 router = APIRouter(tags=["payment"])
 
-# Templates
-templates = Jinja2Templates(directory="templates")
-
-# Add custom filters for templates
-def format_datetime(value, format="%Y-%m-%d"):
-    """Format a datetime object to a string"""
-    if value is None:
-        return ""
-    if isinstance(value, str):
-        try:
-            value = datetime.fromisoformat(value)
-        except ValueError:
-            pass
-    return value.strftime(format)
-
-def format_currency(value):
-    """Format a currency value to 2 decimal places"""
-    if value is None:
-        return "0.00"
-    try:
-        # Convert cents to dollars
-        if isinstance(value, int) and value > 100:
-            value = value / 100.0
-        return "{:.2f}".format(float(value))
-    except (ValueError, TypeError):
-        return "0.00"
-
-templates.env.filters["format_datetime"] = format_datetime
-templates.env.filters["format_currency"] = format_currency
 
 @router.get("/payment/manage", response_class=HTMLResponse)
 async def payment_management(
@@ -88,7 +63,7 @@ async def payment_management(
     # If customer has no Stripe ID, create one
     if not customer.stripe_customer_id:
         try:
-            stripe_customer = stripe.Customer.create(
+            stripe_customer = await stripe_client.Customer.create(
                 email=customer.email,
                 name=customer.name,
                 metadata={"internal_customer_id": str(customer.id)}
@@ -107,50 +82,15 @@ async def payment_management(
                 "error": "Could not create payment profile. Please try again later."
             })
     
-    # Get payment methods
-    payment_methods = []
-    default_payment_method_id = None
+    # Payment methods and invoices are read from the local Stripe mirror, which
+    # webhooks keep current; Stripe is only called the first time a customer is seen
     try:
-        stripe_customer = stripe.Customer.retrieve(customer.stripe_customer_id)
-        if stripe_customer.get("invoice_settings", {}).get("default_payment_method"):
-            default_payment_method_id = stripe_customer["invoice_settings"]["default_payment_method"]
-            
-        payment_methods_response = stripe.PaymentMethod.list(
-            customer=customer.stripe_customer_id,
-            type="card"
-        )
-        payment_methods = payment_methods_response.data
+        await stripe_mirror.ensure_fresh(db, customer.stripe_customer_id)
     except Exception as e:
-        logger.error(f"Error retrieving payment methods: {str(e)}")
+        logger.error(f"Error loading payment details from Stripe: {str(e)}")
     
-    # Get invoices
-    invoices = []
-    try:
-        # Query local database first
-        db_invoices = db.query(Invoice).filter(Invoice.customer_id == customer.id).all()
-        
-        # If no local invoices, try to get from Stripe
-        if not db_invoices:
-            stripe_invoices = stripe.Invoice.list(customer=customer.stripe_customer_id)
-            for invoice in stripe_invoices.data:
-                invoices.append({
-                    "created": datetime.fromtimestamp(invoice.created),
-                    "description": invoice.lines.data[0].description if invoice.lines.data else "Invoice",
-                    "amount": invoice.total / 100,  # Convert from cents to dollars
-                    "status": invoice.status,
-                    "invoice_pdf": invoice.invoice_pdf
-                })
-        else:
-            for invoice in db_invoices:
-                invoices.append({
-                    "created": invoice.created_at,
-                    "description": invoice.description,
-                    "amount": invoice.amount / 100,  # Convert from cents to dollars
-                    "status": invoice.status,
-                    "invoice_pdf": invoice.invoice_url if invoice.invoice_url else "#"
-                })
-    except Exception as e:
-        logger.error(f"Error retrieving invoices: {str(e)}")
+    payment_methods, default_payment_method_id = stripe_mirror.get_payment_methods(db, customer.stripe_customer_id)
+    invoices = stripe_mirror.get_invoices(db, customer.id)
     
     return templates.TemplateResponse("payment_management.html", {
         "request": request,
@@ -187,7 +127,7 @@ async def create_setup_intent(
     if stripe_customer_id:
         try:
             # Verify the customer exists in Stripe
-            stripe_customer = stripe.Customer.retrieve(stripe_customer_id)
+            stripe_customer = await stripe_client.Customer.retrieve(stripe_customer_id)
             if hasattr(stripe_customer, 'deleted') and stripe_customer.deleted:
                 # Customer was deleted in Stripe, create a new one
                 stripe_customer_id = None
@@ -201,7 +141,7 @@ async def create_setup_intent(
     if not stripe_customer_id:
         try:
             logger.info(f"Creating new Stripe customer for {customer.name}")
-            stripe_customer = stripe.Customer.create(
+            stripe_customer = await stripe_client.Customer.create(
                 email=customer.email,
                 name=customer.name,
                 metadata={"internal_customer_id": str(customer.id)}
@@ -237,7 +177,7 @@ async def create_setup_intent(
         stripe.api_key = os.getenv("STRIPE_LIVE_SECRET_KEY")
         logger.info("Switched to live API key for setup intent")
         
-        setup_intent = stripe.SetupIntent.create(
+        setup_intent = await stripe_client.SetupIntent.create(
             customer=stripe_customer_id,
             payment_method_types=["card"],
             usage="off_session"
@@ -303,7 +243,7 @@ async def attach_payment_method(
     
     # Attach payment method to customer
     try:
-        payment_method = stripe.PaymentMethod.attach(
+        payment_method = await stripe_client.PaymentMethod.attach(
             payment_method_id,
             customer=customer.stripe_customer_id
         )
@@ -312,15 +252,18 @@ async def attach_payment_method(
         customer.payment_method_id = payment_method.id
         customer.payment_method_last4 = payment_method.card.last4
         customer.payment_method_brand = payment_method.card.brand
+        stripe_mirror.upsert_payment_method(db, payment_method)
         db.commit()
         
         # Set as default payment method if no default exists
-        stripe_customer = stripe.Customer.retrieve(customer.stripe_customer_id)
+        stripe_customer = await stripe_client.Customer.retrieve(customer.stripe_customer_id)
         if not stripe_customer.get("invoice_settings", {}).get("default_payment_method"):
-            stripe.Customer.modify(
+            await stripe_client.Customer.modify(
                 customer.stripe_customer_id,
                 invoice_settings={"default_payment_method": payment_method.id}
             )
+            stripe_mirror.set_default_payment_method(db, customer.stripe_customer_id, payment_method.id)
+            db.commit()
         
         return {"success": True, "payment_method": {
             "id": payment_method.id,
@@ -353,18 +296,19 @@ async def set_default_payment_method(
     
     # Set as default payment method
     try:
-        stripe.Customer.modify(
+        await stripe_client.Customer.modify(
             customer.stripe_customer_id,
             invoice_settings={"default_payment_method": payment_method_id}
         )
         
         # Get payment method details
-        payment_method = stripe.PaymentMethod.retrieve(payment_method_id)
+        payment_method = await stripe_client.PaymentMethod.retrieve(payment_method_id)
         
         # Update customer record
         customer.payment_method_id = payment_method.id
         customer.payment_method_last4 = payment_method.card.last4
         customer.payment_method_brand = payment_method.card.brand
+        stripe_mirror.set_default_payment_method(db, customer.stripe_customer_id, payment_method.id)
         db.commit()
         
         return {"success": True}
@@ -395,21 +339,24 @@ async def delete_payment_method(
     # Check if this is the default payment method
     is_default = False
     try:
-        stripe_customer = stripe.Customer.retrieve(customer.stripe_customer_id)
+        stripe_customer = await stripe_client.Customer.retrieve(customer.stripe_customer_id)
         is_default = stripe_customer.get("invoice_settings", {}).get("default_payment_method") == payment_method_id
     except Exception as e:
         logger.error(f"Error checking default payment method: {str(e)}")
     
     # Delete payment method
     try:
-        stripe.PaymentMethod.detach(payment_method_id)
+        await stripe_client.PaymentMethod.detach(payment_method_id)
+        stripe_mirror.remove_payment_method(db, payment_method_id)
         
         # Clear customer record if this was the default payment method
         if is_default or customer.payment_method_id == payment_method_id:
             customer.payment_method_id = None
             customer.payment_method_last4 = None
             customer.payment_method_brand = None
-            db.commit()
+        if is_default:
+            stripe_mirror.set_default_payment_method(db, customer.stripe_customer_id, None)
+        db.commit()
         
         return {"success": True}
     except Exception as e:
@@ -445,87 +392,25 @@ async def stripe_webhook(request: Request):
             logger.error(f"Invalid signature: {str(e)}")
             return JSONResponse(status_code=400, content={"error": "Invalid signature"})
         
-        # Handle the event
-        if event["type"] == "invoice.payment_succeeded":
-            await handle_successful_payment(event["data"]["object"], request)
-        elif event["type"] == "invoice.payment_failed":
-            await handle_failed_payment(event["data"]["object"], request)
+        # Store the event and acknowledge it; the webhook inbox worker applies it
+        db = SessionLocal()
+        try:
+            if webhook_inbox.receive(db, json.loads(body)):
+                webhook_inbox.notify()
+        finally:
+            db.close()
         
         return JSONResponse(content={"status": "success"})
     except Exception as e:
         logger.error(f"Error processing webhook: {str(e)}")
         return JSONResponse(status_code=500, content={"error": str(e)})
 
-async def handle_successful_payment(invoice, request: Request):
-    """Handle successful payment webhook event"""
-    try:
-        db = next(get_db())
-        
-        # Get customer from Stripe customer ID
-        stripe_customer_id = invoice.get("customer")
-        customer = db.query(Customer).filter(Customer.stripe_customer_id == stripe_customer_id).first()
-        
-        if not customer:
-            logger.error(f"Customer not found for Stripe ID: {stripe_customer_id}")
-            return
-        
-        # Create invoice record
-        db_invoice = Invoice(
-            customer_id=customer.id,
-            stripe_invoice_id=invoice.get("id"),
-            amount=invoice.get("total"),
-            status="paid",
-            description=invoice.get("description") or "API Usage",
-            invoice_url=invoice.get("invoice_pdf"),
-            created_at=datetime.fromtimestamp(invoice.get("created"))
-        )
-        db.add(db_invoice)
-        db.commit()
-        
-        logger.info(f"Recorded successful payment for customer {customer.id}")
-    except Exception as e:
-        logger.error(f"Error handling successful payment: {str(e)}")
-
-async def handle_failed_payment(invoice, request: Request):
-    """Handle failed payment webhook event"""
-    try:
-        db = next(get_db())
-        
-        # Get customer from Stripe customer ID
-        stripe_customer_id = invoice.get("customer")
-        customer = db.query(Customer).filter(Customer.stripe_customer_id == stripe_customer_id).first()
-        
-        if not customer:
-            logger.error(f"Customer not found for Stripe ID: {stripe_customer_id}")
-            return
-        
-        # Create invoice record for failed payment
-        db_invoice = Invoice(
-            customer_id=customer.id,
-            stripe_invoice_id=invoice.get("id"),
-            amount=invoice.get("total"),
-            status="failed",
-            description=invoice.get("description") or "API Usage (Failed Payment)",
-            invoice_url=invoice.get("hosted_invoice_url"),
-            created_at=datetime.fromtimestamp(invoice.get("created"))
-        )
-        db.add(db_invoice)
-        
-        # Update customer subscription status
-        customer.subscription_active = False
-        
-        db.commit()
-        
-        logger.info(f"Recorded failed payment for customer {customer.id}")
-    except Exception as e:
-        logger.error(f"Error handling failed payment: {str(e)}")
-
 @router.get("/test-stripe-keys")
 async def test_stripe_keys():
     """Test endpoint to verify Stripe keys are correctly configured"""
     try:
         # Test the secret key by making a simple API call
-        customers = stripe.Customer.list(limit=1)
+        customers = await stripe_client.Customer.list(limit=1)
         
         return {
             "success": True,
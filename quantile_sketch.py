@@ -0,0 +1,130 @@
+import math
+from typing import Dict, Any, Optional
+
+# Values at or below this are counted in the zero bucket
+MIN_INDEXABLE_VALUE = 1e-9
+# Default relative accuracy of quantile estimates (1%)
+DEFAULT_RELATIVE_ACCURACY = 0.01
+# Upper bound on the number of bins; the lowest bins are collapsed beyond it
+DEFAULT_MAX_BINS = 2048
+
+
+class DDSketch:
+    """
+    Mergeable quantile sketch with relative-error guarantees (DDSketch).
+
+    Values are counted in logarithmically sized bins, so any quantile is
+    returned within `relative_accuracy` of the true value. Two sketches with
+    the same accuracy can be merged exactly, which lets per-worker and
+    per-day sketches be combined into fleet-wide percentiles.
+    """
+
+    def __init__(self, relative_accuracy: float = DEFAULT_RELATIVE_ACCURACY, max_bins: int = DEFAULT_MAX_BINS):
+        if not 0 < relative_accuracy < 1:
+            raise ValueError("relative_accuracy must be between 0 and 1")
+        self.relative_accuracy = relative_accuracy
+        self.max_bins = max_bins
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.bins: Dict[int, int] = {}
+        self.zero_count = 0
+        self.count = 0
+        self.sum = 0.0
+        self.min: Optional[float] = None
+        self.max: Optional[float] = None
+
+    def _key(self, value: float) -> int:
+        return int(math.ceil(math.log(value) / self._log_gamma))
+
+    def _value(self, key: int) -> float:
+        return 2 * self.gamma ** key / (self.gamma + 1)
+
+    def add(self, value: float, weight: int = 1):
+        """Add a value to the sketch"""
+        if value is None or weight <= 0:
+            return
+        value = float(value)
+        if value <= MIN_INDEXABLE_VALUE:
+            self.zero_count += weight
+        else:
+            key = self._key(value)
+            self.bins[key] = self.bins.get(key, 0) + weight
+            if len(self.bins) > self.max_bins:
+                self._collapse()
+        self.count += weight
+        self.sum += value * weight
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def merge(self, other: "DDSketch"):
+        """Merge another sketch into this one"""
+        if other.count == 0:
+            return
+        if not math.isclose(self.gamma, other.gamma):
+            raise ValueError("Cannot merge sketches with different relative accuracy")
+        for key, count in other.bins.items():
+            self.bins[key] = self.bins.get(key, 0) + count
+        if len(self.bins) > self.max_bins:
+            self._collapse()
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.sum += other.sum
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+
+    def _collapse(self):
+        """Fold the lowest bins together to stay within max_bins"""
+        keys = sorted(self.bins)
+        excess = keys[:len(keys) - self.max_bins + 1]
+        folded = sum(self.bins.pop(key) for key in excess)
+        target = keys[len(excess)]
+        self.bins[target] = self.bins.get(target, 0) + folded
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Return the estimated value at quantile q (0..1), or None if empty"""
+        if self.count == 0:
+            return None
+        if q <= 0:
+            return self.min
+        if q >= 1:
+            return self.max
+
+        rank = q * (self.count - 1)
+        seen = self.zero_count
+        if seen > rank:
+            return 0.0
+        for key in sorted(self.bins):
+            seen += self.bins[key]
+            if seen > rank:
+                return min(max(self._value(key), self.min), self.max)
+        return self.max
+
+    @property
+    def average(self) -> Optional[float]:
+        return self.sum / self.count if self.count else None
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Serialize the sketch to a JSON-compatible dict"""
+        return {
+            "relative_accuracy": self.relative_accuracy,
+            "bins": {str(key): count for key, count in self.bins.items()},
+            "zero_count": self.zero_count,
+            "count": self.count,
+            "sum": self.sum,
+            "min": self.min,
+            "max": self.max
+        }
+
+    @classmethod
+    def from_dict(cls, data: Optional[Dict[str, Any]]) -> "DDSketch":
+        """Rebuild a sketch serialized with to_dict()"""
+        if not data:
+            return cls()
+        sketch = cls(relative_accuracy=data.get("relative_accuracy", DEFAULT_RELATIVE_ACCURACY))
+        sketch.bins = {int(key): int(count) for key, count in data.get("bins", {}).items()}
+        sketch.zero_count = int(data.get("zero_count", 0))
+        sketch.count = int(data.get("count", 0))
+        sketch.sum = float(data.get("sum", 0.0))
+        sketch.min = data.get("min")
+        sketch.max = data.get("max")
+        return sketch
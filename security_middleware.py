@@ -1,61 +1,88 @@
+from typing import Dict, List, Tuple, Iterable
 from fastapi import FastAPI
-from starlette.middleware.base import BaseHTTPMiddleware
-from starlette.requests import Request
-from starlette.responses import Response
-import secrets
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+# Paths whose responses must never be cached (matched as prefixes): pages and APIs that
+# carry credentials, tokens, API keys or account details
+NO_STORE_PATH_PREFIXES = (
+    "/login", "/register", "/logout", "/admin", "/dashboard", "/account-settings", "/token",
+    "/api/login", "/api/register", "/api/dashboard", "/api/users/me", "/api/keys", "/api-key"
+)
+
+class SecurityHeadersMiddleware:
+    """
+    Adds security headers to every HTTP response.
+
+    This is plain ASGI middleware: it only rewrites the headers of the
+    http.response.start message, so response bodies (including streamed
+    and server-sent event responses) pass through untouched. The header
+    blocks are built once, when the app starts.
+    """
 
-class SecurityHeadersMiddleware(BaseHTTPMiddleware):
     def __init__(
         self,
-        app: FastAPI,
+        app: ASGIApp,
         **kwargs
     ):
-        super().__init__(app)
+        self.app = app
         self.csp_directives = kwargs.get("csp_directives", self._default_csp_directives())
         self.hsts_max_age = kwargs.get("hsts_max_age", 31536000)  # 1 year in seconds
         self.include_subdomains = kwargs.get("include_subdomains", True)
         self.preload = kwargs.get("preload", False)
         self.xfo_option = kwargs.get("xfo_option", "DENY")
-    
-    async def dispatch(self, request: Request, call_next):
-        response = await call_next(request)
-        
-        # Add Content-Security-Policy header
+        self.no_store_prefixes = tuple(kwargs.get("no_store_prefixes", NO_STORE_PATH_PREFIXES))
+
+        headers = {}
+
+        # Content-Security-Policy header
         if self.csp_directives:
-            response.headers["Content-Security-Policy"] = self._build_csp_header()
-        
-        # Add Strict-Transport-Security header
+            headers["Content-Security-Policy"] = self._build_csp_header()
+
+        # Strict-Transport-Security header
         if self.hsts_max_age > 0:
             hsts_value = f"max-age={self.hsts_max_age}"
             if self.include_subdomains:
                 hsts_value += "; includeSubDomains"
             if self.preload:
                 hsts_value += "; preload"
-            response.headers["Strict-Transport-Security"] = hsts_value
-        
-        # Add X-Content-Type-Options header
-        response.headers["X-Content-Type-Options"] = "nosniff"
-        
-        # Add X-Frame-Options header
-        response.headers["X-Frame-Options"] = self.xfo_option
-        
-        # Add X-XSS-Protection header
-        response.headers["X-XSS-Protection"] = "1; mode=block"
-        
-        # Add Referrer-Policy header
-        response.headers["Referrer-Policy"] = "strict-origin-when-cross-origin"
-        
-        # Add Permissions-Policy header
-        response.headers["Permissions-Policy"] = "geolocation=(), microphone=(), camera=()"
-        
-        # Add Cache-Control headers for sensitive pages
-        if any(path in request.url.path for path in ["/login", "/register", "/admin", "/dashboard"]):
-            response.headers["Cache-Control"] = "no-store, no-cache, must-revalidate, max-age=0"
-            response.headers["Pragma"] = "no-cache"
-            response.headers["Expires"] = "0"
-        
-        return response
-    
+            headers["Strict-Transport-Security"] = hsts_value
+
+        headers["X-Content-Type-Options"] = "nosniff"
+        headers["X-Frame-Options"] = self.xfo_option
+        headers["X-XSS-Protection"] = "1; mode=block"
+        headers["Referrer-Policy"] = "strict-origin-when-cross-origin"
+        headers["Permissions-Policy"] = "geolocation=(), microphone=(), camera=()"
+
+        # Cache-Control headers for sensitive pages
+        no_store = dict(headers)
+        no_store["Cache-Control"] = "no-store, no-cache, must-revalidate, max-age=0"
+        no_store["Pragma"] = "no-cache"
+        no_store["Expires"] = "0"
+
+        self._headers = self._encode(headers)
+        self._no_store_headers = self._encode(no_store)
+
+    @staticmethod
+    def _encode(headers: Dict[str, str]) -> Tuple[frozenset, List[Tuple[bytes, bytes]]]:
+        raw = [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers.items()]
+        return frozenset(name for name, _ in raw), raw
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        names, block = self._no_store_headers if scope["path"].startswith(self.no_store_prefixes) else self._headers
+
+        async def send_with_headers(message: Message):
+            if message["type"] == "http.response.start":
+                # Our values replace any the endpoint set for the same headers
+                headers: Iterable[Tuple[bytes, bytes]] = message.get("headers", ())
+                message["headers"] = [header for header in headers if header[0].lower() not in names] + block
+            await send(message)
+
+        await self.app(scope, receive, send_with_headers)
+
     def _default_csp_directives(self):
         """Default Content Security Policy directives"""
         return {
@@ -72,7 +99,7 @@ class SecurityHeadersMiddleware(BaseHTTPMiddleware):
             "frame-ancestors": ["'none'"],
             "upgrade-insecure-requests": []
         }
-    
+
     def _build_csp_header(self):
         """Build the Content-Security-Policy header value"""
         directives = []
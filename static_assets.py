@@ -0,0 +1,238 @@
+import os
+import sys
+import gzip
+import stat
+import hashlib
+import threading
+import mimetypes
+import logging
+from typing import Dict, Optional, Tuple
+
+from fastapi.staticfiles import StaticFiles
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import NotModifiedResponse
+from starlette.types import Scope
+
+from compression import accepted_encodings
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Directory served under /static
+STATIC_DIRECTORY = os.getenv("STATIC_DIRECTORY", "static")
+# Cache lifetime for assets requested without their current version; fingerprinted URLs are cached for a year
+STATIC_MAX_AGE_SECONDS = int(os.getenv("STATIC_MAX_AGE_SECONDS", "3600"))
+# Files smaller than this are not worth a compressed copy
+STATIC_PRECOMPRESS_MIN_SIZE = int(os.getenv("STATIC_PRECOMPRESS_MIN_SIZE", "256"))
+
+# Extensions of files that get .br/.gz siblings
+PRECOMPRESS_EXTENSIONS = (".css", ".js", ".html", ".json", ".svg", ".txt", ".xml", ".map")
+
+# Preferred first
+ENCODING_SUFFIXES = (("br", ".br"), ("gzip", ".gz"))
+
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# Hex digits of the content hash used in asset URLs and ETags
+ASSET_HASH_LENGTH = 16
+
+
+def _write_if_smaller(path: str, data: bytes, source_size: int) -> bool:
+    if len(data) >= source_size:
+        # Not worth it; drop a stale copy so it is never served
+        if os.path.exists(path):
+            os.remove(path)
+        return False
+    with open(path, "wb") as f:
+        f.write(data)
+    return True
+
+
+def precompress(directory: str = STATIC_DIRECTORY) -> int:
+    """Write .gz (and .br when brotli is installed) copies of compressible assets; returns files written"""
+    written = 0
+    for root, _, files in os.walk(directory):
+        for name in files:
+            if not name.endswith(PRECOMPRESS_EXTENSIONS):
+                continue
+            path = os.path.join(root, name)
+            source = os.stat(path)
+            if source.st_size < STATIC_PRECOMPRESS_MIN_SIZE:
+                continue
+            with open(path, "rb") as f:
+                data = f.read()
+            for encoding, suffix in ENCODING_SUFFIXES:
+                target = path + suffix
+                if os.path.exists(target) and os.stat(target).st_mtime >= source.st_mtime:
+                    continue
+                if encoding == "br":
+                    if brotli is None:
+                        continue
+                    compressed = brotli.compress(data, quality=11)
+                else:
+                    # mtime=0 keeps the output identical between builds
+                    compressed = gzip.compress(data, compresslevel=9, mtime=0)
+                if _write_if_smaller(target, compressed, source.st_size):
+                    written += 1
+                    logger.info(f"{target}: {source.st_size} -> {len(compressed)} bytes")
+    if brotli is None:
+        logger.warning("brotli is not installed; only .gz copies were written")
+    return written
+
+
+class AssetManifest:
+    """
+    Content hashes of the files under static/, for cache-busting URLs.
+
+    Built at startup; an entry whose file changed on disk (same path, new
+    size or mtime) is rehashed on its next use, so edits during development
+    show up without a restart.
+    """
+
+    def __init__(self, directory: str = STATIC_DIRECTORY, url_prefix: str = "/static"):
+        self.directory = directory
+        self.url_prefix = url_prefix.rstrip("/")
+        # Relative path -> (mtime_ns, size, hash)
+        self._entries: Dict[str, Tuple[int, int, str]] = {}
+        self._built = False
+        self._lock = threading.Lock()
+
+    def _hash_file(self, path: str, stat_result: os.stat_result) -> str:
+        digest = hashlib.sha256()
+        with open(os.path.join(self.directory, path), "rb") as f:
+            for block in iter(lambda: f.read(65536), b""):
+                digest.update(block)
+        fingerprint = digest.hexdigest()[:ASSET_HASH_LENGTH]
+        with self._lock:
+            self._entries[path] = (stat_result.st_mtime_ns, stat_result.st_size, fingerprint)
+        return fingerprint
+
+    def build(self) -> int:
+        """Hash every asset; returns the number of files"""
+        entries = 0
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith((".br", ".gz")):
+                    continue
+                full_path = os.path.join(root, name)
+                path = os.path.relpath(full_path, self.directory).replace(os.sep, "/")
+                self._hash_file(path, os.stat(full_path))
+                entries += 1
+        self._built = True
+        logger.info(f"Asset manifest: {entries} files in {self.directory}")
+        return entries
+
+    def fingerprint(self, path: str, stat_result: Optional[os.stat_result] = None) -> Optional[str]:
+        """Current content hash of an asset, or None if it does not exist"""
+        if not self._built:
+            self.build()
+        path = path.lstrip("/")
+        if stat_result is None:
+            try:
+                stat_result = os.stat(os.path.join(self.directory, path))
+            except OSError:
+                return None
+        entry = self._entries.get(path)
+        if entry is not None and entry[0] == stat_result.st_mtime_ns and entry[1] == stat_result.st_size:
+            return entry[2]
+        return self._hash_file(path, stat_result)
+
+    def url(self, path: str) -> str:
+        """URL of an asset with its content hash, e.g. /static/css/styles.css?v=3f2a..."""
+        path = path.lstrip("/")
+        fingerprint = self.fingerprint(path)
+        if fingerprint is None:
+            logger.warning(f"Static asset not found: {path}")
+            return f"{self.url_prefix}/{path}"
+        return f"{self.url_prefix}/{path}?v={fingerprint}"
+
+
+# Create global asset manifest instance
+asset_manifest = AssetManifest()
+
+
+def static_url(path: str) -> str:
+    """Jinja global: {{ static_url('css/styles.css') }}"""
+    return asset_manifest.url(path)
+
+
+class PrecompressedStaticFiles(StaticFiles):
+    """
+    StaticFiles that serves a prebuilt .br or .gz sibling when the client accepts it.
+
+    Siblings come from `python static_assets.py` and are only used while
+    they are at least as new as the original. ETags are strong, derived
+    from the content hash. A request whose ?v= matches the asset's current
+    hash is cached as immutable; others are revalidated after
+    STATIC_MAX_AGE_SECONDS, so an outdated URL never pins new content.
+    """
+
+    def __init__(self, *args, manifest: AssetManifest = asset_manifest, max_age: int = STATIC_MAX_AGE_SECONDS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.manifest = manifest
+        self.max_age = max_age
+
+    @staticmethod
+    def _requested_version(scope: Scope) -> Optional[str]:
+        for param in scope.get("query_string", b"").split(b"&"):
+            if param.startswith(b"v="):
+                return param[2:].decode("latin-1")
+        return None
+
+    def _precompressed(self, full_path: str, stat_result: os.stat_result, scope: Scope) -> Optional[Tuple[str, str, os.stat_result]]:
+        accepted = accepted_encodings(Headers(scope=scope))
+        for encoding, suffix in ENCODING_SUFFIXES:
+            if encoding not in accepted:
+                continue
+            try:
+                sibling = os.stat(full_path + suffix)
+            except OSError:
+                continue
+            if stat.S_ISREG(sibling.st_mode) and sibling.st_mtime >= stat_result.st_mtime:
+                return encoding, full_path + suffix, sibling
+        return None
+
+    def file_response(self, full_path, stat_result: os.stat_result, scope: Scope, status_code: int = 200) -> Response:
+        full_path = str(full_path)
+        media_type = mimetypes.guess_type(full_path)[0] or "text/plain"
+        fingerprint = None
+        if status_code == 200:
+            path = os.path.relpath(full_path, self.manifest.directory).replace(os.sep, "/")
+            if not path.startswith("../"):
+                fingerprint = self.manifest.fingerprint(path, stat_result)
+        encoding = None
+        precompressed = self._precompressed(full_path, stat_result, scope)
+        if precompressed is not None:
+            encoding, full_path, stat_result = precompressed
+
+        response = FileResponse(
+            full_path, status_code=status_code, stat_result=stat_result, method=scope["method"], media_type=media_type
+        )
+        headers = MutableHeaders(raw=response.raw_headers)
+        if encoding is not None:
+            headers["Content-Encoding"] = encoding
+        if full_path.endswith(PRECOMPRESS_EXTENSIONS) or encoding is not None:
+            headers.add_vary_header("Accept-Encoding")
+        if fingerprint is not None:
+            # Strong, content-based; each encoding is a different representation
+            headers["ETag"] = f'"{fingerprint}-{encoding}"' if encoding else f'"{fingerprint}"'
+        if fingerprint is not None and self._requested_version(scope) == fingerprint:
+            headers["Cache-Control"] = IMMUTABLE_CACHE_CONTROL
+        else:
+            headers["Cache-Control"] = f"public, max-age={self.max_age}"
+
+        if self.is_not_modified(response.headers, Headers(scope=scope)):
+            return NotModifiedResponse(response.headers)
+        return response
+
+
+if __name__ == "__main__":
+    # Usage: python static_assets.py [directory]
+    directory = sys.argv[1] if len(sys.argv) > 1 else STATIC_DIRECTORY
+    logger.info(f"Precompressed {precompress(directory)} files in {directory}")
@@ -0,0 +1,194 @@
+import os
+import time
+import threading
+import logging
+from typing import Dict, Any, List, Optional
+
+import stripe
+from starlette.concurrency import run_in_threadpool
+
+logger = logging.getLogger(__name__)
+
+# Cached catalog is refreshed in the background once it is this old
+STRIPE_CATALOG_TTL_SECONDS = float(os.getenv("STRIPE_CATALOG_TTL_SECONDS", "300"))
+
+
+class StripeCatalog:
+    """
+    Cached snapshot of the active Stripe products and their active prices.
+
+    A refresh costs two paginated list calls (products and prices) instead
+    of one price list per product. Readers always get the current snapshot
+    without waiting; once it is older than the TTL, or after invalidate()
+    (called for product.* and price.* webhooks and admin edits), one
+    background thread replaces it. Only the very first read blocks on Stripe.
+    Each worker process keeps its own snapshot; a webhook handled by another
+    worker reaches this one within the TTL.
+    """
+
+    def __init__(self, ttl: float = STRIPE_CATALOG_TTL_SECONDS):
+        self.ttl = ttl
+        self._products: Optional[List[Dict[str, Any]]] = None
+        self._loaded_at = 0.0
+        self._generation = 0
+        # Bumped whenever the snapshot is replaced, so rendered pricing can be cached against it
+        self.version = 0
+        self._refreshing = False
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+
+    def _fetch(self) -> List[Dict[str, Any]]:
+        prices: Dict[str, List[Dict[str, Any]]] = {}
+        for price in stripe.Price.list(active=True, limit=100).auto_paging_iter():
+            product_id = price.get("product")
+            if isinstance(product_id, dict):
+                product_id = product_id.get("id")
+            prices.setdefault(product_id, []).append(price)
+
+        products = []
+        for product in stripe.Product.list(active=True, limit=100).auto_paging_iter():
+            # Both lists are newest first, like the per-product price lists they replace
+            products.append(dict(product, prices=prices.get(product["id"], [])))
+        return products
+
+    def refresh(self) -> List[Dict[str, Any]]:
+        """Fetch the catalog from Stripe now and replace the snapshot"""
+        with self._lock:
+            generation = self._generation
+        started = time.monotonic()
+        products = self._fetch()
+        with self._lock:
+            # An invalidation that arrived while fetching keeps the snapshot stale
+            self._products = products
+            self.version += 1
+            self._loaded_at = time.monotonic() if generation == self._generation else 0.0
+        logger.info(f"Loaded Stripe catalog: {len(products)} products in {time.monotonic() - started:.2f}s")
+        return products
+
+    def _refresh_in_background(self):
+        try:
+            self.refresh()
+        except Exception as e:
+            logger.error(f"Error refreshing Stripe catalog: {str(e)}")
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def get_products(self) -> List[Dict[str, Any]]:
+        """Active products, each with a "prices" list; the result must not be modified"""
+        with self._lock:
+            products = self._products
+            if products is not None:
+                if time.monotonic() - self._loaded_at >= self.ttl and not self._refreshing:
+                    self._refreshing = True
+                    threading.Thread(target=self._refresh_in_background, daemon=True).start()
+                return products
+
+        # Nothing cached yet: load once, letting concurrent callers share the result
+        with self._load_lock:
+            if self._products is not None:
+                return self._products
+            return self.refresh()
+
+    async def products(self) -> List[Dict[str, Any]]:
+        """get_products() for async handlers; only a cold cache touches the threadpool"""
+        if self._products is not None:
+            return self.get_products()
+        return await run_in_threadpool(self.get_products)
+
+    def warm(self):
+        """Start loading the catalog in the background (at startup)"""
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(target=self._refresh_in_background, daemon=True).start()
+
+    def invalidate(self):
+        """Mark the snapshot stale; the next read triggers a background refresh"""
+        with self._lock:
+            self._generation += 1
+            self._loaded_at = 0.0
+
+    def handle_event(self, event: Dict[str, Any]) -> bool:
+        """Invalidate on product.* and price.* webhook events; returns whether it did"""
+        event_type = event.get("type") or ""
+        if event_type.startswith(("product.", "price.")):
+            logger.info(f"Stripe catalog invalidated by {event_type}")
+            self.invalidate()
+            return True
+        return False
+
+
+# Create global Stripe catalog instance
+stripe_catalog = StripeCatalog()
+
+
+async def landing_products(limit: int = 3) -> List[Dict[str, Any]]:
+    """Active products and their first price, formatted for the landing page pricing section"""
+    products = (await stripe_catalog.products())[:limit]
+
+    # Process products to format them for display
+    formatted_products = []
+    for product in products:
+        price_data = product["prices"][:1]
+
+        # Extract features from metadata or description
+        features = []
+        if "metadata" in product and "features" in product["metadata"]:
+            # Try to get features from metadata if available
+            features = product["metadata"]["features"].split(",")
+        elif product.get("description"):
+            # Otherwise parse from description
+            features = [line.strip() for line in product.get("description", "").split("\n") if line.strip()]
+
+        # Default features if none found
+        if not features and product.get("name", "").lower() == "starter":
+            features = [
+                "Up to 5 API keys",
+                "1M tokens per month",
+                "Basic analytics",
+                "Email support"
+            ]
+        elif not features and product.get("name", "").lower() == "professional":
+            features = [
+                "Up to 20 API keys",
+                "10M tokens per month",
+                "Advanced analytics",
+                "Priority support",
+                "Custom rate limiting"
+            ]
+        elif not features and product.get("name", "").lower() == "enterprise":
+            features = [
+                "Unlimited API keys",
+                "Custom token limits",
+                "Custom analytics",
+                "Dedicated support",
+                "SSO integration",
+                "On-premises deployment"
+            ]
+
+        # Format price display
+        price_display = "Custom"
+        price_interval = ""
+        if price_data:
+            price = price_data[0]
+            if price.get("unit_amount"):
+                amount = price.get("unit_amount") / 100
+                price_display = f"${amount}"
+
+            if price.get("recurring") and price.get("recurring").get("interval"):
+                price_interval = f"/{price.get('recurring').get('interval')}"
+
+        formatted_products.append({
+            "id": product["id"],
+            "name": product.get("name", "Unknown"),
+            "price_display": price_display,
+            "price_interval": price_interval,
+            "features": features,
+            "is_enterprise": product.get("name", "").lower() == "enterprise"
+        })
+
+    # Sort products by price (custom/enterprise last)
+    formatted_products.sort(key=lambda p: 999999 if p["price_display"] == "Custom" else float(p["price_display"].replace("$", "")))
+    return formatted_products
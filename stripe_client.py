@@ -0,0 +1,175 @@
+import os
+import time
+import asyncio
+import threading
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any
+
+import stripe
+
+logger = logging.getLogger(__name__)
+
+# Threads dedicated to Stripe calls, separate from the threadpool used by sync endpoints
+STRIPE_CLIENT_MAX_WORKERS = int(os.getenv("STRIPE_CLIENT_MAX_WORKERS", "8"))
+# Calls waiting or running beyond this are rejected at once instead of queueing
+STRIPE_CLIENT_MAX_PENDING = int(os.getenv("STRIPE_CLIENT_MAX_PENDING", "64"))
+# Longest a handler waits for one Stripe call
+STRIPE_CALL_TIMEOUT_SECONDS = float(os.getenv("STRIPE_CALL_TIMEOUT_SECONDS", "10"))
+
+
+class _ScopedTimeoutHTTPClient(stripe.http_client.RequestsClient):
+    """
+    The SDK's requests client, with a per-thread timeout override.
+
+    StripeClient's threads bound each HTTP request by their call timeout, so
+    a timed-out call frees its thread. Every other caller in the process
+    (billing runs, metered reporting, webhook processing) keeps the SDK's
+    default timeout.
+    """
+
+    _scope = threading.local()
+
+    @property
+    def _timeout(self):
+        return getattr(self._scope, "timeout", None) or self._default_timeout
+
+    @_timeout.setter
+    def _timeout(self, value):
+        self._default_timeout = value
+
+    @classmethod
+    def set_thread_timeout(cls, timeout: float):
+        cls._scope.timeout = timeout
+
+
+# Installed only when nothing else configured a client; same settings the SDK would use
+if stripe.default_http_client is None:
+    stripe.default_http_client = _ScopedTimeoutHTTPClient(verify_ssl_certs=stripe.verify_ssl_certs, proxy=stripe.proxy)
+
+
+class _OperationStats:
+    __slots__ = ("calls", "errors", "timeouts", "rejected", "total_seconds", "max_seconds")
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.rejected = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+
+class _ResourceProxy:
+    """stripe_client.Customer etc.: async versions of the resource's class methods"""
+
+    def __init__(self, client: "StripeClient", resource_name: str):
+        self._client = client
+        self._resource_name = resource_name
+
+    def __getattr__(self, method_name: str):
+        method = getattr(getattr(stripe, self._resource_name), method_name)
+        operation = f"{self._resource_name}.{method_name}"
+
+        async def call(*args, **kwargs):
+            return await self._client.call(operation, method, *args, **kwargs)
+        return call
+
+
+class StripeClient:
+    """
+    Runs blocking Stripe SDK calls off the event loop.
+
+    Calls go to a dedicated, bounded thread pool, so a slow Stripe response
+    only holds up the handler waiting for it, and payment pages cannot
+    exhaust the threadpool that serves API traffic. Each call is bounded by
+    a timeout, and calls beyond STRIPE_CLIENT_MAX_PENDING are rejected
+    immediately. Timeouts and rejections raise stripe.error.APIConnectionError,
+    so existing StripeError handling covers them. Usage mirrors the SDK:
+
+        customer = await stripe_client.Customer.create(email=email)
+    """
+
+    def __init__(
+        self,
+        max_workers: int = STRIPE_CLIENT_MAX_WORKERS,
+        max_pending: int = STRIPE_CLIENT_MAX_PENDING,
+        timeout: float = STRIPE_CALL_TIMEOUT_SECONDS
+    ):
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers,
+            thread_name_prefix="stripe",
+            initializer=_ScopedTimeoutHTTPClient.set_thread_timeout,
+            initargs=(timeout,)
+        )
+        self._stats: Dict[str, _OperationStats] = {}
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def __getattr__(self, resource_name: str) -> _ResourceProxy:
+        if not resource_name[:1].isupper():
+            raise AttributeError(resource_name)
+        return _ResourceProxy(self, resource_name)
+
+    async def call(self, operation: str, method, *args, timeout: float = None, **kwargs):
+        """Run one SDK call on the Stripe pool and wait for it with a timeout"""
+        with self._lock:
+            stats = self._stats.get(operation)
+            if stats is None:
+                stats = self._stats[operation] = _OperationStats()
+            if self._pending >= self.max_pending:
+                stats.rejected += 1
+                raise stripe.error.APIConnectionError(f"Stripe client is saturated ({self._pending} calls pending)")
+            self._pending += 1
+
+        started = time.monotonic()
+        future = asyncio.get_running_loop().run_in_executor(self._executor, functools.partial(method, *args, **kwargs))
+        # The slot is released when the thread finishes, not when the caller gives up
+        future.add_done_callback(self._release)
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout or self.timeout)
+        except asyncio.TimeoutError:
+            with self._lock:
+                stats.timeouts += 1
+            logger.warning(f"Stripe {operation} timed out after {timeout or self.timeout:.0f}s")
+            raise stripe.error.APIConnectionError(f"Stripe {operation} timed out")
+        except Exception:
+            with self._lock:
+                stats.errors += 1
+            raise
+        finally:
+            elapsed = time.monotonic() - started
+            with self._lock:
+                stats.calls += 1
+                stats.total_seconds += elapsed
+                stats.max_seconds = max(stats.max_seconds, elapsed)
+
+    def _release(self, future):
+        with self._lock:
+            self._pending -= 1
+
+    def metrics(self) -> Dict[str, Any]:
+        """Per-operation call counts, failures and latency, plus the current backlog"""
+        with self._lock:
+            return {
+                "pending": self._pending,
+                "max_pending": self.max_pending,
+                "operations": {
+                    operation: {
+                        "calls": stats.calls,
+                        "errors": stats.errors,
+                        "timeouts": stats.timeouts,
+                        "rejected": stats.rejected,
+                        "avg_ms": round(stats.total_seconds / stats.calls * 1000, 1) if stats.calls else None,
+                        "max_ms": round(stats.max_seconds * 1000, 1)
+                    }
+                    for operation, stats in sorted(self._stats.items())
+                }
+            }
+
+
+# Create global Stripe client instance
+stripe_client = StripeClient()
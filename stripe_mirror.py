@@ -0,0 +1,291 @@
+import os
+import time
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Dict, Any, List, Optional, Tuple
+
+import stripe
+from sqlalchemy.orm import Session
+
+from database import SessionLocal, Customer, Invoice, StripeCustomerMirror, StripePaymentMethodMirror
+from stripe_client import stripe_client
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# A customer's mirror is refreshed from Stripe in the background once it is this old
+STRIPE_MIRROR_TTL_SECONDS = float(os.getenv("STRIPE_MIRROR_TTL_SECONDS", "3600"))
+
+# Invoice events whose object is mirrored as-is (payment results are handled in webhook_inbox)
+INVOICE_EVENTS = (
+    "invoice.created", "invoice.finalized", "invoice.updated", "invoice.paid",
+    "invoice.voided", "invoice.marked_uncollectible", "invoice.deleted"
+)
+PAYMENT_METHOD_EVENTS = ("payment_method.attached", "payment_method.updated", "payment_method.automatically_updated")
+
+
+def _id(value) -> Optional[str]:
+    """The id of a Stripe reference that may or may not be expanded"""
+    if isinstance(value, dict):
+        return value.get("id")
+    return value
+
+
+def _timestamp(value) -> Optional[datetime]:
+    return datetime.utcfromtimestamp(value) if value else None
+
+
+class StripeMirror:
+    """
+    Local copy of the Stripe objects shown on the payment management page.
+
+    Customers' default payment methods and their cards are kept in the
+    mirror tables, and invoices in the invoices table (keyed by
+    stripe_invoice_id). Webhooks and the payment endpoints update the
+    mirror as changes happen, so the page renders from the database. A
+    customer is loaded from Stripe on first view, refreshed in the
+    background once older than the TTL (in case a webhook was missed),
+    and `python stripe_mirror.py` re-syncs everyone in bulk.
+    """
+
+    def __init__(self, ttl: float = STRIPE_MIRROR_TTL_SECONDS):
+        self.ttl = timedelta(seconds=ttl)
+        self._refreshing = set()
+        self._tasks = set()
+
+    # Writes
+
+    def _customer_state(self, db: Session, stripe_customer_id: str) -> StripeCustomerMirror:
+        state = db.query(StripeCustomerMirror).filter_by(stripe_customer_id=stripe_customer_id).first()
+        if state is None:
+            customer_id = db.query(Customer.id).filter(Customer.stripe_customer_id == stripe_customer_id).scalar()
+            state = StripeCustomerMirror(stripe_customer_id=stripe_customer_id, customer_id=customer_id)
+            db.add(state)
+            # Sessions do not autoflush; make the new row visible to later lookups
+            db.flush()
+        return state
+
+    def upsert_customer(self, db: Session, stripe_customer: Dict[str, Any]):
+        """Mirror a Stripe customer's default payment method"""
+        state = self._customer_state(db, stripe_customer["id"])
+        state.default_payment_method_id = _id((stripe_customer.get("invoice_settings") or {}).get("default_payment_method"))
+
+    def set_default_payment_method(self, db: Session, stripe_customer_id: str, payment_method_id: Optional[str]):
+        self._customer_state(db, stripe_customer_id).default_payment_method_id = payment_method_id
+
+    def upsert_payment_method(self, db: Session, payment_method: Dict[str, Any]):
+        """Mirror one payment method; detached ones are removed"""
+        stripe_customer_id = _id(payment_method.get("customer"))
+        if not stripe_customer_id or payment_method.get("type") != "card":
+            self.remove_payment_method(db, payment_method["id"])
+            return
+        record = db.query(StripePaymentMethodMirror).filter_by(stripe_payment_method_id=payment_method["id"]).first()
+        if record is None:
+            record = StripePaymentMethodMirror(stripe_payment_method_id=payment_method["id"])
+            db.add(record)
+        card = payment_method.get("card") or {}
+        record.stripe_customer_id = stripe_customer_id
+        record.brand = card.get("brand")
+        record.last4 = card.get("last4")
+        record.exp_month = card.get("exp_month")
+        record.exp_year = card.get("exp_year")
+        record.created_at = _timestamp(payment_method.get("created"))
+        # Sessions do not autoflush; make a new row visible to later lookups
+        db.flush()
+
+    def remove_payment_method(self, db: Session, payment_method_id: str):
+        db.query(StripePaymentMethodMirror).filter_by(
+            stripe_payment_method_id=payment_method_id
+        ).delete(synchronize_session=False)
+
+    def upsert_invoice(self, db: Session, invoice: Dict[str, Any], status: Optional[str] = None) -> Optional[Invoice]:
+        """Insert or update the local row of a Stripe invoice"""
+        stripe_customer_id = _id(invoice.get("customer"))
+        customer_id = db.query(Customer.id).filter(Customer.stripe_customer_id == stripe_customer_id).scalar()
+        if customer_id is None:
+            return None
+
+        record = db.query(Invoice).filter(Invoice.stripe_invoice_id == invoice["id"]).first()
+        if record is None:
+            record = Invoice(customer_id=customer_id, stripe_invoice_id=invoice["id"])
+            db.add(record)
+
+        description = invoice.get("description")
+        if not description:
+            lines = (invoice.get("lines") or {}).get("data") or []
+            description = lines[0].get("description") if lines else None
+        record.customer_id = customer_id
+        record.amount = invoice.get("total")
+        record.status = status or invoice.get("status")
+        record.description = description or record.description or "Invoice"
+        record.invoice_url = invoice.get("invoice_pdf") or invoice.get("hosted_invoice_url") or record.invoice_url
+        record.created_at = _timestamp(invoice.get("created")) or record.created_at
+        db.flush()
+        return record
+
+    def _apply_snapshot(
+        self,
+        db: Session,
+        stripe_customer: Dict[str, Any],
+        payment_methods: List[Dict[str, Any]],
+        invoices: List[Dict[str, Any]]
+    ):
+        """Replace everything mirrored for one customer with a fresh read from Stripe"""
+        stripe_customer_id = stripe_customer["id"]
+        if stripe_customer.get("deleted"):
+            self.remove_customer(db, stripe_customer_id)
+            return
+        self.upsert_customer(db, stripe_customer)
+        current = {payment_method["id"] for payment_method in payment_methods}
+        for record in db.query(StripePaymentMethodMirror).filter_by(stripe_customer_id=stripe_customer_id):
+            if record.stripe_payment_method_id not in current:
+                db.delete(record)
+        for payment_method in payment_methods:
+            self.upsert_payment_method(db, payment_method)
+        for invoice in invoices:
+            self.upsert_invoice(db, invoice)
+        self._customer_state(db, stripe_customer_id).synced_at = datetime.utcnow()
+
+    def remove_customer(self, db: Session, stripe_customer_id: str):
+        db.query(StripePaymentMethodMirror).filter_by(stripe_customer_id=stripe_customer_id).delete(synchronize_session=False)
+        db.query(StripeCustomerMirror).filter_by(stripe_customer_id=stripe_customer_id).delete(synchronize_session=False)
+
+    def handle_event(self, db: Session, event: Dict[str, Any]) -> bool:
+        """Apply a webhook event to the mirror (the caller commits); returns whether it was relevant"""
+        event_type = event.get("type") or ""
+        obj = event["data"]["object"]
+        if event_type == "customer.updated":
+            self.upsert_customer(db, obj)
+        elif event_type == "customer.deleted":
+            self.remove_customer(db, obj["id"])
+        elif event_type in PAYMENT_METHOD_EVENTS or event_type == "payment_method.detached":
+            self.upsert_payment_method(db, obj)
+        elif event_type == "invoice.deleted":
+            db.query(Invoice).filter(Invoice.stripe_invoice_id == obj["id"]).delete(synchronize_session=False)
+        elif event_type in INVOICE_EVENTS:
+            self.upsert_invoice(db, obj)
+        else:
+            return False
+        return True
+
+    # Reads
+
+    def get_payment_methods(self, db: Session, stripe_customer_id: str) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """Cards of a customer (newest first, shaped like Stripe's) and the default card's id"""
+        records = db.query(StripePaymentMethodMirror).filter_by(
+            stripe_customer_id=stripe_customer_id
+        ).order_by(StripePaymentMethodMirror.created_at.desc()).all()
+        default_id = db.query(StripeCustomerMirror.default_payment_method_id).filter_by(
+            stripe_customer_id=stripe_customer_id
+        ).scalar()
+        payment_methods = [
+            {
+                "id": record.stripe_payment_method_id,
+                "card": {
+                    "brand": record.brand,
+                    "last4": record.last4,
+                    "exp_month": record.exp_month,
+                    "exp_year": record.exp_year
+                }
+            }
+            for record in records
+        ]
+        return payment_methods, default_id
+
+    def get_invoices(self, db: Session, customer_id: int) -> List[Dict[str, Any]]:
+        """A customer's invoices, newest first, as shown on the payment page"""
+        return [
+            {
+                "created": invoice.created_at,
+                "description": invoice.description,
+                "amount": (invoice.amount or 0) / 100,  # Convert from cents to dollars
+                "status": invoice.status,
+                "invoice_pdf": invoice.invoice_url if invoice.invoice_url else "#"
+            }
+            for invoice in db.query(Invoice).filter(
+                Invoice.customer_id == customer_id
+            ).order_by(Invoice.created_at.desc()).all()
+        ]
+
+    # Refresh from Stripe
+
+    async def refresh_customer(self, stripe_customer_id: str):
+        """Reload one customer's mirror from Stripe (three calls)"""
+        stripe_customer = await stripe_client.Customer.retrieve(stripe_customer_id)
+        payment_methods = await stripe_client.PaymentMethod.list(customer=stripe_customer_id, type="card", limit=100)
+        invoices = await stripe_client.Invoice.list(customer=stripe_customer_id, limit=100)
+        db = SessionLocal()
+        try:
+            self._apply_snapshot(db, stripe_customer, payment_methods.data, invoices.data)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    async def _refresh_in_background(self, stripe_customer_id: str):
+        try:
+            await self.refresh_customer(stripe_customer_id)
+        except Exception as e:
+            logger.error(f"Error refreshing Stripe mirror for {stripe_customer_id}: {str(e)}")
+        finally:
+            self._refreshing.discard(stripe_customer_id)
+
+    async def ensure_fresh(self, db: Session, stripe_customer_id: str):
+        """Load a customer never seen before; refresh a stale one without waiting"""
+        synced_at = db.query(StripeCustomerMirror.synced_at).filter_by(stripe_customer_id=stripe_customer_id).scalar()
+        if synced_at is None:
+            await self.refresh_customer(stripe_customer_id)
+        elif datetime.utcnow() - synced_at > self.ttl and stripe_customer_id not in self._refreshing:
+            self._refreshing.add(stripe_customer_id)
+            task = asyncio.create_task(self._refresh_in_background(stripe_customer_id))
+            # Keep a reference so the task is not garbage collected mid-flight
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    def sync_all(self):
+        """Re-sync every customer with a Stripe id, using auto-pagination (batch job)"""
+        started = time.monotonic()
+        db = SessionLocal()
+        try:
+            known = {
+                stripe_customer_id
+                for (stripe_customer_id,) in db.query(Customer.stripe_customer_id).filter(Customer.stripe_customer_id.isnot(None))
+            }
+
+            # All invoices in one paginated stream rather than one list per customer
+            invoices: Dict[str, List[Dict[str, Any]]] = {}
+            for invoice in stripe.Invoice.list(limit=100).auto_paging_iter():
+                stripe_customer_id = _id(invoice.get("customer"))
+                if stripe_customer_id in known:
+                    invoices.setdefault(stripe_customer_id, []).append(invoice)
+
+            synced = 0
+            for stripe_customer in stripe.Customer.list(limit=100).auto_paging_iter():
+                if stripe_customer["id"] not in known:
+                    continue
+                payment_methods = list(stripe.PaymentMethod.list(
+                    customer=stripe_customer["id"], type="card", limit=100
+                ).auto_paging_iter())
+                self._apply_snapshot(db, stripe_customer, payment_methods, invoices.get(stripe_customer["id"], []))
+                db.commit()
+                synced += 1
+
+            logger.info(f"Synced {synced} Stripe customers in {time.monotonic() - started:.1f}s")
+        except Exception as e:
+            db.rollback()
+            logger.error(f"Error syncing Stripe mirror: {str(e)}")
+            raise
+        finally:
+            db.close()
+
+
+# Create global Stripe mirror instance
+stripe_mirror = StripeMirror()
+
+
+if __name__ == "__main__":
+    stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
+    stripe_mirror.sync_all()
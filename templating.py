@@ -0,0 +1,200 @@
+import os
+import time
+import threading
+import logging
+from datetime import datetime
+from typing import Dict, Any
+
+import jinja2
+from fastapi.templating import Jinja2Templates
+
+from static_assets import static_url
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Directory the templates are loaded from
+TEMPLATES_DIRECTORY = os.getenv("TEMPLATES_DIRECTORY", os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates"))
+# Compiled templates are kept here and shared by workers and restarts (empty disables it)
+TEMPLATE_CACHE_DIRECTORY = os.getenv("TEMPLATE_CACHE_DIRECTORY", ".jinja_cache")
+# Re-read templates that changed on disk; on by default only in development mode
+TEMPLATE_AUTO_RELOAD = os.getenv("TEMPLATE_AUTO_RELOAD", os.getenv("DEVELOPMENT_MODE", "false")).lower() == "true"
+
+
+class _TemplateStats:
+    __slots__ = ("renders", "errors", "total_seconds", "max_seconds", "compile_seconds")
+
+    def __init__(self):
+        self.renders = 0
+        self.errors = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.compile_seconds = None
+
+
+class TemplateMetrics:
+    """Per-template render counts and latency, plus the time each took to load at startup"""
+
+    def __init__(self):
+        self._stats: Dict[str, _TemplateStats] = {}
+        self._lock = threading.Lock()
+
+    def _get(self, name: str) -> _TemplateStats:
+        stats = self._stats.get(name)
+        if stats is None:
+            stats = self._stats[name] = _TemplateStats()
+        return stats
+
+    def record_render(self, name: str, seconds: float, failed: bool = False):
+        with self._lock:
+            stats = self._get(name)
+            stats.renders += 1
+            stats.errors += failed
+            stats.total_seconds += seconds
+            stats.max_seconds = max(stats.max_seconds, seconds)
+
+    def record_compile(self, name: str, seconds: float):
+        with self._lock:
+            self._get(name).compile_seconds = seconds
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "auto_reload": TEMPLATE_AUTO_RELOAD,
+                "bytecode_cache": TEMPLATE_CACHE_DIRECTORY or None,
+                "templates": {
+                    name: {
+                        "renders": stats.renders,
+                        "errors": stats.errors,
+                        "avg_ms": round(stats.total_seconds / stats.renders * 1000, 2) if stats.renders else None,
+                        "max_ms": round(stats.max_seconds * 1000, 2),
+                        "load_ms": round(stats.compile_seconds * 1000, 2) if stats.compile_seconds is not None else None
+                    }
+                    for name, stats in sorted(self._stats.items())
+                }
+            }
+
+
+# Create global template metrics instance
+template_metrics = TemplateMetrics()
+
+
+class TimedTemplate(jinja2.Template):
+    """Template whose top-level renders are timed (extended and included templates count toward it)"""
+
+    def render(self, *args, **kwargs) -> str:
+        started = time.perf_counter()
+        failed = True
+        try:
+            result = super().render(*args, **kwargs)
+            failed = False
+            return result
+        finally:
+            # Templates built with from_string have no name
+            template_metrics.record_render(self.name or "<string>", time.perf_counter() - started, failed)
+
+
+# Template filters
+def format_datetime(value, format="%Y-%m-%d"):
+    """Format a datetime object to a string"""
+    if value is None:
+        return ""
+    if isinstance(value, str):
+        try:
+            value = datetime.fromisoformat(value)
+        except ValueError:
+            pass
+    return value.strftime(format)
+
+def format_currency(value):
+    """Format a currency value to 2 decimal places"""
+    if value is None:
+        return "0.00"
+    try:
+        # Convert cents to dollars
+        if isinstance(value, int) and value > 100:
+            value = value / 100.0
+        return "{:.2f}".format(float(value))
+    except (ValueError, TypeError):
+        return "0.00"
+
+def format_timestamp(value, format="%Y-%m-%d %H:%M:%S"):
+    """Format a datetime object to a string with the time (admin pages)"""
+    if not value:
+        return "N/A"
+    return value.strftime(format)
+
+def format_dollars(value):
+    """Format a dollar amount with its sign (admin pages)"""
+    if not value:
+        return "$0.00"
+    return f"${value:.2f}"
+
+def format_date(value, format="%Y-%m-%d"):
+    """Format a date given as a datetime or Unix timestamp; other values (e.g. 'N/A') are shown as they are"""
+    if value is None:
+        return ""
+    if isinstance(value, (int, float)):
+        value = datetime.utcfromtimestamp(value)
+    if isinstance(value, datetime):
+        return value.strftime(format)
+    return value
+
+def timestamp_to_datetime(timestamp):
+    """Convert a Unix timestamp to a formatted datetime string"""
+    if not timestamp:
+        return "N/A"
+    dt = datetime.fromtimestamp(timestamp)
+    return dt.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def _create_templates() -> Jinja2Templates:
+    options = {"auto_reload": TEMPLATE_AUTO_RELOAD}
+    if TEMPLATE_CACHE_DIRECTORY:
+        os.makedirs(TEMPLATE_CACHE_DIRECTORY, exist_ok=True)
+        options["bytecode_cache"] = jinja2.FileSystemBytecodeCache(TEMPLATE_CACHE_DIRECTORY)
+    templates = Jinja2Templates(directory=TEMPLATES_DIRECTORY, **options)
+    templates.env.template_class = TimedTemplate
+    templates.env.filters["format_datetime"] = format_datetime
+    templates.env.filters["format_currency"] = format_currency
+    templates.env.filters["format_timestamp"] = format_timestamp
+    templates.env.filters["format_dollars"] = format_dollars
+    templates.env.filters["timeformat"] = timestamp_to_datetime
+    templates.env.filters["date"] = format_date
+    templates.env.globals["static_url"] = static_url
+    return templates
+
+
+# Shared by every router, so each template is compiled once per process
+templates = _create_templates()
+
+
+def precompile() -> int:
+    """
+    Load every template ahead of the first request; returns the number loaded.
+
+    Every template is tried, then a TemplateError naming the ones that
+    failed is raised, so warm-up (and the image build) fail on a broken
+    template instead of the first request that renders it.
+    """
+    loaded = 0
+    failed = []
+    for name in templates.env.list_templates(extensions=["html"]):
+        started = time.perf_counter()
+        try:
+            templates.env.get_template(name)
+        except jinja2.TemplateError as e:
+            logger.error(f"Error compiling template {name}: {str(e)}")
+            failed.append(f"{name} ({str(e)})")
+            continue
+        template_metrics.record_compile(name, time.perf_counter() - started)
+        loaded += 1
+    if failed:
+        raise jinja2.TemplateError(f"{len(failed)} templates failed to compile: {', '.join(failed)}")
+    logger.info(f"Precompiled {loaded} templates")
+    return loaded
+
+
+if __name__ == "__main__":
+    # Usage: python templating.py (fills the bytecode cache)
+    precompile()
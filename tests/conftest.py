@@ -0,0 +1,34 @@
+import os
+import sys
+import tempfile
+
+# Point the app at a throwaway SQLite database before any module imports database.py
+_db_dir = tempfile.mkdtemp(prefix="nexusforge-tests-")
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(_db_dir, 'test.db')}")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+
+@pytest.fixture(scope="session")
+def tables():
+    """Create every table in the test database once"""
+    from database import Base, engine
+    Base.metadata.create_all(bind=engine)
+    return engine
+
+
+@pytest.fixture
+def db(tables):
+    """A session on the test database; the tables are emptied afterwards"""
+    from database import Base, SessionLocal
+    session = SessionLocal()
+    try:
+        yield session
+    finally:
+        session.rollback()
+        for table in reversed(Base.metadata.sorted_tables):
+            session.execute(table.delete())
+        session.commit()
+        session.close()
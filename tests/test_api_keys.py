@@ -0,0 +1,102 @@
+import pytest
+
+from api_keys import APIKeyCache, hash_api_key, issue_api_key
+from database import APIKey
+
+
+@pytest.fixture
+def issued(db):
+    api_key, raw_key = issue_api_key(name="test", rate_limit=60, allowed_models=[])
+    db.add(api_key)
+    db.commit()
+    return api_key, raw_key
+
+
+def test_issued_key_keeps_only_a_digest(issued):
+    api_key, raw_key = issued
+    assert api_key.key is None
+    assert api_key.key_digest == hash_api_key(raw_key)
+    assert api_key.masked_key == f"{raw_key[:8]}..."
+
+
+def test_lookup_is_served_from_the_cache(db, issued):
+    api_key, raw_key = issued
+    cache = APIKeyCache()
+    assert cache.lookup(db, raw_key).id == api_key.id
+    assert cache.lookup(db, "wrong") is None
+    assert cache.lookup(db, "") is None
+
+    # A change the cache was not told about is not seen until the entry expires
+    api_key.is_active = False
+    db.commit()
+    db.expunge_all()
+    assert cache.lookup(db, raw_key).is_active is True
+
+
+def test_invalidate_forgets_the_key(db, issued):
+    api_key, raw_key = issued
+    cache = APIKeyCache()
+    cache.lookup(db, raw_key)
+
+    api_key.is_active = False
+    db.commit()
+    cache.invalidate(api_key.id)
+    db.expunge_all()
+    assert cache.lookup(db, raw_key).is_active is False
+
+
+def test_lookup_racing_an_invalidation_is_not_stored(db, issued, monkeypatch):
+    api_key, raw_key = issued
+    cache = APIKeyCache()
+    snapshot = cache._snapshot
+
+    def changed_during_lookup(row):
+        # The key is changed after the lookup read it, but before it is stored
+        cache.invalidate(row.id)
+        return snapshot(row)
+
+    monkeypatch.setattr(cache, "_snapshot", changed_during_lookup)
+    cache.lookup(db, raw_key)
+    assert cache._entries == {}
+
+
+def test_expired_entry_is_read_again(db, issued):
+    api_key, raw_key = issued
+    cache = APIKeyCache(ttl_seconds=0)
+    cache.lookup(db, raw_key)
+    api_key.name = "renamed"
+    db.commit()
+    db.expunge_all()
+    assert cache.lookup(db, raw_key).name == "renamed"
+
+
+def test_preload_caches_active_keys_up_to_the_bound(db):
+    for index in range(3):
+        api_key, _ = issue_api_key(name=f"key{index}", allowed_models=[])
+        db.add(api_key)
+    inactive, _ = issue_api_key(name="inactive", is_active=False, allowed_models=[])
+    db.add(inactive)
+    db.commit()
+
+    cache = APIKeyCache(max_entries=2)
+    assert cache.preload(db) == 2
+    assert [entry[1]["name"] for entry in cache._entries.values()] == ["key1", "key2"]
+
+
+def test_legacy_key_is_converted_on_first_use(db):
+    db.add(APIKey(key="legacy-secret", name="legacy", allowed_models=[]))
+    db.commit()
+    cache = APIKeyCache()
+
+    api_key = cache.lookup(db, "legacy-secret")
+    assert api_key.key_digest == hash_api_key("legacy-secret")
+    assert api_key.key_prefix == "legacy-s"
+
+
+def test_seeded_key_is_returned_but_never_logged(db, caplog):
+    from database import seed_db
+    caplog.set_level("DEBUG")
+    raw_key = seed_db()
+    assert db.query(APIKey).filter(APIKey.key_digest == hash_api_key(raw_key)).count() == 1
+    assert raw_key not in caplog.text
+    assert raw_key[:8] in caplog.text
@@ -0,0 +1,129 @@
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+import stripe
+
+import billing_run
+from billing_run import run_billing
+from database import BillingRun, BillingRunItem, Customer, Invoice
+
+PERIOD = (datetime(2026, 9, 1), datetime(2026, 10, 1))
+
+
+@pytest.fixture
+def customers(db, monkeypatch):
+    """Three customers owing $5, $7 and (below the minimum) $0.10"""
+    for customer_id in (1, 2, 3):
+        db.add(Customer(id=customer_id, name=f"c{customer_id}", email=f"c{customer_id}@example.com", stripe_customer_id=f"cus_{customer_id}"))
+    db.commit()
+    costs = {1: {"cost": 5.0}, 2: {"cost": 7.0}, 3: {"cost": 0.1}}
+    monkeypatch.setattr(billing_run, "get_customer_costs", lambda db, start, end: dict(costs))
+    return costs
+
+
+@pytest.fixture
+def invoicer(monkeypatch):
+    """Replaces the Stripe calls; customers listed in `failing` raise"""
+    invoicer = SimpleNamespace(calls=[], failing=set())
+
+    def invoice_customer(run_id, item_id, customer_id, stripe_customer_id, amount, description, stripe_invoice_id=None):
+        invoicer.calls.append(customer_id)
+        if customer_id in invoicer.failing:
+            raise stripe.error.APIError("boom")
+        return f"in_{customer_id}", f"https://invoices/{customer_id}"
+
+    monkeypatch.setattr(billing_run, "_invoice_customer", invoice_customer)
+    return invoicer
+
+
+def test_run_invoices_every_customer_once(db, customers, invoicer):
+    summary = run_billing(*PERIOD)
+    assert summary["status"] == "completed"
+    assert summary["invoiced"] == 2 and summary["customers"] == 3
+    assert sorted(invoicer.calls) == [1, 2]
+    assert {(row.customer_id, row.amount) for row in db.query(Invoice)} == {(1, 500), (2, 700)}
+
+    # A completed run is not repeated
+    assert run_billing(*PERIOD)["status"] == "completed"
+    assert sorted(invoicer.calls) == [1, 2]
+
+
+def test_failure_marks_only_that_item_and_resume_retries_it(db, customers, invoicer):
+    invoicer.failing = {2}
+    summary = run_billing(*PERIOD)
+    assert summary["status"] == "completed_with_errors"
+    assert summary["invoiced"] == 1 and summary["failed"] == 1
+    failed = db.query(BillingRunItem).filter_by(customer_id=2).one()
+    assert failed.status == "failed" and failed.attempts == 1 and "boom" in failed.error
+
+    # The amount checkpointed on the first run is kept, even if the ledger changed since
+    customers[2] = {"cost": 9.0}
+    invoicer.failing = set()
+    invoicer.calls.clear()
+    summary = run_billing(*PERIOD)
+    assert summary["status"] == "completed" and summary["invoiced"] == 2
+    assert invoicer.calls == [2]
+    assert db.query(Invoice).filter_by(customer_id=2).one().amount == 700
+    assert db.query(BillingRun).count() == 1
+
+
+def test_invoice_already_mirrored_from_a_webhook(db, customers, invoicer):
+    db.add(Invoice(customer_id=1, stripe_invoice_id="in_1", amount=500, status="paid", description="Invoice"))
+    db.commit()
+
+    summary = run_billing(*PERIOD)
+    assert summary["status"] == "completed" and summary["invoiced"] == 2
+    record = db.query(Invoice).filter_by(stripe_invoice_id="in_1").one()
+    assert record.status == "paid"
+    assert record.invoice_url == "https://invoices/1"
+    assert db.query(Invoice).count() == 2
+
+
+class FakeStripe:
+    """Just enough of stripe.Invoice / stripe.InvoiceItem for `_invoice_customer`"""
+
+    def __init__(self, monkeypatch):
+        self.invoices = {}
+        self.items = []
+        self.fail_item = False
+        monkeypatch.setattr(stripe, "api_key", "sk_test_unit")
+        monkeypatch.setattr(stripe.Invoice, "create", self.create_invoice)
+        monkeypatch.setattr(stripe.Invoice, "retrieve", self.invoices.__getitem__)
+        monkeypatch.setattr(stripe.Invoice, "modify", self.modify_invoice)
+        monkeypatch.setattr(stripe.InvoiceItem, "create", self.create_item)
+        monkeypatch.setattr(stripe.InvoiceItem, "list", self.list_items)
+
+    def create_invoice(self, **params):
+        invoice = stripe.Invoice.construct_from({"id": f"in_{len(self.invoices) + 1}", "auto_advance": params["auto_advance"]}, "sk")
+        self.invoices[invoice.id] = invoice
+        return invoice
+
+    def modify_invoice(self, invoice_id, **params):
+        self.invoices[invoice_id]["auto_advance"] = params["auto_advance"]
+        return self.invoices[invoice_id]
+
+    def create_item(self, **params):
+        if self.fail_item:
+            raise stripe.error.APIError("item failed")
+        self.items.append(params)
+
+    def list_items(self, invoice, limit):
+        return SimpleNamespace(data=[item for item in self.items if item["invoice"] == invoice][:limit])
+
+
+def test_resume_completes_the_checkpointed_draft(db, customers, monkeypatch):
+    fake = FakeStripe(monkeypatch)
+    fake.fail_item = True
+    assert run_billing(*PERIOD)["failed"] == 2
+    drafts = {item.customer_id: item.stripe_invoice_id for item in db.query(BillingRunItem).filter_by(status="failed")}
+    assert set(drafts) == {1, 2} and all(drafts.values())
+
+    fake.fail_item = False
+    assert run_billing(*PERIOD)["status"] == "completed"
+    # No second invoice, one line item each, and both drafts are now auto-advanced
+    assert len(fake.invoices) == 2
+    assert sorted(item["invoice"] for item in fake.items) == sorted(drafts.values())
+    assert all(invoice["auto_advance"] for invoice in fake.invoices.values())
+    db.expire_all()
+    assert {row.stripe_invoice_id for row in db.query(Invoice)} == set(drafts.values())
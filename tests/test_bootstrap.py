@@ -0,0 +1,66 @@
+import pytest
+
+import bootstrap as bootstrap_module
+from bootstrap import SchemaNotReady, bootstrap, check_schema
+from database import SCHEMA_VERSION, SchemaVersion, get_schema_version
+
+
+@pytest.fixture
+def upgrades(db, monkeypatch):
+    """Record the upgrade and seeding steps instead of migrating the shared test database"""
+    calls = []
+    monkeypatch.setattr(bootstrap_module, "_upgrade", lambda version: calls.append(("upgrade", version)))
+    monkeypatch.setattr(bootstrap_module, "seed_db", lambda: calls.append(("seed",)))
+    return calls
+
+
+def set_version(db, version):
+    db.query(SchemaVersion).delete()
+    db.add(SchemaVersion(id=1, version=version))
+    db.commit()
+
+
+def test_bootstrap_is_a_no_op_at_the_current_version(db, upgrades):
+    set_version(db, SCHEMA_VERSION)
+
+    assert bootstrap() == SCHEMA_VERSION
+    assert upgrades == []
+
+
+def test_bootstrap_upgrades_and_records_the_version(db, upgrades):
+    assert get_schema_version() is None
+
+    assert bootstrap() == SCHEMA_VERSION
+    assert upgrades == [("upgrade", None), ("seed",)]
+    assert get_schema_version() == SCHEMA_VERSION
+
+    set_version(db, 2)
+    bootstrap()
+    assert upgrades[-2:] == [("upgrade", 2), ("seed",)]
+    assert get_schema_version() == SCHEMA_VERSION
+
+
+def test_outdated_schema_is_not_ready_without_auto_bootstrap(db, upgrades, monkeypatch):
+    monkeypatch.setattr(bootstrap_module, "DATABASE_AUTO_BOOTSTRAP", False)
+    set_version(db, SCHEMA_VERSION - 1)
+
+    with pytest.raises(SchemaNotReady):
+        check_schema()
+    assert upgrades == []
+    assert get_schema_version() == SCHEMA_VERSION - 1
+
+
+def test_outdated_schema_is_bootstrapped_when_allowed(db, upgrades, monkeypatch):
+    monkeypatch.setattr(bootstrap_module, "DATABASE_AUTO_BOOTSTRAP", True)
+    set_version(db, SCHEMA_VERSION - 1)
+
+    assert check_schema() == SCHEMA_VERSION
+    assert upgrades == [("upgrade", SCHEMA_VERSION - 1), ("seed",)]
+
+
+def test_newer_schema_is_accepted(db, upgrades, monkeypatch):
+    monkeypatch.setattr(bootstrap_module, "DATABASE_AUTO_BOOTSTRAP", False)
+    set_version(db, SCHEMA_VERSION + 1)
+
+    assert check_schema() == SCHEMA_VERSION + 1
+    assert upgrades == []
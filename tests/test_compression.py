@@ -0,0 +1,100 @@
+import gzip
+import zlib
+
+import pytest
+from starlette.applications import Starlette
+from starlette.datastructures import Headers
+from starlette.responses import PlainTextResponse, Response, StreamingResponse
+from starlette.routing import Route
+from starlette.testclient import TestClient
+
+import compression
+from compression import CompressionMiddleware, accepted_encodings, choose_encoding
+
+BIG = "x" * 4096
+
+
+@pytest.fixture(autouse=True)
+def without_brotli(monkeypatch):
+    # brotli is optional; negotiate gzip whether or not it is installed
+    monkeypatch.setattr(compression, "brotli", None)
+
+
+def headers(accept_encoding):
+    return Headers({"accept-encoding": accept_encoding})
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("gzip, deflate, br", {"gzip", "deflate", "br"}),
+    ("GZIP;q=0.5, br;q=0", {"gzip"}),
+    ("gzip; q=0.0, identity", {"identity"}),
+    ("", set()),
+])
+def test_accepted_encodings(value, expected):
+    assert accepted_encodings(headers(value)) == expected
+
+
+def test_choose_encoding(monkeypatch):
+    assert choose_encoding(headers("br, gzip")) == "gzip"
+    assert choose_encoding(headers("br")) is None
+    assert choose_encoding(headers("deflate")) is None
+    monkeypatch.setattr(compression, "brotli", object())
+    assert choose_encoding(headers("gzip, br")) == "br"
+
+
+def stream_lines():
+    for i in range(50):
+        yield f'{{"line": {i}, "padding": "{"y" * 100}"}}\n'
+
+
+def make_client():
+    app = Starlette(routes=[
+        Route("/big", lambda request: PlainTextResponse(BIG)),
+        Route("/small", lambda request: PlainTextResponse("tiny")),
+        Route("/png", lambda request: Response(b"\x89PNG" + b"0" * 4096, media_type="image/png")),
+        Route("/not-modified", lambda request: Response(status_code=304, headers={"ETag": '"abc"'})),
+        Route("/events", lambda request: StreamingResponse(iter(["data: " + BIG + "\n\n"]), media_type="text/event-stream")),
+        Route("/ndjson", lambda request: StreamingResponse(stream_lines(), media_type="application/x-ndjson")),
+    ])
+    app.add_middleware(CompressionMiddleware, minimum_size=1024)
+    return TestClient(app)
+
+
+def raw_get(client, path, accept_encoding="gzip"):
+    # stream=True keeps the body as sent, without transparent decoding
+    with client.stream("GET", path, headers={"Accept-Encoding": accept_encoding}) as response:
+        return response, b"".join(response.iter_raw())
+
+
+def test_large_text_is_gzipped():
+    response, body = raw_get(make_client(), "/big")
+    assert response.headers["content-encoding"] == "gzip"
+    assert "Accept-Encoding" in response.headers["vary"]
+    assert int(response.headers["content-length"]) == len(body)
+    assert gzip.decompress(body).decode() == BIG
+
+
+@pytest.mark.parametrize("path", ["/small", "/png", "/events"])
+def test_left_alone(path):
+    response, _ = raw_get(make_client(), path)
+    assert "content-encoding" not in response.headers
+
+
+def test_not_modified_passes_through():
+    response, body = raw_get(make_client(), "/not-modified")
+    assert response.status_code == 304
+    assert "content-encoding" not in response.headers
+    assert body == b""
+
+
+def test_client_without_gzip_gets_identity():
+    response, body = raw_get(make_client(), "/big", accept_encoding="identity")
+    assert "content-encoding" not in response.headers
+    assert body.decode() == BIG
+
+
+def test_streamed_body_is_compressed():
+    response, body = raw_get(make_client(), "/ndjson")
+    assert response.headers["content-encoding"] == "gzip"
+    assert "content-length" not in response.headers
+    assert zlib.decompress(body, 31).decode() == "".join(stream_lines())
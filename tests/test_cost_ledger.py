@@ -0,0 +1,92 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from api_keys import issue_api_key
+from cost_ledger import _split_range, bucket_ceil, bucket_floor, get_customer_costs, update_cost_ledger
+from database import CostLedgerEntry, Usage
+
+HOUR = datetime(2026, 10, 1, 10)
+
+
+def test_bucket_bounds():
+    assert bucket_floor(datetime(2026, 10, 1, 10, 59, 59)) == HOUR
+    assert bucket_ceil(HOUR) == HOUR
+    assert bucket_ceil(HOUR + timedelta(microseconds=1)) == HOUR + timedelta(hours=1)
+
+
+@pytest.mark.parametrize("start, end, first, last", [
+    # Hour-aligned: all whole buckets
+    (HOUR, HOUR + timedelta(hours=3), HOUR, HOUR + timedelta(hours=3)),
+    # Partial hours at both ends
+    (HOUR + timedelta(minutes=15), HOUR + timedelta(hours=2, minutes=30), HOUR + timedelta(hours=1), HOUR + timedelta(hours=2)),
+    # Within a single bucket: no whole buckets
+    (HOUR + timedelta(minutes=5), HOUR + timedelta(minutes=50), HOUR + timedelta(hours=1), HOUR),
+])
+def test_split_range(start, end, first, last):
+    assert _split_range(start, end) == (first, last)
+
+
+@pytest.fixture
+def usage(db):
+    """Usage for two customers every 20 minutes over four hours, recorded in the ledger too"""
+    keys = []
+    for customer_id in (1, 2):
+        api_key, _ = issue_api_key(name=f"key {customer_id}", customer_id=customer_id, is_active=True)
+        db.add(api_key)
+        keys.append(api_key)
+    db.commit()
+
+    rows = []
+    for step in range(12):
+        timestamp = HOUR + timedelta(minutes=20 * step, seconds=30)
+        for api_key in keys:
+            cost = 0.01 * (step + api_key.customer_id)
+            db.add(Usage(api_key_id=api_key.id, request_type="generate", tokens_used=10, cost=cost, timestamp=timestamp))
+            update_cost_ledger(db, timestamp, api_key.customer_id, 10, cost)
+            rows.append((api_key.customer_id, timestamp, cost))
+    db.commit()
+    return rows
+
+
+def expected_costs(rows, start, end):
+    totals = {}
+    for customer_id, timestamp, cost in rows:
+        if start <= timestamp < end:
+            entry = totals.setdefault(customer_id, {"requests": 0, "tokens": 0, "cost": 0.0})
+            entry["requests"] += 1
+            entry["tokens"] += 10
+            entry["cost"] += cost
+    return totals
+
+
+@pytest.mark.parametrize("start, end", [
+    (HOUR, HOUR + timedelta(hours=4)),
+    (HOUR + timedelta(minutes=10), HOUR + timedelta(hours=3, minutes=10)),
+    (HOUR + timedelta(minutes=25), HOUR + timedelta(minutes=55)),
+    (HOUR + timedelta(hours=1), HOUR + timedelta(hours=1, minutes=1)),
+    (HOUR - timedelta(hours=1), HOUR),
+])
+def test_costs_match_raw_usage(db, usage, start, end):
+    totals = get_customer_costs(db, start, end)
+    expected = expected_costs(usage, start, end)
+    assert set(totals) == set(expected)
+    for customer_id, values in expected.items():
+        assert totals[customer_id]["requests"] == values["requests"]
+        assert totals[customer_id]["tokens"] == values["tokens"]
+        assert totals[customer_id]["cost"] == pytest.approx(values["cost"])
+
+
+def test_whole_buckets_come_from_the_ledger(db, usage):
+    # A ledger-only adjustment is seen by whole-bucket ranges but not by partial ones
+    db.add(CostLedgerEntry(customer_id=1, bucket_start=HOUR + timedelta(hours=5), request_count=1, tokens_used=0, cost=5.0))
+    db.commit()
+
+    whole = get_customer_costs(db, HOUR + timedelta(hours=5), HOUR + timedelta(hours=6), customer_id=1)
+    partial = get_customer_costs(db, HOUR + timedelta(hours=5, minutes=1), HOUR + timedelta(hours=6), customer_id=1)
+    assert whole == {1: {"requests": 1, "tokens": 0, "cost": 5.0}}
+    assert partial == {}
+
+
+def test_empty_range(db, usage):
+    assert get_customer_costs(db, HOUR, HOUR) == {}
@@ -0,0 +1,60 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from api_keys import issue_api_key
+from dashboard_service import DASHBOARD_WINDOW_DAYS, DashboardService
+from database import AIModel, Customer, Usage
+
+
+@pytest.fixture
+def customer(db):
+    """A customer with a used key, an unused key and a key of another customer"""
+    db.add(Customer(id=1, name="c1", email="c1@example.com"))
+    db.add(Customer(id=2, name="c2", email="c2@example.com"))
+    db.add(AIModel(id=1, name="GPT-4", model_type="openai", model_name="gpt-4"))
+    keys = []
+    for name, customer_id in (("used", 1), ("unused", 1), ("other", 2)):
+        api_key, _ = issue_api_key(name=name, customer_id=customer_id)
+        db.add(api_key)
+        keys.append(api_key)
+    db.commit()
+
+    now = datetime.utcnow()
+    for days_ago, tokens in ((0, 10), (0, 20), (2, 5)):
+        db.add(Usage(api_key_id=keys[0].id, model_id=1, request_type="generate", tokens_used=tokens, cost=tokens / 100, timestamp=now - timedelta(days=days_ago)))
+    # Outside the window, and another customer's usage
+    db.add(Usage(api_key_id=keys[0].id, model_id=1, request_type="generate", tokens_used=1000, cost=1.0, timestamp=now - timedelta(days=DASHBOARD_WINDOW_DAYS + 40)))
+    db.add(Usage(api_key_id=keys[2].id, model_id=1, request_type="generate", tokens_used=500, cost=5.0, timestamp=now))
+    db.commit()
+    return keys
+
+
+def test_aggregates_the_window(db, customer):
+    data = DashboardService().get_customer_usage(db, 1)
+    assert data["total_tokens"] == 35
+    assert data["total_cost"] == pytest.approx(0.35)
+    assert data["model_usage"] == [{"name": "GPT-4", "tokens": 35, "cost": pytest.approx(0.35)}]
+    assert len(data["daily_usage"]) == DASHBOARD_WINDOW_DAYS
+    assert data["daily_usage"][-1]["tokens"] == 30 and data["daily_usage"][-3]["tokens"] == 5
+    assert data["daily_requests"][-1]["requests"] == 2
+
+
+def test_every_key_is_listed_even_without_usage(db, customer):
+    used, unused, _ = customer
+    data = DashboardService().get_customer_usage(db, 1)
+    assert data["key_usage"] == [
+        {"id": used.id, "name": "used", "tokens": 35},
+        {"id": unused.id, "name": "unused", "tokens": 0},
+    ]
+    assert DashboardService().get_customer_usage(db, 3)["key_usage"] == []
+
+
+def test_cached_until_invalidated(db, customer):
+    service = DashboardService()
+    assert service.get_customer_usage(db, 1)["total_tokens"] == 35
+    db.add(Usage(api_key_id=customer[0].id, model_id=1, request_type="generate", tokens_used=7, cost=0.07, timestamp=datetime.utcnow()))
+    db.commit()
+    assert service.get_customer_usage(db, 1)["total_tokens"] == 35
+    service.invalidate(1)
+    assert service.get_customer_usage(db, 1)["total_tokens"] == 42
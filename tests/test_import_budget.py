@@ -0,0 +1,13 @@
+import os
+import subprocess
+import sys
+
+import lazy_imports
+from lazy_imports import check_import_budget
+
+
+def test_import_main_is_within_budget(tmp_path, monkeypatch):
+    # A database of its own, bootstrapped first so the measured import does no seeding
+    monkeypatch.setenv("DATABASE_URL", f"sqlite:///{tmp_path / 'import.db'}")
+    subprocess.run([sys.executable, "bootstrap.py"], check=True, capture_output=True, cwd=os.path.dirname(lazy_imports.__file__))
+    assert check_import_budget("main") == []
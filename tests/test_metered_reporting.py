@@ -0,0 +1,150 @@
+import json
+import threading
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+import pytest
+import stripe
+
+from cost_ledger import update_cost_ledger
+from database import Customer, MeteredSubscriptionItem, MeteredUsageReport, MeteredUsageWatermark
+from metered_reporting import MeteredUsageReporter
+
+HOUR = datetime(2026, 10, 1, 10)
+
+
+class StripeStandIn(ThreadingHTTPServer):
+    """
+    Local stand-in for the usage record endpoint, reached through the real
+    Stripe client. Like Stripe, it replays the first response for a repeated
+    idempotency key, and action="set" replaces a bucket's quantity.
+    """
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), _Handler)
+        self.requests = []
+        self.usage = {}
+        self.responses = {}
+        self.fail_next = 0
+        self.lock = threading.Lock()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        server = self.server
+        params = {key: values[0] for key, values in parse_qs(self.rfile.read(int(self.headers["Content-Length"])).decode()).items()}
+        item_id = self.path.split("/")[3]
+        key = self.headers.get("Idempotency-Key")
+        with server.lock:
+            server.requests.append({"item": item_id, "key": key, **params})
+            if key in server.responses:
+                status, body = server.responses[key]
+            elif server.fail_next:
+                server.fail_next -= 1
+                status, body = 500, {"error": {"type": "api_error", "message": "stand-in failure"}}
+            else:
+                assert params["action"] == "set"
+                server.usage[(item_id, int(params["timestamp"]))] = int(params["quantity"])
+                status, body = 200, {"id": f"mbur_{len(server.requests)}", "object": "usage_record", "quantity": int(params["quantity"])}
+                server.responses[key] = (status, body)
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stripe_stand_in(monkeypatch):
+    server = StripeStandIn()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(stripe, "api_key", "sk_test_unit")
+    monkeypatch.setattr(stripe, "api_base", f"http://127.0.0.1:{server.server_port}")
+    monkeypatch.setattr(stripe, "max_network_retries", 0)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def subscribed(db):
+    """A customer with an active metered item, and usage in two closed hours and the current one"""
+    db.add(Customer(id=1, name="c1", email="c1@example.com", stripe_customer_id="cus_1"))
+    db.add(MeteredSubscriptionItem(customer_id=1, stripe_subscription_id="sub_1", stripe_subscription_item_id="si_1", created_at=HOUR - timedelta(days=1)))
+    for timestamp, tokens in ((HOUR, 100), (HOUR + timedelta(minutes=30), 50), (HOUR + timedelta(hours=1), 70), (HOUR + timedelta(hours=2), 10)):
+        update_cost_ledger(db, timestamp, 1, tokens, 0.0)
+    db.commit()
+
+
+def unix(timestamp):
+    return int((timestamp - datetime(1970, 1, 1)).total_seconds())
+
+
+def test_closed_buckets_are_reported_and_the_watermark_advances(db, stripe_stand_in, subscribed):
+    reporter = MeteredUsageReporter(lag_seconds=0)
+    now = HOUR + timedelta(hours=2, minutes=5)
+
+    result = reporter.run_once(now)
+    assert result["queued"] == 2 and result["reported"] == 2 and result["failed"] == 0
+    assert stripe_stand_in.usage == {("si_1", unix(HOUR)): 150, ("si_1", unix(HOUR + timedelta(hours=1))): 70}
+    assert db.query(MeteredUsageWatermark).one().queued_until == HOUR + timedelta(hours=2)
+
+    # The open bucket is reported once it closes
+    result = reporter.run_once(now + timedelta(hours=1))
+    assert result["queued"] == 1 and result["reported"] == 1
+    assert stripe_stand_in.usage[("si_1", unix(HOUR + timedelta(hours=2)))] == 10
+    db.expire_all()
+    assert db.query(MeteredUsageWatermark).one().queued_until == HOUR + timedelta(hours=3)
+
+
+def test_failed_report_is_resent_with_the_same_idempotency_key(db, stripe_stand_in, subscribed):
+    reporter = MeteredUsageReporter(lag_seconds=0, concurrency=1)
+    stripe_stand_in.fail_next = 1
+    now = HOUR + timedelta(hours=2)
+
+    result = reporter.run_once(now)
+    assert result["reported"] == 1 and result["failed"] == 1
+    failed = db.query(MeteredUsageReport).filter_by(status="failed").one()
+    assert failed.attempts == 1 and "stand-in failure" in failed.error
+    first_key = next(request["key"] for request in stripe_stand_in.requests if int(request["timestamp"]) == unix(failed.bucket_start))
+
+    result = reporter.run_once(now)
+    assert (result["queued"], result["reported"], result["failed"]) == (0, 1, 0)
+    resent = [request for request in stripe_stand_in.requests if int(request["timestamp"]) == unix(failed.bucket_start)]
+    assert len(resent) == 2
+    assert {request["key"] for request in resent} == {first_key}
+    assert {request["action"] for request in resent} == {"set"}
+    assert len(stripe_stand_in.usage) == 2
+
+
+def test_nothing_is_reported_twice(db, stripe_stand_in, subscribed):
+    reporter = MeteredUsageReporter(lag_seconds=0)
+    now = HOUR + timedelta(hours=2)
+    reporter.run_once(now)
+    sent = len(stripe_stand_in.requests)
+
+    # Same cutoff again: nothing queued, nothing sent
+    result = reporter.run_once(now)
+    assert (result["queued"], result["reported"], result["failed"]) == (0, 0, 0)
+    assert len(stripe_stand_in.requests) == sent
+    assert db.query(MeteredUsageReport).count() == 2
+
+    # A report resent after a crash (sent, but not marked reported) replays the same record
+    db.query(MeteredUsageReport).update({"status": "pending"})
+    db.commit()
+    assert reporter.run_once(now)["reported"] == 2
+    assert stripe_stand_in.usage == {("si_1", unix(HOUR)): 150, ("si_1", unix(HOUR + timedelta(hours=1))): 70}
+    assert len(stripe_stand_in.responses) == 2
+
+
+def test_usage_from_before_the_subscription_is_not_reported(db, stripe_stand_in, subscribed):
+    db.query(MeteredSubscriptionItem).update({"created_at": HOUR + timedelta(hours=1, minutes=10)})
+    db.commit()
+    MeteredUsageReporter(lag_seconds=0).run_once(HOUR + timedelta(hours=2))
+    assert list(stripe_stand_in.usage) == [("si_1", unix(HOUR + timedelta(hours=1)))]
@@ -0,0 +1,169 @@
+import contextlib
+import threading
+import time
+import types
+
+import pytest
+
+import model_manager
+from model_manager import ModelBatcher, ModelBusy, _GenerationRequest
+
+
+class FakeTensor:
+    """Just enough of a 2-D torch tensor for ModelBatcher"""
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    @property
+    def shape(self):
+        return (len(self.rows), len(self.rows[0]))
+
+    def sum(self, dim):
+        return types.SimpleNamespace(tolist=lambda: [sum(row) for row in self.rows])
+
+    def __getitem__(self, index):
+        return self.rows[index]
+
+
+class FakeTokenizer:
+    """One token per character, left padding with id 0"""
+
+    pad_token = None
+    eos_token = "<eos>"
+    pad_token_id = 0
+    padding_side = "right"
+
+    def __call__(self, texts, **kwargs):
+        ids = [[ord(char) for char in text] for text in texts]
+        width = max(len(row) for row in ids)
+        return {
+            "input_ids": FakeTensor([[0] * (width - len(row)) + row for row in ids]),
+            "attention_mask": FakeTensor([[0] * (width - len(row)) + [1] * len(row) for row in ids])
+        }
+
+    def decode(self, tokens, skip_special_tokens=True):
+        return "".join(chr(token) for token in tokens)
+
+
+class FakeModel:
+    """Appends "a", "b", "c", ... to every row and records each generate() call"""
+
+    def __init__(self):
+        self.calls = []
+
+    def generate(self, input_ids, attention_mask, max_new_tokens, pad_token_id, **options):
+        self.calls.append({"rows": len(input_ids.rows), "max_new_tokens": max_new_tokens, **options})
+        new_tokens = [ord("a") + i for i in range(max_new_tokens)]
+        return [row + new_tokens for row in input_ids.rows]
+
+
+@pytest.fixture(autouse=True)
+def fake_torch(monkeypatch):
+    monkeypatch.setattr(model_manager, "torch", types.SimpleNamespace(inference_mode=contextlib.nullcontext))
+
+
+def make_batcher(**kwargs):
+    options = {"max_batch_size": 4, "window_ms": 0, "max_pending": 16}
+    options.update(kwargs)
+    return ModelBatcher(1, FakeModel(), FakeTokenizer(), threading.Lock(), **options)
+
+
+def queue(batcher, prompt, max_length=10, **options):
+    request = _GenerationRequest(prompt, max_length, tuple(sorted(options.items())))
+    batcher._pending.append(request)
+    return request
+
+
+def test_tokenizer_is_set_up_for_left_padding():
+    batcher = make_batcher()
+    assert batcher.tokenizer.padding_side == "left"
+    assert batcher.tokenizer.pad_token == "<eos>"
+
+
+def test_batch_is_capped_at_max_size():
+    batcher = make_batcher(max_batch_size=3)
+    requests = [queue(batcher, f"p{i}", temperature=0.7) for i in range(5)]
+    assert batcher._next_batch() == requests[:3]
+    assert batcher._next_batch() == requests[3:]
+
+
+def test_only_matching_options_share_a_batch():
+    batcher = make_batcher()
+    a1 = queue(batcher, "a1", temperature=0.7)
+    b1 = queue(batcher, "b1", temperature=0.9)
+    a2 = queue(batcher, "a2", temperature=0.7)
+    b2 = queue(batcher, "b2", temperature=0.9)
+    assert batcher._next_batch() == [a1, a2]
+    # The skipped requests keep their order
+    assert batcher._next_batch() == [b1, b2]
+
+
+def test_window_collects_late_arrivals():
+    batcher = make_batcher(window_ms=200)
+    first = queue(batcher, "first")
+
+    def arrive_late():
+        time.sleep(0.05)
+        with batcher._condition:
+            queue(batcher, "late")
+            batcher._condition.notify()
+
+    thread = threading.Thread(target=arrive_late)
+    thread.start()
+    batch = batcher._next_batch()
+    thread.join()
+    assert [request.prompt for request in batch] == ["first", "late"]
+    assert batch[0] is first
+
+
+def test_stopped_batcher_returns_no_batch():
+    batcher = make_batcher()
+    request = queue(batcher, "p")
+    batcher.stop()
+    assert batcher._next_batch() == []
+    with pytest.raises(RuntimeError):
+        request.future.result(timeout=1)
+
+
+def test_outputs_are_sliced_to_each_prompts_budget():
+    batcher = make_batcher()
+    # max_length counts the prompt: budgets are 3, 1 and 0 new tokens
+    batch = [
+        _GenerationRequest("ab", 5, (("temperature", 0.7),)),
+        _GenerationRequest("abcd", 5, (("temperature", 0.7),)),
+        _GenerationRequest("abcdef", 5, (("temperature", 0.7),))
+    ]
+    assert batcher._generate(batch) == ["abc", "a", ""]
+    assert batcher.model.calls == [{"rows": 3, "max_new_tokens": 3, "temperature": 0.7}]
+
+
+def test_no_generate_call_without_budget():
+    batcher = make_batcher()
+    assert batcher._generate([_GenerationRequest("abcdef", 3, ())]) == [""]
+    assert batcher.model.calls == []
+
+
+def test_submit_scatters_results():
+    batcher = make_batcher(window_ms=50)
+    results = {}
+
+    def submit(prompt, max_length):
+        results[prompt] = batcher.submit(prompt, max_length, temperature=0.7)
+
+    threads = [threading.Thread(target=submit, args=(f"p{i}", 3 + i)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=5)
+    batcher.stop()
+
+    assert results == {"p0": "a", "p1": "ab", "p2": "abc", "p3": "abcd"}
+    assert batcher.metrics()["requests"] == 4
+
+
+def test_full_queue_raises_model_busy():
+    batcher = make_batcher(max_pending=1)
+    queue(batcher, "waiting")
+    with pytest.raises(ModelBusy):
+        batcher.submit("p", 10)
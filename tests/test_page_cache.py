@@ -0,0 +1,99 @@
+import asyncio
+from types import SimpleNamespace
+
+import jinja2
+import pytest
+from starlette.requests import Request
+
+import page_cache as page_cache_module
+from page_cache import PageCache
+
+
+@pytest.fixture(autouse=True)
+def page_templates(monkeypatch):
+    env = jinja2.Environment(loader=jinja2.DictLoader({
+        "page.html": "<h1>{{ user.username if user else 'guest' }} {{ plan | default('') }}</h1>"
+    }))
+    monkeypatch.setattr(page_cache_module, "templates", SimpleNamespace(get_template=env.get_template))
+
+
+def make_request(path="/pricing", if_none_match=None):
+    headers = [(b"if-none-match", if_none_match.encode())] if if_none_match else []
+    return Request({"type": "http", "method": "GET", "path": path, "query_string": b"", "headers": headers})
+
+
+def render(cache, request, user=None, context=None, version=None):
+    return asyncio.run(cache.render(request, "page.html", user=user, context=context, version=version))
+
+
+def test_context_is_only_loaded_on_a_miss():
+    cache = PageCache()
+    loads = []
+
+    async def context():
+        loads.append(1)
+        return {"plan": "pro"}
+
+    first = render(cache, make_request(), context=context)
+    second = render(cache, make_request(), context=context)
+
+    assert first.body == second.body == b"<h1>guest pro</h1>"
+    assert loads == [1]
+    assert cache.stats() == {"entries": 1, "hits": 1, "misses": 1}
+
+
+def test_signed_in_viewers_get_their_own_copy():
+    cache = PageCache()
+    alice = SimpleNamespace(id=1, username="alice", role="user")
+
+    anonymous = render(cache, make_request())
+    signed_in = render(cache, make_request(), user=alice)
+    renamed = render(cache, make_request(), user=SimpleNamespace(id=1, username="alicia", role="user"))
+
+    assert anonymous.body == b"<h1>guest </h1>"
+    assert signed_in.body == b"<h1>alice </h1>"
+    assert renamed.body == b"<h1>alicia </h1>"
+    assert anonymous.headers["cache-control"] == "no-cache"
+    assert signed_in.headers["cache-control"] == "private, no-cache"
+
+
+def test_matching_etag_gets_not_modified():
+    cache = PageCache()
+    etag = render(cache, make_request()).headers["etag"]
+
+    assert render(cache, make_request(if_none_match=etag)).status_code == 304
+    assert render(cache, make_request(if_none_match=f"W/{etag}")).status_code == 304
+    assert render(cache, make_request(if_none_match='"stale"')).status_code == 200
+
+
+def test_entries_expire_and_are_purged():
+    cache = PageCache(ttl_seconds=0)
+    render(cache, make_request())
+    render(cache, make_request())
+    assert cache.stats()["hits"] == 0
+
+    cache = PageCache()
+    render(cache, make_request("/pricing"))
+    render(cache, make_request("/docs"))
+    cache.fragment("pricing-table", lambda: "<table></table>")
+
+    assert cache.purge("/pricing") == 1
+    assert cache.purge() == 2
+
+
+def test_least_recently_used_entries_are_dropped():
+    cache = PageCache(max_entries=2)
+    cache.fragment("a", lambda: "a")
+    cache.fragment("b", lambda: "b")
+    cache.fragment("a", lambda: "stale")
+    cache.fragment("c", lambda: "c")
+
+    assert cache.fragment("a", lambda: "new a") == "a"
+    assert cache.fragment("b", lambda: "new b") == "new b"
+
+
+def test_fragment_versions_are_separate_entries():
+    cache = PageCache()
+    assert cache.fragment("pricing-table", lambda: "<b>v1</b>", version=1) == "<b>v1</b>"
+    assert cache.fragment("pricing-table", lambda: "<b>v2</b>", version=1) == "<b>v1</b>"
+    assert cache.fragment("pricing-table", lambda: "<b>v2</b>", version=2) == "<b>v2</b>"
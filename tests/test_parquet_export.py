@@ -0,0 +1,82 @@
+import os
+from datetime import datetime, timedelta
+
+import pytest
+
+pq = pytest.importorskip("pyarrow.parquet")
+
+import parquet_export
+from api_keys import issue_api_key
+from database import ExportWatermark, Usage
+from parquet_export import export_usage_parquet
+
+DAY = datetime(2026, 10, 1, 12)
+
+
+@pytest.fixture
+def usage(db):
+    """Two customers' usage over two days, plus two rows without a timestamp"""
+    ids = []
+    for customer_id in (1, 2):
+        api_key, _ = issue_api_key(name=f"key {customer_id}", customer_id=customer_id)
+        db.add(api_key)
+        db.commit()
+        for step in range(5):
+            row = Usage(api_key_id=api_key.id, request_type="generate", tokens_used=step, cost=0.0, timestamp=DAY + timedelta(hours=6 * step))
+            db.add(row)
+            db.commit()
+            ids.append(row.id)
+    db.query(Usage).filter(Usage.id.in_(ids[:2])).update({"timestamp": None}, synchronize_session=False)
+    db.commit()
+    return ids
+
+
+def read(output_dir):
+    """Every exported row as (day, customer_id, id)"""
+    rows = []
+    for directory, _, files in os.walk(os.path.join(output_dir, "usage")):
+        for file in files:
+            day, customer = directory.split(os.sep)[-2:]
+            for row_id in pq.read_table(os.path.join(directory, file)).column("id").to_pylist():
+                rows.append((day.split("=")[1], customer.split("=")[1], row_id))
+    return sorted(rows, key=lambda row: row[2])
+
+
+def test_export_partitions_by_day_and_customer(db, usage, tmp_path):
+    result = export_usage_parquet(output_dir=str(tmp_path), chunk_size=3)
+    assert result["total_rows"] == 10 and result["chunks"] == 4
+
+    rows = read(str(tmp_path))
+    assert [row[2] for row in rows] == sorted(usage)
+    assert rows[0][:2] == (parquet_export.NULL_PARTITION, "1")
+    assert ("2026-10-02", "2", usage[-1]) in rows
+    files = [name for _, _, names in os.walk(str(tmp_path)) for name in names]
+    # Named after this export, so other time ranges can share the directory
+    assert set(files) == {parquet_export._part_name(result["name"], f"{chunk:06d}") for chunk in range(4)}
+
+
+def test_interrupted_export_resumes_without_duplicates(db, usage, tmp_path, monkeypatch):
+    write_chunk = parquet_export._write_chunk
+
+    def fail_on_third_chunk(pa, pq, schema, rows, output_dir, source, name, chunk_index):
+        if chunk_index == 2:
+            raise OSError("disk full")
+        return write_chunk(pa, pq, schema, rows, output_dir, source, name, chunk_index)
+
+    monkeypatch.setattr(parquet_export, "_write_chunk", fail_on_third_chunk)
+    with pytest.raises(OSError):
+        export_usage_parquet(output_dir=str(tmp_path), chunk_size=3)
+    watermark = db.query(ExportWatermark).one()
+    assert watermark.chunk_count == 2 and watermark.row_count == 6 and watermark.completed_at is None
+
+    monkeypatch.setattr(parquet_export, "_write_chunk", write_chunk)
+    result = export_usage_parquet(output_dir=str(tmp_path), chunk_size=3)
+    assert result["rows_written"] == 4 and result["total_rows"] == 10
+    assert [row[2] for row in read(str(tmp_path))] == sorted(usage)
+
+
+def test_restart_replaces_the_earlier_files(db, usage, tmp_path):
+    export_usage_parquet(output_dir=str(tmp_path), chunk_size=4)
+    result = export_usage_parquet(output_dir=str(tmp_path), chunk_size=3, resume=False)
+    assert result["rows_written"] == 10 and result["chunks"] == 4
+    assert [row[2] for row in read(str(tmp_path))] == sorted(usage)
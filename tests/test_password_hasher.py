@@ -0,0 +1,53 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from fastapi import HTTPException
+from passlib.context import CryptContext
+
+import auth
+from password_hasher import BCRYPT_ROUNDS, PasswordHasher, PasswordHasherBusy, pwd_context
+
+
+@pytest.fixture(scope="module")
+def hasher():
+    hasher = PasswordHasher(max_workers=1, max_pending=4)
+    yield hasher
+    hasher.shutdown()
+
+
+def test_hash_and_verify_on_the_pool(hasher):
+    async def scenario():
+        hashed = await hasher.hash("s3cret")
+        return hashed, await hasher.verify_and_update("s3cret", hashed), await hasher.verify_and_update("wrong", hashed)
+
+    hashed, valid, invalid = asyncio.run(scenario())
+    assert pwd_context.verify("s3cret", hashed)
+    assert valid == (True, None)
+    assert invalid == (False, None)
+    assert hasher._pending == 0
+
+
+def test_outdated_cost_is_upgraded_on_login(hasher, monkeypatch):
+    monkeypatch.setattr(auth, "password_hasher", hasher)
+    cheap = CryptContext(schemes=["bcrypt"], bcrypt__rounds=4).hash("s3cret")
+    user = SimpleNamespace(hashed_password=cheap)
+
+    assert asyncio.run(auth.verify_password_async(None, user, "s3cret")) is True
+    assert user.hashed_password != cheap
+    assert f"${BCRYPT_ROUNDS:02d}$" in user.hashed_password
+    assert pwd_context.verify("s3cret", user.hashed_password)
+
+
+def test_calls_beyond_the_backlog_are_rejected(monkeypatch):
+    busy = PasswordHasher(max_workers=1, max_pending=0)
+    with pytest.raises(PasswordHasherBusy):
+        asyncio.run(busy.hash("s3cret"))
+    # No worker processes were started for the rejected call
+    assert busy._executor is None
+
+    monkeypatch.setattr(auth, "password_hasher", busy)
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(auth.get_password_hash_async("s3cret"))
+    assert error.value.status_code == 503
+    assert error.value.headers["Retry-After"] == "1"
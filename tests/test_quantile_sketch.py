@@ -0,0 +1,99 @@
+import math
+import random
+
+import pytest
+
+from quantile_sketch import DDSketch
+
+
+def exact_quantile(values, q):
+    """Same rank convention as DDSketch.quantile: the value at rank q * (n - 1)"""
+    ordered = sorted(values)
+    return ordered[int(math.floor(q * (len(ordered) - 1)))]
+
+
+@pytest.mark.parametrize("q", [0.01, 0.25, 0.5, 0.9, 0.95, 0.99])
+def test_quantiles_within_relative_accuracy(q):
+    rng = random.Random(42)
+    values = [rng.lognormvariate(-2, 1.5) for _ in range(20000)]
+    sketch = DDSketch(relative_accuracy=0.01)
+    for value in values:
+        sketch.add(value)
+
+    expected = exact_quantile(values, q)
+    assert abs(sketch.quantile(q) - expected) <= 0.01 * expected + 1e-12
+
+
+def test_merge_equals_single_sketch():
+    rng = random.Random(7)
+    values = [rng.expovariate(5) for _ in range(5000)]
+    whole = DDSketch()
+    parts = [DDSketch() for _ in range(4)]
+    for i, value in enumerate(values):
+        whole.add(value)
+        parts[i % 4].add(value)
+
+    merged = DDSketch()
+    for part in parts:
+        merged.merge(part)
+
+    assert merged.bins == whole.bins
+    assert merged.count == whole.count
+    assert merged.min == whole.min and merged.max == whole.max
+    assert merged.sum == pytest.approx(whole.sum)
+    for q in (0.5, 0.95, 0.99):
+        assert merged.quantile(q) == whole.quantile(q)
+
+
+def test_merge_rejects_different_accuracy():
+    a = DDSketch(relative_accuracy=0.01)
+    b = DDSketch(relative_accuracy=0.05)
+    b.add(1.0)
+    with pytest.raises(ValueError):
+        a.merge(b)
+
+
+def test_merge_of_empty_sketch_is_noop():
+    sketch = DDSketch()
+    sketch.add(0.5)
+    sketch.merge(DDSketch(relative_accuracy=0.05))
+    assert sketch.count == 1
+
+
+def test_zero_and_extreme_quantiles():
+    sketch = DDSketch()
+    assert sketch.quantile(0.5) is None
+    for value in (0.0, 0.0, 0.0, 2.0):
+        sketch.add(value)
+    assert sketch.quantile(0.5) == 0.0
+    assert sketch.quantile(0) == 0.0
+    assert sketch.quantile(1) == 2.0
+
+
+def test_estimates_stay_within_min_and_max():
+    sketch = DDSketch()
+    sketch.add(1.0)
+    assert sketch.quantile(0.5) == 1.0
+
+
+def test_collapse_keeps_count_and_high_quantiles():
+    sketch = DDSketch(max_bins=64)
+    values = [10 ** (i / 100) for i in range(-600, 300)]
+    for value in values:
+        sketch.add(value)
+
+    assert len(sketch.bins) <= 64
+    assert sum(sketch.bins.values()) + sketch.zero_count == sketch.count == len(values)
+    # Only the lowest bins are folded, so upper quantiles keep their guarantee
+    expected = exact_quantile(values, 0.99)
+    assert abs(sketch.quantile(0.99) - expected) <= 0.01 * expected
+
+
+def test_round_trip_through_dict():
+    sketch = DDSketch()
+    for value in (0.0, 0.1, 0.2, 5.0):
+        sketch.add(value)
+    restored = DDSketch.from_dict(sketch.to_dict())
+    assert restored.to_dict() == sketch.to_dict()
+    assert restored.quantile(0.5) == sketch.quantile(0.5)
+    assert DDSketch.from_dict(None).count == 0
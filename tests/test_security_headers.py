@@ -0,0 +1,37 @@
+import pytest
+from starlette.applications import Starlette
+from starlette.responses import PlainTextResponse
+from starlette.routing import Route
+from starlette.testclient import TestClient
+
+from security_middleware import SecurityHeadersMiddleware
+
+
+async def endpoint(request):
+    return PlainTextResponse("ok", headers={"Cache-Control": "public, max-age=3600"})
+
+
+@pytest.fixture(scope="module")
+def client():
+    app = Starlette(routes=[Route("/{path:path}", endpoint, methods=["GET", "POST"])])
+    app.add_middleware(SecurityHeadersMiddleware)
+    return TestClient(app)
+
+
+@pytest.mark.parametrize("path", [
+    "/login", "/register", "/logout", "/token", "/account-settings",
+    "/api/login", "/api/register", "/api/users/me", "/api/keys", "/api/keys/create", "/api-key",
+    "/admin/api-keys", "/dashboard", "/api/dashboard/stream",
+])
+def test_sensitive_paths_are_not_cached(client, path):
+    response = client.post(path)
+    assert response.headers["cache-control"] == "no-store, no-cache, must-revalidate, max-age=0"
+    assert response.headers["pragma"] == "no-cache"
+
+
+@pytest.mark.parametrize("path", ["/", "/landing", "/static/app.css", "/api/v1/models"])
+def test_other_paths_keep_their_cache_headers(client, path):
+    response = client.get(path)
+    assert response.headers["cache-control"] == "public, max-age=3600"
+    assert response.headers["x-content-type-options"] == "nosniff"
+    assert "content-security-policy" in response.headers
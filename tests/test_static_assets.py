@@ -0,0 +1,84 @@
+import gzip
+import os
+
+import pytest
+from starlette.applications import Starlette
+from starlette.routing import Mount
+from starlette.testclient import TestClient
+
+from static_assets import IMMUTABLE_CACHE_CONTROL, AssetManifest, PrecompressedStaticFiles
+
+CSS = "body { color: #333; }\n" * 200
+
+
+@pytest.fixture
+def static_dir(tmp_path):
+    (tmp_path / "css").mkdir()
+    (tmp_path / "css" / "site.css").write_text(CSS)
+    return tmp_path
+
+
+@pytest.fixture
+def manifest(static_dir):
+    return AssetManifest(directory=str(static_dir))
+
+
+@pytest.fixture
+def client(static_dir, manifest):
+    files = PrecompressedStaticFiles(directory=str(static_dir), manifest=manifest, max_age=60)
+    return TestClient(Starlette(routes=[Mount("/static", app=files)]))
+
+
+def test_url_carries_content_hash(manifest):
+    url = manifest.url("css/site.css")
+    fingerprint = manifest.fingerprint("css/site.css")
+    assert url == f"/static/css/site.css?v={fingerprint}"
+    assert manifest.url("missing.css") == "/static/missing.css"
+
+
+def test_fingerprint_follows_file_changes(static_dir, manifest):
+    before = manifest.fingerprint("css/site.css")
+    path = static_dir / "css" / "site.css"
+    path.write_text(CSS + "a { color: red; }\n")
+    os.utime(path, ns=(path.stat().st_mtime_ns + 10**9,) * 2)
+    assert manifest.fingerprint("css/site.css") != before
+
+
+def test_strong_etag_and_revalidation(client, manifest):
+    response = client.get("/static/css/site.css", headers={"Accept-Encoding": "identity"})
+    etag = response.headers["etag"]
+    assert etag == f'"{manifest.fingerprint("css/site.css")}"'
+    assert response.headers["cache-control"] == "public, max-age=60"
+
+    again = client.get("/static/css/site.css", headers={"Accept-Encoding": "identity", "If-None-Match": etag})
+    assert again.status_code == 304
+
+
+def test_immutable_only_for_current_version(client, manifest):
+    current = client.get(manifest.url("css/site.css"))
+    assert current.headers["cache-control"] == IMMUTABLE_CACHE_CONTROL
+
+    outdated = client.get("/static/css/site.css?v=0000000000000000")
+    assert outdated.headers["cache-control"] == "public, max-age=60"
+
+
+def test_precompressed_sibling_has_its_own_etag(static_dir, client, manifest):
+    sibling = static_dir / "css" / "site.css.gz"
+    sibling.write_bytes(gzip.compress(CSS.encode()))
+
+    with client.stream("GET", "/static/css/site.css", headers={"Accept-Encoding": "gzip"}) as response:
+        body = b"".join(response.iter_raw())
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.headers["etag"] == f'"{manifest.fingerprint("css/site.css")}-gzip"'
+    assert gzip.decompress(body).decode() == CSS
+
+
+def test_stale_sibling_is_ignored(static_dir, client):
+    sibling = static_dir / "css" / "site.css.gz"
+    sibling.write_bytes(gzip.compress(b"old"))
+    original = static_dir / "css" / "site.css"
+    os.utime(sibling, ns=(original.stat().st_mtime_ns - 10**9,) * 2)
+
+    response = client.get("/static/css/site.css", headers={"Accept-Encoding": "gzip"})
+    assert "content-encoding" not in response.headers
+    assert response.text == CSS
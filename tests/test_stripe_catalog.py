@@ -0,0 +1,94 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+import stripe_catalog as catalog_module
+from stripe_catalog import StripeCatalog, landing_products
+
+
+class FakeFetch:
+    """Stands in for the two Stripe list calls; each call returns a new snapshot"""
+
+    def __init__(self):
+        self.calls = 0
+        self.during = None
+
+    def __call__(self):
+        self.calls += 1
+        if self.during is not None:
+            self.during()
+        return [{"id": f"prod_{self.calls}", "prices": []}]
+
+
+@pytest.fixture
+def catalog(monkeypatch):
+    catalog = StripeCatalog(ttl=60)
+    fetch = FakeFetch()
+    monkeypatch.setattr(catalog, "_fetch", fetch)
+    catalog.fetch = fetch
+    return catalog
+
+
+def wait_for(condition):
+    deadline = time.monotonic() + 2
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_first_read_loads_once_for_concurrent_callers(catalog):
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(catalog.get_products())) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert catalog.fetch.calls == 1
+    assert all(result is results[0] for result in results)
+    assert catalog.version == 1
+
+
+def test_stale_snapshot_is_served_while_refreshing_in_background(catalog):
+    first = catalog.get_products()
+    assert catalog.get_products() is first and catalog.fetch.calls == 1
+
+    catalog.invalidate()
+    assert catalog.get_products() is first
+    wait_for(lambda: catalog.fetch.calls == 2 and not catalog._refreshing)
+    assert catalog.get_products()[0]["id"] == "prod_2"
+    assert catalog.version == 2
+
+
+def test_invalidation_during_a_fetch_keeps_the_snapshot_stale(catalog):
+    catalog.fetch.during = catalog.invalidate
+    catalog.refresh()
+    catalog.fetch.during = None
+    catalog.get_products()
+    wait_for(lambda: catalog.fetch.calls == 2 and not catalog._refreshing)
+
+
+def test_product_and_price_events_invalidate(catalog):
+    catalog.get_products()
+    assert catalog.handle_event({"type": "price.updated"}) is True
+    assert catalog.handle_event({"type": "invoice.paid"}) is False
+    assert catalog._loaded_at == 0.0
+
+
+def test_landing_products_are_formatted_and_sorted(monkeypatch):
+    catalog = StripeCatalog()
+    products = [
+        {"id": "prod_e", "name": "Enterprise", "prices": []},
+        {"id": "prod_p", "name": "Professional", "prices": [{"unit_amount": 9900, "recurring": {"interval": "month"}}]},
+        {"id": "prod_s", "name": "Starter", "metadata": {"features": "a,b"}, "prices": [{"unit_amount": 1900}]},
+    ]
+    monkeypatch.setattr(catalog, "_fetch", lambda: products)
+    monkeypatch.setattr(catalog_module, "stripe_catalog", catalog)
+
+    formatted = asyncio.run(landing_products())
+    assert [product["id"] for product in formatted] == ["prod_s", "prod_p", "prod_e"]
+    assert formatted[0]["features"] == ["a", "b"] and formatted[0]["price_interval"] == ""
+    assert (formatted[1]["price_display"], formatted[1]["price_interval"]) == ("$99.0", "/month")
+    assert formatted[1]["features"][0] == "Up to 20 API keys"
+    assert formatted[2]["is_enterprise"] and formatted[2]["price_display"] == "Custom"
@@ -0,0 +1,71 @@
+import asyncio
+import threading
+import time
+
+import pytest
+import stripe
+
+from stripe_client import StripeClient, _ScopedTimeoutHTTPClient
+
+
+@pytest.fixture
+def client():
+    client = StripeClient(max_workers=2, max_pending=2, timeout=0.2)
+    yield client
+    client._executor.shutdown(wait=True)
+
+
+def test_calls_run_on_the_stripe_pool(client, monkeypatch):
+    monkeypatch.setattr(stripe.Customer, "retrieve", lambda customer_id: (customer_id, threading.current_thread().name))
+    customer_id, thread = asyncio.run(client.Customer.retrieve("cus_1"))
+    assert customer_id == "cus_1" and thread.startswith("stripe")
+    assert client.metrics()["operations"]["Customer.retrieve"]["calls"] == 1
+
+
+def test_slow_call_times_out(client):
+    async def scenario():
+        with pytest.raises(stripe.error.APIConnectionError, match="timed out"):
+            await client.call("Invoice.list", time.sleep, 0.5)
+        # The slot stays taken until the thread actually finishes
+        return client.metrics()["pending"]
+
+    assert asyncio.run(scenario()) == 1
+    assert client.metrics()["operations"]["Invoice.list"]["timeouts"] == 1
+
+
+def test_calls_beyond_the_backlog_are_rejected(client):
+    release = threading.Event()
+
+    async def scenario():
+        running = [asyncio.ensure_future(client.call("Charge.list", release.wait, timeout=5)) for _ in range(2)]
+        await asyncio.sleep(0.05)
+        with pytest.raises(stripe.error.APIConnectionError, match="saturated"):
+            await client.call("Charge.list", release.wait)
+        release.set()
+        await asyncio.gather(*running)
+
+    asyncio.run(scenario())
+    stats = client.metrics()
+    assert stats["pending"] == 0
+    assert stats["operations"]["Charge.list"]["rejected"] == 1
+
+
+def test_stripe_errors_are_counted_and_raised(client):
+    def fail():
+        raise stripe.error.CardError("declined", None, "card_declined")
+
+    with pytest.raises(stripe.error.CardError):
+        asyncio.run(client.call("PaymentIntent.create", fail))
+    assert client.metrics()["operations"]["PaymentIntent.create"]["errors"] == 1
+
+
+def test_http_timeout_applies_only_to_stripe_threads(client):
+    http_client = _ScopedTimeoutHTTPClient(verify_ssl_certs=True, proxy=None)
+    default = http_client._timeout
+    assert default == 80
+
+    async def on_pool():
+        return await client.call("Balance.retrieve", lambda: http_client._timeout)
+
+    assert asyncio.run(on_pool()) == 0.2
+    assert http_client._timeout == default
@@ -0,0 +1,114 @@
+import asyncio
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+
+import stripe_mirror as mirror_module
+from database import Customer, Invoice, StripeCustomerMirror
+from stripe_mirror import StripeMirror
+
+
+def card(payment_method_id, created, customer="cus_1", last4="4242"):
+    return {"id": payment_method_id, "type": "card", "customer": customer, "created": created,
+            "card": {"brand": "visa", "last4": last4, "exp_month": 1, "exp_year": 2030}}
+
+
+def event(event_type, obj):
+    return {"type": event_type, "data": {"object": obj}}
+
+
+@pytest.fixture
+def mirror(db):
+    db.add(Customer(id=1, name="c1", email="c1@example.com", stripe_customer_id="cus_1"))
+    db.commit()
+    return StripeMirror(ttl=60)
+
+
+def test_payment_method_events(db, mirror):
+    mirror.handle_event(db, event("payment_method.attached", card("pm_old", 100)))
+    mirror.handle_event(db, event("payment_method.attached", card("pm_new", 200)))
+    mirror.handle_event(db, event("customer.updated", {"id": "cus_1", "invoice_settings": {"default_payment_method": "pm_new"}}))
+    mirror.handle_event(db, event("payment_method.updated", card("pm_old", 100, last4="1111")))
+    db.commit()
+
+    methods, default_id = mirror.get_payment_methods(db, "cus_1")
+    assert [method["id"] for method in methods] == ["pm_new", "pm_old"]
+    assert methods[1]["card"]["last4"] == "1111"
+    assert default_id == "pm_new"
+
+    mirror.handle_event(db, event("payment_method.detached", dict(card("pm_old", 100), customer=None)))
+    db.commit()
+    assert [method["id"] for method in mirror.get_payment_methods(db, "cus_1")[0]] == ["pm_new"]
+    assert mirror.handle_event(db, event("charge.succeeded", {})) is False
+
+
+def test_invoice_events(db, mirror):
+    invoice = {"id": "in_1", "customer": "cus_1", "total": 1250, "status": "open", "created": 1790000000,
+               "lines": {"data": [{"description": "API usage"}]}, "hosted_invoice_url": "https://pay/in_1"}
+    mirror.handle_event(db, event("invoice.finalized", invoice))
+    mirror.handle_event(db, event("invoice.paid", dict(invoice, status="paid", invoice_pdf="https://pdf/in_1")))
+    # Invoices of customers we do not know are ignored
+    mirror.handle_event(db, event("invoice.created", dict(invoice, id="in_2", customer="cus_other")))
+    db.commit()
+
+    assert mirror.get_invoices(db, 1) == [{
+        "created": datetime.utcfromtimestamp(1790000000),
+        "description": "API usage",
+        "amount": 12.5,
+        "status": "paid",
+        "invoice_pdf": "https://pdf/in_1"
+    }]
+    mirror.handle_event(db, event("invoice.deleted", {"id": "in_1"}))
+    db.commit()
+    assert db.query(Invoice).count() == 0
+
+
+def test_snapshot_replaces_what_was_mirrored(db, mirror):
+    mirror.handle_event(db, event("payment_method.attached", card("pm_removed", 100)))
+    db.commit()
+
+    mirror._apply_snapshot(db, {"id": "cus_1", "invoice_settings": {"default_payment_method": {"id": "pm_kept"}}}, [card("pm_kept", 300)], [])
+    db.commit()
+    methods, default_id = mirror.get_payment_methods(db, "cus_1")
+    assert [method["id"] for method in methods] == ["pm_kept"] and default_id == "pm_kept"
+    assert db.query(StripeCustomerMirror).one().synced_at is not None
+
+    mirror._apply_snapshot(db, {"id": "cus_1", "deleted": True}, [], [])
+    db.commit()
+    assert mirror.get_payment_methods(db, "cus_1") == ([], None)
+
+
+@pytest.fixture
+def fake_stripe(monkeypatch):
+    calls = []
+
+    async def retrieve(stripe_customer_id):
+        calls.append(stripe_customer_id)
+        return {"id": stripe_customer_id, "invoice_settings": {}}
+
+    async def empty_list(**params):
+        return SimpleNamespace(data=[])
+
+    client = SimpleNamespace(
+        Customer=SimpleNamespace(retrieve=retrieve),
+        PaymentMethod=SimpleNamespace(list=empty_list),
+        Invoice=SimpleNamespace(list=empty_list)
+    )
+    monkeypatch.setattr(mirror_module, "stripe_client", client)
+    return calls
+
+
+def test_first_view_loads_and_stale_mirror_refreshes_in_background(db, mirror, fake_stripe):
+    async def scenario():
+        await mirror.ensure_fresh(db, "cus_1")
+        await mirror.ensure_fresh(db, "cus_1")
+        assert fake_stripe == ["cus_1"]
+
+        db.query(StripeCustomerMirror).update({"synced_at": datetime.utcnow() - timedelta(hours=1)})
+        db.commit()
+        await mirror.ensure_fresh(db, "cus_1")
+        await asyncio.gather(*mirror._tasks)
+
+    asyncio.run(scenario())
+    assert fake_stripe == ["cus_1", "cus_1"]
@@ -0,0 +1,42 @@
+import asyncio
+from datetime import datetime
+
+import jinja2
+import pytest
+
+import templating
+from templating import format_date, precompile, templates
+from warmup import WarmUp, warm_templates
+
+
+def test_every_template_compiles():
+    assert precompile() == len(templates.env.list_templates(extensions=["html"]))
+
+
+def test_date_filter():
+    assert format_date(datetime(2026, 10, 19, 8, 30)) == "2026-10-19"
+    assert format_date(1792368000) == "2026-10-19"
+    assert format_date("N/A") == "N/A"
+    assert format_date(None) == ""
+    assert templates.env.from_string("{{ value|date }}").render(value=1792368000) == "2026-10-19"
+
+
+@pytest.fixture
+def broken_template(monkeypatch):
+    loader = jinja2.ChoiceLoader([jinja2.DictLoader({"broken.html": "{{ value|no_such_filter }}"}), templates.env.loader])
+    monkeypatch.setattr(templates.env, "loader", loader)
+
+
+def test_broken_template_fails_precompile(broken_template):
+    with pytest.raises(jinja2.TemplateError, match="broken.html"):
+        precompile()
+    # The others were still compiled
+    assert templating.template_metrics.snapshot()["templates"]["base.html"]["load_ms"] is not None
+
+
+def test_broken_template_keeps_the_worker_unready(broken_template):
+    warmup = WarmUp([("templates", warm_templates, True)])
+    asyncio.run(warmup.run())
+    assert warmup.ready is False
+    assert warmup.status()["status"] == "failed"
+    assert warmup.results["templates"]["status"] == "failed"
@@ -0,0 +1,89 @@
+from datetime import timedelta
+
+import pytest
+
+from auth import TokenCache, create_access_token, get_user_from_token, token_cache
+from database import User
+
+
+@pytest.fixture
+def user(db):
+    user = User(username="alice", email="alice@example.com", hashed_password="x", role="customer")
+    db.add(user)
+    db.commit()
+    return user
+
+
+@pytest.fixture(autouse=True)
+def empty_cache():
+    token_cache.clear()
+    yield
+    token_cache.clear()
+
+
+def test_cached_user_is_attached_without_a_query(db, user):
+    cache = TokenCache()
+    cache.put("token", {}, user, cache.generation())
+    db.expunge_all()
+
+    cached = cache.get(db, "token")
+    assert cached.id == user.id and cached.username == "alice"
+    assert cached in db
+    assert cache.get(db, "other") is None
+
+
+def test_entry_never_outlives_the_token(db, user):
+    cache = TokenCache(ttl_seconds=60)
+    cache.put("expired", {"exp": 0}, user, cache.generation())
+    assert cache.get(db, "expired") is None
+
+
+def test_invalidate_drops_only_that_users_tokens(db, user):
+    other = User(username="bob", email="bob@example.com", hashed_password="x", role="customer")
+    db.add(other)
+    db.commit()
+    cache = TokenCache()
+    cache.put("a1", {}, user, cache.generation())
+    cache.put("a2", {}, user, cache.generation())
+    cache.put("b1", {}, other, cache.generation())
+
+    cache.invalidate(user.id)
+
+    assert cache.get(db, "a1") is None and cache.get(db, "a2") is None
+    assert cache.get(db, "b1").username == "bob"
+
+
+def test_lookup_racing_an_invalidation_is_not_stored(db, user):
+    cache = TokenCache()
+    generation = cache.generation()
+    # The user changed while the lookup was reading the old row
+    cache.invalidate(user.id)
+    cache.put("token", {}, user, generation)
+    assert cache.get(db, "token") is None
+
+
+def test_least_recently_used_entry_is_dropped(db, user):
+    cache = TokenCache(max_entries=2)
+    cache.put("t1", {}, user, cache.generation())
+    cache.put("t2", {}, user, cache.generation())
+    cache.get(db, "t1")
+    cache.put("t3", {}, user, cache.generation())
+    assert cache.get(db, "t2") is None
+    assert cache.get(db, "t1") is not None and cache.get(db, "t3") is not None
+
+
+def test_get_user_from_token_sees_changes_after_invalidate(db, user):
+    token = create_access_token({"sub": "alice"}, expires_delta=timedelta(minutes=5))
+    assert get_user_from_token(db, token).email == "alice@example.com"
+
+    user.email = "new@example.com"
+    db.commit()
+    # Still the snapshot until the change is announced
+    assert get_user_from_token(db, token).email == "alice@example.com"
+    token_cache.invalidate(user.id)
+    db.expire_all()
+    assert get_user_from_token(db, token).email == "new@example.com"
+
+
+def test_invalid_token_is_rejected(db, user):
+    assert get_user_from_token(db, "not-a-jwt") is None
@@ -0,0 +1,92 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from database import Usage
+from usage_export import InvalidCursorError, decode_cursor, encode_cursor, fetch_usage_page
+
+
+def test_cursor_round_trip():
+    timestamp = datetime(2026, 10, 18, 12, 30, 15, 123456)
+    cursor = encode_cursor(timestamp, 42)
+    assert "=" not in cursor
+    assert decode_cursor(cursor) == (timestamp, 42)
+
+
+@pytest.mark.parametrize("cursor", ["", "not-a-cursor", "e30", encode_cursor(datetime(2026, 1, 1), 1)[:-3]])
+def test_invalid_cursor(cursor):
+    with pytest.raises(InvalidCursorError):
+        decode_cursor(cursor)
+
+
+def add_usage(db, api_key_id, timestamps):
+    rows = [Usage(api_key_id=api_key_id, request_type="generate", tokens_used=1, cost=0.0, timestamp=timestamp) for timestamp in timestamps]
+    db.add_all(rows)
+    db.commit()
+    # The column default fills in None, so rows from before it existed are written as NULL here
+    missing = [row.id for row, timestamp in zip(rows, timestamps) if timestamp is None]
+    if missing:
+        db.query(Usage).filter(Usage.id.in_(missing)).update({"timestamp": None}, synchronize_session=False)
+        db.commit()
+
+
+def all_pages(db, api_key_id, limit, **kwargs):
+    rows, cursor, pages = [], None, 0
+    while True:
+        page, cursor = fetch_usage_page(db, "usage", api_key_id, limit, cursor, **kwargs)
+        rows.extend(page)
+        pages += 1
+        if cursor is None:
+            return rows, pages
+
+
+def test_pages_break_timestamp_ties_by_id(db):
+    base = datetime(2026, 10, 1)
+    # Five rows share one timestamp, so pages must split inside the tie
+    add_usage(db, 1, [base] * 5 + [base + timedelta(seconds=1)] * 2 + [base - timedelta(seconds=1)])
+    add_usage(db, 2, [base] * 3)
+
+    rows, pages = all_pages(db, 1, limit=2)
+
+    assert pages == 4
+    assert len(rows) == 8
+    assert len({row["id"] for row in rows}) == 8
+    assert [(row["timestamp"], row["id"]) for row in rows] == sorted((row["timestamp"], row["id"]) for row in rows)
+
+
+def test_last_full_page_has_no_cursor(db):
+    add_usage(db, 1, [datetime(2026, 10, 1, hour) for hour in range(4)])
+    page, cursor = fetch_usage_page(db, "usage", 1, limit=4)
+    assert len(page) == 4
+    assert cursor is None
+
+
+def test_time_range_is_half_open(db):
+    add_usage(db, 1, [datetime(2026, 10, day) for day in (1, 2, 3)])
+    rows, _ = all_pages(db, 1, limit=10, start=datetime(2026, 10, 2), end=datetime(2026, 10, 3))
+    assert [row["timestamp"] for row in rows] == [datetime(2026, 10, 2).isoformat()]
+
+
+def test_rows_without_a_timestamp_are_paged_last(db):
+    base = datetime(2026, 10, 1)
+    add_usage(db, 1, [None, base, None, base + timedelta(seconds=1), None, base])
+    assert db.query(Usage).filter(Usage.timestamp.is_(None)).count() == 3
+
+    for limit in (1, 2, 4):
+        rows, _ = all_pages(db, 1, limit=limit)
+        assert len(rows) == 6
+        assert len({row["id"] for row in rows}) == 6
+        assert [row["timestamp"] is None for row in rows] == [False] * 3 + [True] * 3
+        nulls = [row["id"] for row in rows if row["timestamp"] is None]
+        assert nulls == sorted(nulls)
+
+
+def test_cursor_round_trip_without_timestamp():
+    assert decode_cursor(encode_cursor(None, 7)) == (None, 7)
+
+
+def test_stream_uses_the_same_order(db):
+    from usage_export import iter_usage_rows
+    add_usage(db, 1, [None, datetime(2026, 10, 1)])
+    page, _ = fetch_usage_page(db, "usage", 1, limit=10)
+    assert [row["id"] for row in iter_usage_rows("usage", 1)] == [row["id"] for row in page]
@@ -0,0 +1,100 @@
+import gzip
+import json
+from datetime import datetime
+
+import pytest
+from sqlalchemy import inspect, text
+
+from api_keys import issue_api_key
+from database import Usage, UsagePartition, engine
+from usage_partitions import UsagePartitionManager, next_period, partition_name, period_start, previous_period
+
+NOW = datetime(2026, 10, 19, 12)
+
+
+@pytest.mark.parametrize("period, start, following, preceding", [
+    ("month", datetime(2026, 10, 1), datetime(2026, 11, 1), datetime(2026, 9, 1)),
+    ("week", datetime(2026, 10, 19), datetime(2026, 10, 26), datetime(2026, 10, 12)),
+    ("day", datetime(2026, 10, 19), datetime(2026, 10, 20), datetime(2026, 10, 18)),
+])
+def test_periods(period, start, following, preceding):
+    assert period_start(NOW, period) == start
+    assert next_period(start, period) == following
+    assert previous_period(start, period) == preceding
+
+
+def test_month_boundaries_and_names():
+    assert next_period(datetime(2026, 12, 1), "month") == datetime(2027, 1, 1)
+    assert previous_period(datetime(2027, 1, 1), "month") == datetime(2026, 12, 1)
+    assert partition_name(datetime(2026, 9, 1), "month") == "usage_p202609"
+    assert partition_name(datetime(2026, 9, 7), "week") == "usage_p20260907"
+
+
+@pytest.fixture
+def manager(tmp_path):
+    manager = UsagePartitionManager(period="month", retention_periods=2, archive_dir=str(tmp_path))
+    if manager.native:
+        pytest.skip("SQLite rotation only")
+    yield manager
+    with engine.begin() as conn:
+        for name in inspect(conn).get_table_names():
+            if name.startswith("usage_p2"):
+                conn.execute(text(f"DROP TABLE {name}"))
+
+
+@pytest.fixture
+def api_key_id(db):
+    api_key, _ = issue_api_key(name="key", customer_id=1)
+    db.add(api_key)
+    db.commit()
+    return api_key.id
+
+
+def add_usage(db, api_key_id, *timestamps):
+    rows = [Usage(api_key_id=api_key_id, request_type="generate", tokens_used=1, cost=0.01, timestamp=timestamp) for timestamp in timestamps]
+    db.add_all(rows)
+    db.commit()
+    return [row.id for row in rows]
+
+
+def test_rotation_moves_closed_periods_and_queries_still_see_them(db, manager, api_key_id):
+    add_usage(db, api_key_id, datetime(2026, 8, 10), datetime(2026, 9, 5), datetime(2026, 9, 30, 23), NOW)
+
+    assert manager.rotate(NOW) == 3
+    assert db.query(Usage).count() == 1
+    partitions = {row.name: row.row_count for row in db.query(UsagePartition)}
+    assert partitions == {"usage_p202608": 1, "usage_p202609": 2}
+
+    # A range over September reads the partition, one over all time reads everything
+    source = manager.usage_source(db, datetime(2026, 9, 1), datetime(2026, 10, 1))
+    assert db.query(source).filter(source.timestamp >= datetime(2026, 9, 1), source.timestamp < datetime(2026, 10, 1)).count() == 2
+    source = manager.usage_source(db)
+    assert db.query(source).count() == 4
+    # Nothing older than the current period: the hot table alone
+    assert manager.usage_source(db, NOW) is Usage
+
+
+def test_ids_are_not_reused_after_rotation(db, manager, api_key_id):
+    old_ids = add_usage(db, api_key_id, datetime(2026, 9, 5), datetime(2026, 9, 6))
+    manager.rotate(NOW)
+    assert db.query(Usage).count() == 0
+
+    new_id, = add_usage(db, api_key_id, NOW)
+    assert new_id > max(old_ids)
+
+
+def test_expired_partitions_are_archived_and_dropped(db, manager, api_key_id):
+    ids = add_usage(db, api_key_id, datetime(2026, 7, 3), datetime(2026, 7, 4), datetime(2026, 9, 5))
+
+    result = manager.maintain(NOW)
+    assert result["moved_rows"] == 3
+    assert result["archived"] == ["usage_p202607"]
+
+    partition = db.query(UsagePartition).filter_by(name="usage_p202607").one()
+    assert partition.status == "archived" and partition.row_count == 2
+    with gzip.open(partition.archive_path, "rt") as archive:
+        assert [json.loads(line)["id"] for line in archive] == ids[:2]
+    assert "usage_p202607" not in inspect(engine).get_table_names()
+    assert manager.archived_until(db) == datetime(2026, 8, 1)
+    # September is within retention and stays queryable
+    assert db.query(manager.usage_source(db)).count() == 1
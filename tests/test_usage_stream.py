@@ -0,0 +1,97 @@
+import asyncio
+import json
+import threading
+from datetime import datetime
+from types import SimpleNamespace
+
+from usage_stream import UsageBroadcaster, merge_deltas, sse_events, usage_broadcaster, usage_delta
+
+
+def row(usage_id, api_key_id=1, tokens=10, cost=0.1, day=1):
+    return SimpleNamespace(id=usage_id, api_key_id=api_key_id, tokens_used=tokens, cost=cost, timestamp=datetime(2026, 10, day, 12))
+
+
+def test_usage_delta_and_merge():
+    first = usage_delta(row(1), "GPT-4")
+    assert first["keys"] == {"1": {"requests": 1, "tokens": 10, "cost": 0.1}}
+    assert first["models"]["GPT-4"]["name"] == "GPT-4"
+    assert usage_delta(row(2), None)["models"] == {}
+
+    merged = merge_deltas(first, usage_delta(row(5, api_key_id=2, tokens=5, day=2), "GPT-4"))
+    assert (merged["requests"], merged["tokens"], merged["last_usage_id"]) == (2, 15, 5)
+    assert merged["models"]["GPT-4"]["tokens"] == 15
+    assert set(merged["keys"]) == {"1", "2"} and set(merged["days"]) == {"2026-10-01", "2026-10-02"}
+
+
+def test_queued_deltas_are_merged_and_old_ones_skipped():
+    async def scenario():
+        broadcaster = UsageBroadcaster()
+        subscription = broadcaster.subscribe(7)
+        for usage_id in (3, 4, 5):
+            broadcaster.publish(7, usage_delta(row(usage_id), None))
+        # Another customer's usage is not delivered
+        broadcaster.publish(8, usage_delta(row(6), None))
+        await asyncio.sleep(0)
+        return await subscription.next_message(0.1, after_usage_id=3), await subscription.next_message(0.01)
+
+    merged, idle = asyncio.run(scenario())
+    assert (merged["requests"], merged["last_usage_id"]) == (2, 5)
+    assert idle is None
+
+
+def test_shared_delta_is_not_modified_by_merging():
+    async def scenario():
+        broadcaster = UsageBroadcaster()
+        first, second = broadcaster.subscribe(7), broadcaster.subscribe(7)
+        delta = usage_delta(row(1), None)
+        broadcaster.publish(7, delta)
+        broadcaster.publish(7, usage_delta(row(2), None))
+        await asyncio.sleep(0)
+        return delta, await first.next_message(0.1), await second.next_message(0.1)
+
+    delta, first, second = asyncio.run(scenario())
+    assert delta["requests"] == 1
+    assert first["requests"] == second["requests"] == 2
+
+
+def test_full_queue_asks_the_client_to_resync():
+    async def scenario():
+        broadcaster = UsageBroadcaster(queue_size=2)
+        subscription = broadcaster.subscribe(7)
+        for usage_id in range(1, 5):
+            broadcaster.publish(7, usage_delta(row(usage_id), None))
+        await asyncio.sleep(0)
+        return await subscription.next_message(0.1)
+
+    assert asyncio.run(scenario()) == {"type": "resync"}
+
+
+def test_publishing_from_another_thread():
+    async def scenario():
+        broadcaster = UsageBroadcaster()
+        subscription = broadcaster.subscribe(7)
+        thread = threading.Thread(target=broadcaster.publish, args=(7, usage_delta(row(1), None)))
+        thread.start()
+        thread.join()
+        return await subscription.next_message(1)
+
+    assert asyncio.run(scenario())["last_usage_id"] == 1
+
+
+def test_sse_events_send_a_snapshot_then_deltas_and_unsubscribe():
+    async def scenario():
+        subscription = usage_broadcaster.subscribe(7)
+        events = sse_events(subscription, {"total_tokens": 5, "last_usage_id": 1})
+        received = [await events.__anext__(), await events.__anext__()]
+        usage_broadcaster.publish(7, usage_delta(row(1), None))
+        usage_broadcaster.publish(7, usage_delta(row(2), None))
+        received.append(await events.__anext__())
+        await events.aclose()
+        return received
+
+    retry, snapshot, delta = asyncio.run(scenario())
+    assert retry == "retry: 5000\n\n"
+    assert json.loads(snapshot.split("data: ", 1)[1]) == {"total_tokens": 5, "last_usage_id": 1}
+    assert delta.startswith("event: usage\n")
+    assert json.loads(delta.split("data: ", 1)[1])["last_usage_id"] == 2
+    assert not usage_broadcaster.has_subscribers(7)
@@ -0,0 +1,71 @@
+import asyncio
+
+import warmup as warmup_module
+from warmup import WarmUp, warm_api_keys, warm_database, warm_stripe
+
+
+def fail(message):
+    def step():
+        raise RuntimeError(message)
+    return step
+
+
+def test_worker_is_warming_until_every_step_ran():
+    warmup = WarmUp([("database", lambda: {"connections": 1}, True)])
+    assert warmup.status() == {"status": "warming", "seconds": None, "steps": {}}
+
+    asyncio.run(warmup.run())
+
+    status = warmup.status()
+    assert warmup.ready is True
+    assert status["status"] == "ready"
+    assert status["steps"]["database"]["status"] == "ok"
+    assert status["steps"]["database"]["connections"] == 1
+
+
+def test_optional_step_failure_is_recorded_and_skipped():
+    ran = []
+    warmup = WarmUp([
+        ("stripe", fail("Stripe is unreachable"), False),
+        ("models", lambda: ran.append("models") or {"active": 0}, False)
+    ])
+    asyncio.run(warmup.run())
+
+    assert warmup.ready is True
+    assert ran == ["models"]
+    assert warmup.results["stripe"]["status"] == "failed"
+    assert warmup.results["stripe"]["error"] == "Stripe is unreachable"
+
+
+def test_critical_step_failure_keeps_the_worker_unready():
+    warmup = WarmUp([
+        ("database", fail("connection refused"), True),
+        ("api_keys", lambda: {"cached": 0}, False)
+    ])
+    asyncio.run(warmup.run())
+
+    assert warmup.ready is False
+    assert warmup.status()["status"] == "failed"
+    # Later steps still run, so the status shows everything that is wrong
+    assert warmup.results["api_keys"]["status"] == "ok"
+
+
+def test_stopped_worker_reports_draining():
+    async def scenario():
+        warmup = WarmUp([("slow", lambda: {}, True)])
+        warmup.start()
+        warmup.stop()
+        return warmup
+
+    warmup = asyncio.run(scenario())
+    assert warmup.status()["status"] == "draining"
+
+
+def test_steps_against_the_database(db):
+    assert warm_database()["connections"] >= 1
+    assert warm_api_keys() == {"cached": 0}
+
+
+def test_stripe_step_is_skipped_without_a_key(monkeypatch):
+    monkeypatch.setattr(warmup_module.stripe, "api_key", None)
+    assert warm_stripe() == {"skipped": "no Stripe key"}
@@ -0,0 +1,81 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from database import WebhookEvent
+from webhook_inbox import WebhookInbox
+
+
+def event(event_id, created, event_type="test.event"):
+    return {"id": event_id, "type": event_type, "created": created, "data": {"object": {}}}
+
+
+@pytest.fixture
+def inbox(monkeypatch):
+    inbox = WebhookInbox(batch_size=2, max_attempts=2, retry_delay=0)
+    inbox.applied = []
+
+    def process_event(db, payload):
+        if payload["type"] == "bad.event":
+            raise ValueError("cannot apply")
+        inbox.applied.append(payload["id"])
+
+    monkeypatch.setattr(inbox, "process_event", process_event)
+    return inbox
+
+
+def test_redelivery_is_dropped(db, inbox):
+    assert inbox.receive(db, event("evt_1", 100)) is True
+    assert inbox.receive(db, event("evt_1", 100)) is False
+    assert db.query(WebhookEvent).count() == 1
+
+
+def test_claim_takes_a_batch_in_stripe_order(db, inbox):
+    for event_id, created in (("evt_c", 300), ("evt_a", 100), ("evt_b", 200)):
+        inbox.receive(db, event(event_id, created))
+
+    batch = inbox._claim(db)
+    assert [record.event_id for record in batch] == ["evt_a", "evt_b"]
+    assert {record.status for record in batch} == {"processing"}
+    # A second worker only gets what is left
+    assert [record.event_id for record in inbox._claim(db)] == ["evt_c"]
+    assert inbox._claim(db) == []
+
+
+def test_drain_applies_everything_in_order(db, inbox):
+    for event_id, created in (("evt_c", 300), ("evt_a", 100), ("evt_b", 200)):
+        inbox.receive(db, event(event_id, created))
+
+    assert inbox.drain() == {"processed": 3, "failed": 0}
+    assert inbox.applied == ["evt_a", "evt_b", "evt_c"]
+    db.expire_all()
+    assert {record.status for record in db.query(WebhookEvent)} == {"processed"}
+
+
+def test_bad_event_does_not_hold_back_its_batch(db, inbox):
+    inbox.receive(db, event("evt_bad", 100, "bad.event"))
+    inbox.receive(db, event("evt_good", 200))
+
+    assert inbox.drain() == {"processed": 1, "failed": 1}
+    assert inbox.applied == ["evt_good"]
+    bad = db.query(WebhookEvent).filter(WebhookEvent.event_id == "evt_bad").one()
+    assert bad.status == "failed" and bad.attempts == 1 and bad.error == "cannot apply"
+
+
+def test_failed_event_is_retried_until_max_attempts(db, inbox):
+    inbox.receive(db, event("evt_bad", 100, "bad.event"))
+    inbox.drain()
+    assert inbox.drain() == {"processed": 0, "failed": 1}
+    assert inbox.drain() == {"processed": 0, "failed": 0}
+    db.expire_all()
+    assert db.query(WebhookEvent).one().attempts == 2
+
+
+def test_stale_claim_is_handed_out_again(db, inbox):
+    inbox.receive(db, event("evt_1", 100))
+    record = inbox._claim(db)[0]
+    record.claimed_at = datetime.utcnow() - timedelta(hours=1)
+    db.commit()
+
+    assert inbox.drain() == {"processed": 1, "failed": 0}
+    assert inbox.applied == ["evt_1"]
@@ -0,0 +1,184 @@
+import base64
+import csv
+import io
+import json
+import logging
+from datetime import datetime
+from typing import Dict, Any, List, Optional, Tuple, Iterator
+
+from sqlalchemy import and_, or_
+from sqlalchemy.orm import Session
+
+from database import SessionLocal, Usage, UsageRecord
+from usage_partitions import partition_manager
+
+logger = logging.getLogger(__name__)
+
+# Columns exposed for each usage table, in output order
+USAGE_FIELDS = ("id", "timestamp", "model_id", "request_type", "tokens_used", "response_time", "cost")
+RECORD_FIELDS = ("id", "timestamp", "service", "request_count", "cost")
+
+USAGE_SOURCES = {
+    "usage": (Usage, USAGE_FIELDS),
+    "records": (UsageRecord, RECORD_FIELDS)
+}
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+# Rows fetched per round-trip when streaming from a server-side cursor
+STREAM_CHUNK_SIZE = 1000
+# Streamed responses are sent in pieces of roughly this many characters
+STREAM_BUFFER_SIZE = 64 * 1024
+
+
+class InvalidCursorError(ValueError):
+    """Raised when a pagination cursor cannot be decoded"""
+    pass
+
+
+def encode_cursor(timestamp: Optional[datetime], row_id: int) -> str:
+    """Encode the (timestamp, id) position of a row as an opaque cursor"""
+    raw = json.dumps([timestamp.isoformat() if timestamp is not None else None, row_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[Optional[datetime], int]:
+    """Decode a cursor produced by encode_cursor"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        timestamp, row_id = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        return datetime.fromisoformat(timestamp) if timestamp is not None else None, int(row_id)
+    except Exception:
+        raise InvalidCursorError("Invalid pagination cursor")
+
+
+def after_position(model, timestamp: Optional[datetime], row_id: int):
+    """Filter for rows after the (timestamp, id) position in position_order"""
+    if timestamp is None:
+        return and_(model.timestamp.is_(None), model.id > row_id)
+    return or_(
+        model.timestamp > timestamp,
+        and_(model.timestamp == timestamp, model.id > row_id),
+        model.timestamp.is_(None)
+    )
+
+
+def position_order(model) -> tuple:
+    """(timestamp, id) order with rows without a timestamp last; NULLS LAST is also PostgreSQL's index order"""
+    return model.timestamp.asc().nulls_last(), model.id
+
+
+def _usage_query(
+    db: Session,
+    source: str,
+    api_key_id: int,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    cursor: Optional[str] = None
+):
+    """
+    Rows of one usage source for an API key, ordered by (timestamp, id).
+
+    Rows without a timestamp (from before it was always set) sort last, by
+    id, and the cursor predicate follows the same order, since a plain
+    comparison with NULL would skip them.
+    """
+    model, fields = USAGE_SOURCES[source]
+    if model is Usage:
+        model = partition_manager.usage_source(db, start, end)
+    query = db.query(*[getattr(model, field) for field in fields]).filter(model.api_key_id == api_key_id)
+
+    if start is not None:
+        query = query.filter(model.timestamp >= start)
+    if end is not None:
+        query = query.filter(model.timestamp < end)
+    if cursor:
+        query = query.filter(after_position(model, *decode_cursor(cursor)))
+
+    return query.order_by(*position_order(model))
+
+
+def serialize_row(row, fields) -> Dict[str, Any]:
+    """Convert a result row into a JSON-compatible dict"""
+    data = dict(zip(fields, row))
+    if data.get("timestamp") is not None:
+        data["timestamp"] = data["timestamp"].isoformat()
+    return data
+
+
+def fetch_usage_page(
+    db: Session,
+    source: str,
+    api_key_id: int,
+    limit: int = DEFAULT_PAGE_SIZE,
+    cursor: Optional[str] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None
+) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """Return one page of rows and the cursor for the next page (None at the end)"""
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    fields = USAGE_SOURCES[source][1]
+
+    # Fetch one extra row to know whether another page exists
+    rows = _usage_query(db, source, api_key_id, start, end, cursor).limit(limit + 1).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    next_cursor = None
+    if has_more:
+        last = rows[-1]
+        next_cursor = encode_cursor(last.timestamp, last.id)
+
+    return [serialize_row(row, fields) for row in rows], next_cursor
+
+
+def iter_usage_rows(
+    source: str,
+    api_key_id: int,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    chunk_size: int = STREAM_CHUNK_SIZE
+) -> Iterator[Dict[str, Any]]:
+    """
+    Yield every matching row from a server-side cursor in constant memory.
+
+    Opens its own session so it can outlive the request's session while a
+    streaming response is being sent.
+    """
+    fields = USAGE_SOURCES[source][1]
+    db = SessionLocal()
+    try:
+        query = _usage_query(db, source, api_key_id, start, end)
+        for row in query.execution_options(stream_results=True).yield_per(chunk_size):
+            yield serialize_row(row, fields)
+    finally:
+        db.close()
+
+
+def iter_ndjson(rows: Iterator[Dict[str, Any]]) -> Iterator[str]:
+    """Format rows as newline-delimited JSON, in chunks of about STREAM_BUFFER_SIZE"""
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write(json.dumps(row))
+        buffer.write("\n")
+        if buffer.tell() >= STREAM_BUFFER_SIZE:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate(0)
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def iter_csv(rows: Iterator[Dict[str, Any]], fields) -> Iterator[str]:
+    """Format rows as CSV with a header line, in chunks of about STREAM_BUFFER_SIZE"""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=fields)
+    writer.writeheader()
+    for row in rows:
+        writer.writerow(row)
+        if buffer.tell() >= STREAM_BUFFER_SIZE:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate(0)
+    if buffer.tell():
+        yield buffer.getvalue()
@@ -0,0 +1,475 @@
+import os
+import sys
+import gzip
+import json
+import time
+import threading
+import logging
+from datetime import datetime, timedelta
+from typing import Dict, Any, List, Optional
+
+from sqlalchemy import MetaData, Table, Column, Index, select, delete, func, text, union_all, and_
+from sqlalchemy.orm import Session, aliased
+
+from database import engine, SessionLocal, Usage, UsagePartition, UsageRollup, APIKey, USAGE_PARTITIONED
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Length of one usage partition: month, week or day
+USAGE_PARTITION_PERIOD = os.getenv("USAGE_PARTITION_PERIOD", "month")
+# Partitions created ahead of time on PostgreSQL, beyond the current period
+USAGE_PARTITIONS_AHEAD = int(os.getenv("USAGE_PARTITIONS_AHEAD", "2"))
+# Closed periods kept in the database; older ones are archived (0 keeps everything)
+USAGE_RETENTION_PERIODS = int(os.getenv("USAGE_RETENTION_PERIODS", "12"))
+# Where archived partitions are written as gzipped NDJSON
+USAGE_ARCHIVE_DIR = os.getenv("USAGE_ARCHIVE_DIR", "archive/usage")
+# How often the maintenance worker creates, rotates and archives partitions
+USAGE_MAINTENANCE_INTERVAL_SECONDS = float(os.getenv("USAGE_MAINTENANCE_INTERVAL_SECONDS", "3600"))
+
+USAGE_COLUMNS = [column.name for column in Usage.__table__.columns]
+
+
+def period_start(value: datetime, period: str = USAGE_PARTITION_PERIOD) -> datetime:
+    """Start of the partition period containing a timestamp"""
+    day = datetime(value.year, value.month, value.day)
+    if period == "month":
+        return day.replace(day=1)
+    if period == "week":
+        return day - timedelta(days=day.weekday())
+    if period == "day":
+        return day
+    raise ValueError(f"Unknown partition period: {period}")
+
+
+def next_period(start: datetime, period: str = USAGE_PARTITION_PERIOD) -> datetime:
+    """Start of the period following the one beginning at `start`"""
+    if period == "month":
+        return datetime(start.year + start.month // 12, start.month % 12 + 1, 1)
+    if period == "week":
+        return start + timedelta(days=7)
+    return start + timedelta(days=1)
+
+
+def previous_period(start: datetime, period: str = USAGE_PARTITION_PERIOD) -> datetime:
+    """Start of the period preceding the one beginning at `start`"""
+    return period_start(start - timedelta(days=1), period)
+
+
+def partition_name(start: datetime, period: str = USAGE_PARTITION_PERIOD) -> str:
+    if period == "month":
+        return f"usage_p{start:%Y%m}"
+    return f"usage_p{start:%Y%m%d}"
+
+
+class UsagePartitionManager:
+    """
+    Time partitioning, query routing and archival for the usage table.
+
+    PostgreSQL uses native declarative range partitions on `usage`, so the
+    planner prunes partitions itself. SQLite keeps the current period in
+    `usage` (the hot table) and moves closed periods into one table per
+    period; usage_source() unions the tables a time range needs.
+    """
+
+    def __init__(
+        self,
+        period: str = USAGE_PARTITION_PERIOD,
+        ahead: int = USAGE_PARTITIONS_AHEAD,
+        retention_periods: int = USAGE_RETENTION_PERIODS,
+        archive_dir: str = USAGE_ARCHIVE_DIR
+    ):
+        self.period = period
+        self.ahead = ahead
+        self.retention_periods = retention_periods
+        self.archive_dir = archive_dir
+        self.native = USAGE_PARTITIONED
+        self._metadata = MetaData()
+        self._tables: Dict[str, Table] = {}
+        self._current_period: Optional[datetime] = None
+        self._lock = threading.Lock()
+
+    # Query routing
+
+    def usage_source(self, db: Session, start: Optional[datetime] = None, end: Optional[datetime] = None):
+        """
+        Return the entity to query usage in [start, end) with.
+
+        This is Usage itself unless older SQLite partitions overlap the range,
+        in which case it is Usage aliased over a UNION ALL of the hot table and
+        those partitions. Callers use it exactly like Usage.
+        """
+        if self.native:
+            return Usage
+
+        query = db.query(UsagePartition.name).filter(UsagePartition.status == "active")
+        if start is not None:
+            query = query.filter(UsagePartition.period_end > start)
+        if end is not None:
+            query = query.filter(UsagePartition.period_start < end)
+        names = [row.name for row in query.order_by(UsagePartition.period_start)]
+        if not names:
+            return Usage
+
+        tables = [Usage.__table__] + [self._partition_table(name) for name in names]
+        routed = union_all(*[
+            select(*[table.c[column] for column in USAGE_COLUMNS]) for table in tables
+        ]).subquery("usage_routed")
+        return aliased(Usage, routed, adapt_on_names=True)
+
+    def _partition_table(self, name: str) -> Table:
+        """Table object for a per-period SQLite partition"""
+        with self._lock:
+            table = self._tables.get(name)
+            if table is None:
+                columns = [
+                    Column(column.name, column.type, primary_key=column.primary_key)
+                    for column in Usage.__table__.columns
+                ]
+                table = Table(
+                    name,
+                    self._metadata,
+                    *columns,
+                    Index(f"ix_{name}_api_key_timestamp", "api_key_id", "timestamp", "id"),
+                    Index(f"ix_{name}_timestamp", "timestamp")
+                )
+                self._tables[name] = table
+            return table
+
+    def archived_until(self, db: Session) -> Optional[datetime]:
+        """End of the newest archived period, or None if nothing is archived"""
+        return db.query(func.max(UsagePartition.period_end)).filter(
+            UsagePartition.status == "archived"
+        ).scalar()
+
+    # Partition creation
+
+    def check_period(self, timestamp: datetime):
+        """Cheap check on the write path; creates partitions when a new period starts"""
+        start = period_start(timestamp, self.period)
+        if start == self._current_period:
+            return
+        with self._lock:
+            if start == self._current_period:
+                return
+            self._current_period = start
+        if self.native:
+            try:
+                self.ensure_partitions(timestamp)
+            except Exception as e:
+                # Rows still land in the default partition and are moved later
+                logger.error(f"Error creating usage partitions: {str(e)}")
+
+    def ensure_partitions(self, now: Optional[datetime] = None) -> List[str]:
+        """Create the current and upcoming partitions (PostgreSQL only)"""
+        if not self.native:
+            return []
+        start = period_start(now or datetime.utcnow(), self.period)
+        created = []
+        for _ in range(self.ahead + 1):
+            end = next_period(start, self.period)
+            with engine.begin() as conn:
+                if self._create_native_partition(conn, start, end):
+                    created.append(partition_name(start, self.period))
+            start = end
+        if created:
+            logger.info(f"Created usage partitions: {', '.join(created)}")
+        return created
+
+    def _create_native_partition(self, conn, start: datetime, end: datetime) -> bool:
+        """Create and attach one PostgreSQL partition; False if it already exists"""
+        name = partition_name(start, self.period)
+        # Serialize partition DDL across workers
+        conn.execute(text("SELECT pg_advisory_xact_lock(hashtext('usage_partitions'))"))
+        if conn.execute(text("SELECT to_regclass(:name)"), {"name": name}).scalar():
+            self._register(conn, name, start, end)
+            return False
+
+        # Rows for this period may already sit in the default partition;
+        # move them into the new table before attaching it
+        conn.execute(text(f"CREATE TABLE {name} (LIKE usage INCLUDING DEFAULTS)"))
+        conn.execute(
+            text(
+                f"WITH moved AS (DELETE FROM usage_default WHERE timestamp >= :start AND timestamp < :end RETURNING *) "
+                f"INSERT INTO {name} SELECT * FROM moved"
+            ),
+            {"start": start, "end": end}
+        )
+        conn.execute(text(
+            f"ALTER TABLE usage ATTACH PARTITION {name} "
+            f"FOR VALUES FROM ('{start.isoformat(sep=' ')}') TO ('{end.isoformat(sep=' ')}')"
+        ))
+        self._register(conn, name, start, end)
+        return True
+
+    def _register(self, conn, name: str, start: datetime, end: datetime, rows: int = 0):
+        """Record a partition in usage_partitions, adding `rows` to its count"""
+        partitions = UsagePartition.__table__
+        existing = conn.execute(
+            select(partitions.c.id, partitions.c.row_count).where(partitions.c.name == name)
+        ).first()
+        if existing is None:
+            conn.execute(partitions.insert().values(
+                name=name,
+                period_start=start,
+                period_end=end,
+                status="active",
+                row_count=rows,
+                created_at=datetime.utcnow()
+            ))
+        elif rows:
+            conn.execute(partitions.update().where(partitions.c.id == existing.id).values(
+                row_count=(existing.row_count or 0) + rows
+            ))
+
+    # SQLite rotation
+
+    def rotate(self, now: Optional[datetime] = None) -> int:
+        """Move rows of closed periods from the hot usage table into their period tables (SQLite)"""
+        if self.native:
+            return 0
+        current = period_start(now or datetime.utcnow(), self.period)
+        usage = Usage.__table__
+        moved = 0
+
+        with engine.begin() as conn:
+            oldest = conn.execute(select(func.min(usage.c.timestamp)).where(usage.c.timestamp < current)).scalar()
+
+        while oldest is not None:
+            start = period_start(oldest, self.period)
+            end = next_period(start, self.period)
+            name = partition_name(start, self.period)
+            in_period = and_(usage.c.timestamp >= start, usage.c.timestamp < end)
+
+            with engine.begin() as conn:
+                status = conn.execute(
+                    select(UsagePartition.__table__.c.status).where(UsagePartition.__table__.c.name == name)
+                ).scalar()
+                if status == "archived":
+                    logger.warning(f"Usage rows for archived period {name} were left in the hot table")
+                else:
+                    table = self._partition_table(name)
+                    table.create(bind=conn, checkfirst=True)
+                    conn.execute(table.insert().from_select(
+                        USAGE_COLUMNS,
+                        select(*[usage.c[column] for column in USAGE_COLUMNS]).where(in_period)
+                    ))
+                    count = conn.execute(delete(usage).where(in_period)).rowcount
+                    self._register(conn, name, start, end, rows=count)
+                    moved += count
+                    logger.info(f"Moved {count} usage rows into {name}")
+
+            with engine.begin() as conn:
+                oldest = conn.execute(select(func.min(usage.c.timestamp)).where(
+                    usage.c.timestamp >= end,
+                    usage.c.timestamp < current
+                )).scalar()
+
+        return moved
+
+    def enable_autoincrement(self):
+        """
+        Rebuild an SQLite hot table created without AUTOINCREMENT (one-time).
+
+        Without it SQLite hands out max(id) + 1 of the rows present, so ids
+        restart once rotation has emptied the table and repeat across
+        partitions. The id sequence continues after the largest id kept in
+        the hot table or any active partition.
+        """
+        if self.native:
+            return
+        with engine.begin() as conn:
+            sql = conn.execute(text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'usage'")).scalar()
+            if sql is None or "AUTOINCREMENT" in sql.upper():
+                return
+
+            logger.info("Rebuilding usage with AUTOINCREMENT ids")
+            for index in Usage.__table__.indexes:
+                conn.execute(text(f"DROP INDEX IF EXISTS {index.name}"))
+            conn.execute(text("ALTER TABLE usage RENAME TO usage_rowid"))
+            Usage.__table__.create(bind=conn)
+            columns = ", ".join(USAGE_COLUMNS)
+            conn.execute(text(f"INSERT INTO usage ({columns}) SELECT {columns} FROM usage_rowid"))
+            conn.execute(text("DROP TABLE usage_rowid"))
+
+            last_id = conn.execute(select(func.max(Usage.__table__.c.id))).scalar() or 0
+            names = conn.execute(select(UsagePartition.__table__.c.name).where(
+                UsagePartition.__table__.c.status == "active"
+            )).scalars().all()
+            for name in names:
+                table = self._partition_table(name)
+                last_id = max(last_id, conn.execute(select(func.max(table.c.id))).scalar() or 0)
+            conn.execute(text("DELETE FROM sqlite_sequence WHERE name = 'usage'"))
+            conn.execute(text("INSERT INTO sqlite_sequence (name, seq) VALUES ('usage', :seq)"), {"seq": last_id})
+        logger.info(f"usage ids now continue after {last_id}")
+
+    # Retention
+
+    def archive_expired(self, now: Optional[datetime] = None) -> List[str]:
+        """Archive partitions older than the retention window"""
+        if self.retention_periods <= 0:
+            return []
+        cutoff = period_start(now or datetime.utcnow(), self.period)
+        for _ in range(self.retention_periods):
+            cutoff = previous_period(cutoff, self.period)
+
+        db = SessionLocal()
+        try:
+            expired = db.query(UsagePartition).filter(
+                UsagePartition.status == "active",
+                UsagePartition.period_end <= cutoff
+            ).order_by(UsagePartition.period_start).all()
+            archived = []
+            for partition in expired:
+                self.archive_partition(db, partition)
+                archived.append(partition.name)
+            return archived
+        finally:
+            db.close()
+
+    def archive_partition(self, db: Session, partition: UsagePartition) -> str:
+        """Write a partition to a compressed file and drop it from the database"""
+        self._ensure_rolled_up(db, partition)
+
+        os.makedirs(self.archive_dir, exist_ok=True)
+        path = os.path.join(self.archive_dir, f"{partition.name}.ndjson.gz")
+        temp_path = path + ".tmp"
+        table = self._partition_table(partition.name)
+
+        rows = 0
+        with engine.connect() as conn, gzip.open(temp_path, "wt", encoding="utf-8") as archive:
+            result = conn.execution_options(stream_results=True).execute(
+                select(*[table.c[column] for column in USAGE_COLUMNS]).order_by(table.c.timestamp, table.c.id)
+            )
+            for row in result:
+                record = dict(zip(USAGE_COLUMNS, row))
+                if record["timestamp"] is not None:
+                    record["timestamp"] = record["timestamp"].isoformat()
+                archive.write(json.dumps(record))
+                archive.write("\n")
+                rows += 1
+        os.replace(temp_path, path)
+
+        # Only drop the data once the archive is safely on disk
+        with engine.begin() as conn:
+            if self.native:
+                conn.execute(text(f"ALTER TABLE usage DETACH PARTITION {partition.name}"))
+            conn.execute(text(f"DROP TABLE IF EXISTS {partition.name}"))
+        with self._lock:
+            self._tables.pop(partition.name, None)
+
+        partition.status = "archived"
+        partition.row_count = rows
+        partition.archive_path = path
+        partition.archived_at = datetime.utcnow()
+        db.commit()
+        logger.info(f"Archived {rows} usage rows from {partition.name} to {path}")
+        return path
+
+    def _ensure_rolled_up(self, db: Session, partition: UsagePartition):
+        """Make sure the daily rollups cover a period before its raw rows are dropped"""
+        source = self.usage_source(db, partition.period_start, partition.period_end)
+        raw = db.query(func.count(source.id)).join(APIKey, source.api_key_id == APIKey.id).filter(
+            source.timestamp >= partition.period_start,
+            source.timestamp < partition.period_end
+        ).scalar() or 0
+        rolled = db.query(func.coalesce(func.sum(UsageRollup.request_count), 0)).filter(
+            UsageRollup.bucket_date >= partition.period_start.date(),
+            UsageRollup.bucket_date < partition.period_end.date()
+        ).scalar() or 0
+
+        if raw != rolled:
+            from usage_rollups import rebuild_rollups
+            logger.info(f"Rollups for {partition.name} are incomplete ({rolled} of {raw} requests), rebuilding")
+            rebuild_rollups(since=partition.period_start.date(), until=partition.period_end.date())
+
+    # PostgreSQL conversion
+
+    def convert_existing_table(self):
+        """Convert an unpartitioned PostgreSQL usage table into a partitioned one (one-time)"""
+        if not self.native:
+            logger.info("Native partitioning is only used on PostgreSQL; nothing to convert")
+            return
+        with engine.begin() as conn:
+            kind = conn.execute(text("SELECT relkind FROM pg_class WHERE oid = to_regclass('usage')")).scalar()
+            if kind == "p":
+                logger.info("usage is already partitioned")
+                return
+            if kind is None:
+                Usage.__table__.create(bind=conn)
+                return
+
+            logger.info("Converting usage into a partitioned table")
+            conn.execute(text("LOCK TABLE usage IN ACCESS EXCLUSIVE MODE"))
+            conn.execute(text("ALTER TABLE usage RENAME TO usage_unpartitioned"))
+            conn.execute(text("ALTER TABLE usage_unpartitioned RENAME CONSTRAINT usage_pkey TO usage_unpartitioned_pkey"))
+            conn.execute(text("ALTER INDEX IF EXISTS ix_usage_id RENAME TO ix_usage_unpartitioned_id"))
+            conn.execute(text("ALTER INDEX IF EXISTS ix_usage_api_key_timestamp RENAME TO ix_usage_unpartitioned_api_key_timestamp"))
+            Usage.__table__.create(bind=conn)
+
+            oldest = conn.execute(text("SELECT min(timestamp) FROM usage_unpartitioned")).scalar()
+            start = period_start(oldest or datetime.utcnow(), self.period)
+            last = next_period(period_start(datetime.utcnow(), self.period), self.period)
+            for _ in range(self.ahead):
+                last = next_period(last, self.period)
+            while start < last:
+                end = next_period(start, self.period)
+                self._create_native_partition(conn, start, end)
+                start = end
+
+            # The partition key cannot be NULL; undated rows are filed under the conversion time
+            values = [
+                "COALESCE(timestamp, now() AT TIME ZONE 'utc')" if column == "timestamp" else column
+                for column in USAGE_COLUMNS
+            ]
+            conn.execute(text(
+                f"INSERT INTO usage ({', '.join(USAGE_COLUMNS)}) "
+                f"SELECT {', '.join(values)} FROM usage_unpartitioned"
+            ))
+            conn.execute(text(
+                "SELECT setval(pg_get_serial_sequence('usage', 'id'), COALESCE((SELECT max(id) FROM usage), 0) + 1, false)"
+            ))
+            for name in conn.execute(text(
+                "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+                "WHERE i.inhparent = 'usage'::regclass AND c.relname <> 'usage_default'"
+            )).scalars():
+                rows = conn.execute(text(f"SELECT count(*) FROM {name}")).scalar()
+                conn.execute(UsagePartition.__table__.update().where(
+                    UsagePartition.__table__.c.name == name
+                ).values(row_count=rows))
+            conn.execute(text("DROP TABLE usage_unpartitioned"))
+        logger.info("usage converted to a partitioned table")
+
+    def maintain(self, now: Optional[datetime] = None) -> Dict[str, Any]:
+        """Create upcoming partitions, rotate closed periods and archive expired ones"""
+        created = self.ensure_partitions(now)
+        moved = self.rotate(now)
+        archived = self.archive_expired(now)
+        return {"created": created, "moved_rows": moved, "archived": archived}
+
+    def run_forever(self, interval: float = USAGE_MAINTENANCE_INTERVAL_SECONDS):
+        logger.info(f"Maintaining usage partitions every {interval:.0f}s")
+        while True:
+            try:
+                logger.info(f"Usage partition maintenance: {self.maintain()}")
+            except Exception as e:
+                # Every step is safe to repeat, so the next cycle picks up where this one failed
+                logger.error(f"Usage partition maintenance failed: {str(e)}")
+            time.sleep(interval)
+
+
+# Create global partition manager instance
+partition_manager = UsagePartitionManager()
+
+
+if __name__ == "__main__":
+    # Usage: python usage_partitions.py [maintain|convert|run]  (run: as a worker)
+    # database.py logs at import, which already configured the root logger at WARNING
+    logging.getLogger().setLevel(logging.INFO)
+    command = sys.argv[1] if len(sys.argv) > 1 else "maintain"
+    if command == "run":
+        partition_manager.run_forever()
+    else:
+        if command == "convert":
+            partition_manager.convert_existing_table()
+        logger.info(f"Usage partition maintenance: {partition_manager.maintain()}")
@@ -0,0 +1,472 @@
+import os
+import asyncio
+import threading
+import logging
+from datetime import datetime, date
+from typing import Dict, Any, List, Optional, Tuple
+
+from sqlalchemy import func, select, delete
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+from database import engine, SessionLocal, Usage, APIKey, AIModel, UsageRollup, ModelLatencyRollup
+from dashboard_service import dashboard_service
+from usage_partitions import partition_manager
+from cost_ledger import update_cost_ledger
+from usage_stream import usage_broadcaster
+from quantile_sketch import DDSketch
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# How often each worker's latency sketches are merged into the database
+LATENCY_FLUSH_INTERVAL_SECONDS = float(os.getenv("LATENCY_FLUSH_INTERVAL_SECONDS", "10"))
+
+# Quantiles reported for each model
+LATENCY_QUANTILES = {"p50": 0.50, "p95": 0.95, "p99": 0.99}
+
+
+def _as_date(value) -> date:
+    """Normalize the result of func.date() to a date"""
+    # SQLite returns a string, PostgreSQL returns a date object
+    if isinstance(value, str):
+        return date.fromisoformat(value[:10])
+    if isinstance(value, datetime):
+        return value.date()
+    return value
+
+
+def record_usage(
+    db: Session,
+    api_key_id: int,
+    customer_id: Optional[int],
+    model_id: Optional[int],
+    request_type: str,
+    tokens_used: int,
+    response_time: float,
+    cost: float
+) -> Usage:
+    """
+    Record a usage row and keep the derived aggregates up to date.
+
+    The usage row, its rollup and its cost ledger bucket are committed in one
+    transaction, so the aggregates never drift from raw usage. Anything left
+    pending on the session (e.g. a UsageRecord) is committed with them.
+    """
+    timestamp = datetime.utcnow()
+    partition_manager.check_period(timestamp)
+    usage = Usage(
+        api_key_id=api_key_id,
+        model_id=model_id,
+        request_type=request_type,
+        tokens_used=tokens_used,
+        response_time=response_time,
+        cost=cost,
+        timestamp=timestamp
+    )
+    db.add(usage)
+    try:
+        update_usage_rollup(db, timestamp, api_key_id, customer_id, model_id, tokens_used, cost)
+        update_cost_ledger(db, timestamp, customer_id, tokens_used, cost)
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Error recording usage: {str(e)}")
+        raise
+
+    latency_recorder.add(model_id, timestamp, response_time)
+    dashboard_service.invalidate(customer_id)
+    usage_broadcaster.publish_usage(db, customer_id, usage)
+    return usage
+
+
+def update_usage_rollup(
+    db: Session,
+    timestamp: datetime,
+    api_key_id: int,
+    customer_id: Optional[int],
+    model_id: Optional[int],
+    tokens_used: int,
+    cost: float
+):
+    """Add one request to the daily rollup row of its API key and model (in the caller's transaction; not committed)"""
+    tokens_used = tokens_used or 0
+    cost = cost or 0.0
+    bucket_date = timestamp.date()
+
+    for attempt in range(2):
+        try:
+            # A savepoint, so a lost insert race only undoes this upsert
+            with db.begin_nested():
+                rollup = db.query(UsageRollup).filter_by(
+                    bucket_date=bucket_date,
+                    api_key_id=api_key_id,
+                    model_id=model_id
+                ).with_for_update().first()
+
+                if rollup is None:
+                    db.add(UsageRollup(
+                        bucket_date=bucket_date,
+                        customer_id=customer_id,
+                        api_key_id=api_key_id,
+                        model_id=model_id,
+                        request_count=1,
+                        tokens_used=tokens_used,
+                        cost=cost,
+                        last_request_at=timestamp
+                    ))
+                else:
+                    # Increment in SQL so concurrent writers never lose an update
+                    rollup.request_count = UsageRollup.request_count + 1
+                    rollup.tokens_used = UsageRollup.tokens_used + tokens_used
+                    rollup.cost = UsageRollup.cost + cost
+                    if rollup.last_request_at is None or rollup.last_request_at < timestamp:
+                        rollup.last_request_at = timestamp
+            return
+        except IntegrityError:
+            # Another worker created the same bucket first; retry as an update
+            if attempt:
+                raise
+
+
+class LatencyRecorder:
+    """
+    Collects response times into per-(day, model) sketches in memory and
+    merges them into ModelLatencyRollup from a background task every
+    flush interval, so recording a request never touches the database or
+    contends on a shared per-model row.
+    """
+
+    def __init__(self, flush_interval: float = LATENCY_FLUSH_INTERVAL_SECONDS):
+        self.flush_interval = flush_interval
+        self._pending: Dict[Tuple[date, int], DDSketch] = {}
+        self._lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    def add(self, model_id: Optional[int], timestamp: datetime, response_time: Optional[float]):
+        """Add a response time (in seconds) for a model"""
+        if model_id is None or response_time is None:
+            return
+        with self._lock:
+            key = (timestamp.date(), model_id)
+            sketch = self._pending.get(key)
+            if sketch is None:
+                sketch = self._pending[key] = DDSketch()
+            sketch.add(response_time)
+
+    def pending(self) -> Dict[Tuple[date, int], DDSketch]:
+        """Return a copy of the sketches not yet written to the database"""
+        with self._lock:
+            copies = {}
+            for key, sketch in self._pending.items():
+                copy = DDSketch(sketch.relative_accuracy)
+                copy.merge(sketch)
+                copies[key] = copy
+            return copies
+
+    def flush(self):
+        """Merge the pending sketches into the database"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+
+        db = SessionLocal()
+        try:
+            while pending:
+                key, sketch = next(iter(pending.items()))
+                self._merge_into_db(db, key[0], key[1], sketch)
+                del pending[key]
+        except Exception as e:
+            db.rollback()
+            logger.error(f"Error flushing latency sketches: {str(e)}")
+            # Keep what could not be written for the next flush
+            with self._lock:
+                for key, sketch in pending.items():
+                    existing = self._pending.get(key)
+                    if existing is None:
+                        self._pending[key] = sketch
+                    else:
+                        existing.merge(sketch)
+        finally:
+            db.close()
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await run_in_threadpool(self.flush)
+            except Exception as e:
+                logger.error(f"Error flushing latency sketches: {str(e)}")
+
+    def start(self):
+        """Start the flush task on the running event loop (app startup)"""
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        """Stop the flush task and write what is still pending (app shutdown)"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await run_in_threadpool(self.flush)
+
+    def _merge_into_db(self, db: Session, bucket_date: date, model_id: int, sketch: DDSketch):
+        for attempt in range(2):
+            try:
+                rollup = db.query(ModelLatencyRollup).filter_by(
+                    bucket_date=bucket_date,
+                    model_id=model_id
+                ).with_for_update().first()
+
+                if rollup is None:
+                    db.add(ModelLatencyRollup(
+                        bucket_date=bucket_date,
+                        model_id=model_id,
+                        request_count=sketch.count,
+                        sketch=sketch.to_dict()
+                    ))
+                else:
+                    merged = DDSketch.from_dict(rollup.sketch)
+                    merged.merge(sketch)
+                    rollup.sketch = merged.to_dict()
+                    rollup.request_count = merged.count
+
+                db.commit()
+                return
+            except IntegrityError:
+                db.rollback()
+                if attempt:
+                    raise
+
+
+# Create global latency recorder instance
+latency_recorder = LatencyRecorder()
+
+
+def get_customer_usage_totals(db: Session, since: Optional[date] = None, until: Optional[date] = None) -> Dict[int, Dict[str, Any]]:
+    """Requests, tokens, cost and last activity per customer in [since, until), from the rollups"""
+    query = db.query(
+        UsageRollup.customer_id,
+        func.coalesce(func.sum(UsageRollup.request_count), 0).label("requests"),
+        func.coalesce(func.sum(UsageRollup.tokens_used), 0).label("tokens"),
+        func.coalesce(func.sum(UsageRollup.cost), 0.0).label("cost"),
+        func.max(UsageRollup.last_request_at).label("last_active")
+    )
+    if since is not None:
+        query = query.filter(UsageRollup.bucket_date >= since)
+    if until is not None:
+        query = query.filter(UsageRollup.bucket_date < until)
+
+    return {
+        row.customer_id: {
+            "requests": int(row.requests),
+            "tokens": int(row.tokens),
+            "cost": float(row.cost),
+            "last_active": row.last_active
+        }
+        for row in query.group_by(UsageRollup.customer_id).all()
+    }
+
+
+def get_daily_usage_totals(db: Session, since: date) -> List[Dict[str, Any]]:
+    """Fleet-wide requests, tokens and cost per day, from the rollups"""
+    rows = db.query(
+        UsageRollup.bucket_date,
+        func.coalesce(func.sum(UsageRollup.request_count), 0).label("requests"),
+        func.coalesce(func.sum(UsageRollup.tokens_used), 0).label("tokens"),
+        func.coalesce(func.sum(UsageRollup.cost), 0.0).label("cost")
+    ).filter(
+        UsageRollup.bucket_date >= since
+    ).group_by(
+        UsageRollup.bucket_date
+    ).order_by(
+        UsageRollup.bucket_date
+    ).all()
+
+    return [
+        {
+            "date": row.bucket_date.strftime("%Y-%m-%d"),
+            "requests": int(row.requests),
+            "tokens": int(row.tokens),
+            "cost": float(row.cost)
+        }
+        for row in rows
+    ]
+
+
+def get_model_usage_stats(db: Session, since: date) -> List[Dict[str, Any]]:
+    """Per-model totals plus p50/p95/p99 response time from the merged sketches"""
+    totals = db.query(
+        UsageRollup.model_id,
+        func.coalesce(func.sum(UsageRollup.request_count), 0).label("requests"),
+        func.coalesce(func.sum(UsageRollup.tokens_used), 0).label("tokens"),
+        func.coalesce(func.sum(UsageRollup.cost), 0.0).label("cost")
+    ).filter(
+        UsageRollup.bucket_date >= since,
+        UsageRollup.model_id.isnot(None)
+    ).group_by(
+        UsageRollup.model_id
+    ).all()
+
+    sketches: Dict[int, DDSketch] = {}
+    latency_rows = db.query(
+        ModelLatencyRollup.model_id,
+        ModelLatencyRollup.sketch
+    ).filter(
+        ModelLatencyRollup.bucket_date >= since
+    ).all()
+    for model_id, data in latency_rows:
+        sketches.setdefault(model_id, DDSketch()).merge(DDSketch.from_dict(data))
+    # Include this worker's response times that have not been flushed yet
+    for (bucket_date, model_id), sketch in latency_recorder.pending().items():
+        if bucket_date >= since:
+            sketches.setdefault(model_id, DDSketch()).merge(sketch)
+
+    stats = {
+        row.model_id: {
+            "model_id": row.model_id,
+            "requests": int(row.requests),
+            "tokens": int(row.tokens),
+            "cost": float(row.cost)
+        }
+        for row in totals
+    }
+    for model_id in sketches:
+        stats.setdefault(model_id, {"model_id": model_id, "requests": 0, "tokens": 0, "cost": 0.0})
+
+    names = dict(db.query(AIModel.id, AIModel.name).filter(AIModel.id.in_(list(stats))).all()) if stats else {}
+    for model_id, entry in stats.items():
+        entry["name"] = names.get(model_id, f"Model {model_id}")
+        sketch = sketches.get(model_id)
+        for label, q in LATENCY_QUANTILES.items():
+            entry[label] = sketch.quantile(q) if sketch else None
+
+    return sorted(stats.values(), key=lambda entry: entry["requests"], reverse=True)
+
+
+def add_no_model_index():
+    """Merge duplicate rollups of requests without a model, then add the index that prevents them (one-time)"""
+    table = UsageRollup.__table__
+    no_model = table.c.model_id.is_(None)
+    with engine.begin() as conn:
+        duplicates = conn.execute(
+            select(table.c.bucket_date, table.c.api_key_id).where(no_model).group_by(
+                table.c.bucket_date, table.c.api_key_id
+            ).having(func.count() > 1)
+        ).all()
+        for bucket_date, api_key_id in duplicates:
+            in_bucket = [no_model, table.c.bucket_date == bucket_date, table.c.api_key_id == api_key_id]
+            rows = conn.execute(select(table).where(*in_bucket).order_by(table.c.id)).all()
+            conn.execute(table.update().where(table.c.id == rows[0].id).values(
+                request_count=sum(row.request_count or 0 for row in rows),
+                tokens_used=sum(row.tokens_used or 0 for row in rows),
+                cost=sum(row.cost or 0.0 for row in rows),
+                last_request_at=max((row.last_request_at for row in rows if row.last_request_at), default=None)
+            ))
+            conn.execute(delete(table).where(*in_bucket, table.c.id != rows[0].id))
+        if duplicates:
+            logger.info(f"Merged duplicate usage rollups in {len(duplicates)} buckets")
+        for index in table.indexes:
+            if index.name == "uq_usage_rollups_bucket_no_model":
+                index.create(bind=conn, checkfirst=True)
+
+
+def rebuild_rollups(since: Optional[date] = None, until: Optional[date] = None):
+    """Recompute the rollups for [since, until) from the raw usage rows (for existing data or repair)"""
+    db = SessionLocal()
+    try:
+        # Raw rows of archived partitions are gone; never discard their rollups
+        archived_until = partition_manager.archived_until(db)
+        if archived_until is not None and (since is None or since < archived_until.date()):
+            since = archived_until.date()
+
+        logger.info(f"Rebuilding usage rollups{f' since {since}' if since else ''}{f' until {until}' if until else ''}")
+
+        start = datetime(since.year, since.month, since.day) if since else None
+        end = datetime(until.year, until.month, until.day) if until else None
+        usage = partition_manager.usage_source(db, start, end)
+
+        usage_query = db.query(UsageRollup)
+        latency_query = db.query(ModelLatencyRollup)
+        if since is not None:
+            usage_query = usage_query.filter(UsageRollup.bucket_date >= since)
+            latency_query = latency_query.filter(ModelLatencyRollup.bucket_date >= since)
+        if until is not None:
+            usage_query = usage_query.filter(UsageRollup.bucket_date < until)
+            latency_query = latency_query.filter(ModelLatencyRollup.bucket_date < until)
+        usage_query.delete(synchronize_session=False)
+        latency_query.delete(synchronize_session=False)
+
+        def in_range(query):
+            if start is not None:
+                query = query.filter(usage.timestamp >= start)
+            if end is not None:
+                query = query.filter(usage.timestamp < end)
+            return query
+
+        day = func.date(usage.timestamp)
+        rows = db.query(
+            day.label("day"),
+            usage.api_key_id,
+            APIKey.customer_id,
+            usage.model_id,
+            func.count(usage.id).label("requests"),
+            func.coalesce(func.sum(usage.tokens_used), 0).label("tokens"),
+            func.coalesce(func.sum(usage.cost), 0.0).label("cost"),
+            func.max(usage.timestamp).label("last_request_at")
+        ).join(
+            APIKey, usage.api_key_id == APIKey.id
+        )
+        rows = in_range(rows).group_by(day, usage.api_key_id, APIKey.customer_id, usage.model_id).all()
+
+        for row in rows:
+            db.add(UsageRollup(
+                bucket_date=_as_date(row.day),
+                customer_id=row.customer_id,
+                api_key_id=row.api_key_id,
+                model_id=row.model_id,
+                request_count=int(row.requests),
+                tokens_used=int(row.tokens),
+                cost=float(row.cost),
+                last_request_at=row.last_request_at
+            ))
+
+        # Latency sketches are built by streaming the raw response times
+        sketches: Dict[Tuple[date, int], DDSketch] = {}
+        latency_source = in_range(db.query(usage.model_id, usage.timestamp, usage.response_time).filter(
+            usage.model_id.isnot(None),
+            usage.response_time.isnot(None)
+        ))
+        for model_id, timestamp, response_time in latency_source.yield_per(10000):
+            key = (timestamp.date(), model_id)
+            sketch = sketches.get(key)
+            if sketch is None:
+                sketch = sketches[key] = DDSketch()
+            sketch.add(response_time)
+
+        for (bucket_date, model_id), sketch in sketches.items():
+            db.add(ModelLatencyRollup(
+                bucket_date=bucket_date,
+                model_id=model_id,
+                request_count=sketch.count,
+                sketch=sketch.to_dict()
+            ))
+
+        db.commit()
+        logger.info(f"Rebuilt {len(rows)} usage rollups and {len(sketches)} latency sketches")
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Error rebuilding usage rollups: {str(e)}")
+        raise
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    rebuild_rollups()
@@ -0,0 +1,188 @@
+import os
+import copy
+import json
+import asyncio
+import threading
+import logging
+from typing import Dict, Any, Optional, Set, AsyncIterator
+
+from sqlalchemy.orm import Session
+
+from database import AIModel
+
+logger = logging.getLogger(__name__)
+
+# Deltas buffered per connection before it is told to resync instead
+USAGE_STREAM_QUEUE_SIZE = int(os.getenv("USAGE_STREAM_QUEUE_SIZE", "100"))
+# Idle connections get a comment line this often to keep proxies from closing them
+USAGE_STREAM_HEARTBEAT_SECONDS = float(os.getenv("USAGE_STREAM_HEARTBEAT_SECONDS", "15"))
+
+
+def merge_deltas(target: Dict[str, Any], delta: Dict[str, Any]) -> Dict[str, Any]:
+    """Add one usage delta into another (both in the shape built by usage_delta)"""
+    target["requests"] += delta["requests"]
+    target["tokens"] += delta["tokens"]
+    target["cost"] += delta["cost"]
+    target["last_usage_id"] = max(target["last_usage_id"], delta["last_usage_id"])
+    for group in ("models", "keys", "days"):
+        for key, values in delta[group].items():
+            entry = target[group].setdefault(key, dict(values, requests=0, tokens=0, cost=0.0))
+            entry["requests"] += values["requests"]
+            entry["tokens"] += values["tokens"]
+            entry["cost"] += values["cost"]
+    return target
+
+
+def usage_delta(usage, model_name: Optional[str]) -> Dict[str, Any]:
+    """The change one committed usage row makes to its customer's dashboard"""
+    tokens = usage.tokens_used or 0
+    cost = usage.cost or 0.0
+    values = {"requests": 1, "tokens": tokens, "cost": cost}
+    delta = {
+        "type": "usage",
+        "requests": 1,
+        "tokens": tokens,
+        "cost": cost,
+        "last_usage_id": usage.id,
+        "models": {},
+        "keys": {str(usage.api_key_id): dict(values)},
+        "days": {usage.timestamp.strftime("%Y-%m-%d"): dict(values)}
+    }
+    if model_name is not None:
+        delta["models"][model_name] = dict(values, name=model_name)
+    return delta
+
+
+class UsageSubscription:
+    """One live dashboard connection's queue of pending deltas"""
+
+    def __init__(self, customer_id: int, loop: asyncio.AbstractEventLoop, queue_size: int):
+        self.customer_id = customer_id
+        self.loop = loop
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+
+    def _put(self, message: Dict[str, Any]):
+        # Runs on the subscriber's event loop
+        if self.queue.full():
+            # The client fell behind; drop the backlog and ask it to reload
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait({"type": "resync"})
+            return
+        self.queue.put_nowait(message)
+
+    async def next_message(self, timeout: float, after_usage_id: int = 0) -> Optional[Dict[str, Any]]:
+        """
+        Wait for the next message, merging every delta already queued into it.
+
+        Deltas for usage at or before `after_usage_id` (already counted in the
+        snapshot the client holds) are skipped. Returns None on timeout.
+        """
+        merged = None
+        while merged is None:
+            try:
+                message = await asyncio.wait_for(self.queue.get(), timeout)
+            except asyncio.TimeoutError:
+                return None
+            while True:
+                if message["type"] != "usage":
+                    return message
+                if message["last_usage_id"] > after_usage_id:
+                    # Published deltas are shared between connections; merge into a copy
+                    merged = copy.deepcopy(message) if merged is None else merge_deltas(merged, message)
+                if self.queue.empty():
+                    break
+                message = self.queue.get_nowait()
+        return merged
+
+
+class UsageBroadcaster:
+    """
+    Fans usage deltas out to every live dashboard connection of a customer.
+
+    The usage writer publishes once per committed row; each subscribed
+    connection gets the delta on its own bounded queue. Publishing is
+    thread-safe, so sync endpoints running in the threadpool can publish too.
+    Subscribers only see usage recorded by the same worker process.
+    """
+
+    def __init__(self, queue_size: int = USAGE_STREAM_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self._subscribers: Dict[int, Set[UsageSubscription]] = {}
+        self._model_names: Dict[int, str] = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, customer_id: int) -> UsageSubscription:
+        """Register a connection; must be called from its event loop"""
+        subscription = UsageSubscription(customer_id, asyncio.get_running_loop(), self.queue_size)
+        with self._lock:
+            self._subscribers.setdefault(customer_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: UsageSubscription):
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.customer_id)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscribers[subscription.customer_id]
+
+    def has_subscribers(self, customer_id: Optional[int]) -> bool:
+        return customer_id in self._subscribers
+
+    def subscriber_count(self) -> int:
+        with self._lock:
+            return sum(len(subscribers) for subscribers in self._subscribers.values())
+
+    def publish(self, customer_id: Optional[int], message: Dict[str, Any]):
+        """Queue a message for every connection of a customer"""
+        with self._lock:
+            subscribers = list(self._subscribers.get(customer_id, ()))
+        for subscription in subscribers:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription._put, message)
+            except RuntimeError:
+                # The connection's event loop has shut down
+                self.unsubscribe(subscription)
+
+    def publish_usage(self, db: Session, customer_id: Optional[int], usage):
+        """Publish the delta of a committed usage row, if anyone is watching"""
+        if not self.has_subscribers(customer_id):
+            return
+        try:
+            self.publish(customer_id, usage_delta(usage, self._model_name(db, usage.model_id)))
+        except Exception as e:
+            logger.error(f"Error publishing usage delta: {str(e)}")
+
+    def _model_name(self, db: Session, model_id: Optional[int]) -> Optional[str]:
+        if model_id is None:
+            return None
+        name = self._model_names.get(model_id)
+        if name is None:
+            name = db.query(AIModel.name).filter(AIModel.id == model_id).scalar()
+            if name is not None:
+                self._model_names[model_id] = name
+        return name
+
+
+async def sse_events(subscription: UsageSubscription, snapshot: Dict[str, Any]) -> AsyncIterator[str]:
+    """Server-sent events for one connection: a snapshot, then merged deltas"""
+    try:
+        yield "retry: 5000\n\n"
+        yield f"event: snapshot\ndata: {json.dumps(snapshot)}\n\n"
+        after_usage_id = snapshot.get("last_usage_id") or 0
+        while True:
+            message = await subscription.next_message(USAGE_STREAM_HEARTBEAT_SECONDS, after_usage_id)
+            if message is None:
+                yield ": keepalive\n\n"
+                continue
+            yield f"event: {message['type']}\ndata: {json.dumps(message)}\n\n"
+            if message["type"] == "resync":
+                # The client reconnects and receives a fresh snapshot
+                break
+    finally:
+        usage_broadcaster.unsubscribe(subscription)
+
+
+# Create global usage broadcaster instance
+usage_broadcaster = UsageBroadcaster()
@@ -0,0 +1,150 @@
+import os
+import time
+import asyncio
+import logging
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import stripe
+from sqlalchemy import text
+from starlette.concurrency import run_in_threadpool
+
+from database import SessionLocal, AIModel, engine
+from api_keys import api_key_cache
+from model_manager import model_manager
+from stripe_catalog import stripe_catalog
+from templating import precompile as precompile_templates
+
+logger = logging.getLogger(__name__)
+
+# Also load every active local model and run a tiny generation on it (slow; needs torch/transformers)
+WARMUP_LOCAL_MODELS = os.getenv("WARMUP_LOCAL_MODELS", "false").lower() == "true"
+# Prompt and length of that generation
+WARMUP_PROMPT = os.getenv("WARMUP_PROMPT", "Hello")
+WARMUP_MAX_LENGTH = int(os.getenv("WARMUP_MAX_LENGTH", "8"))
+
+# Model types served in-process by ModelManager (the rest are proxied)
+LOCAL_MODEL_TYPES = ("huggingface", "custom")
+
+
+def warm_database() -> Dict[str, Any]:
+    """Open the connection pool's connections now rather than on the first requests"""
+    size = engine.pool.size() if hasattr(engine.pool, "size") else 1
+    connections = []
+    try:
+        for _ in range(max(1, size)):
+            connection = engine.connect()
+            connections.append(connection)
+            connection.execute(text("SELECT 1"))
+    finally:
+        for connection in connections:
+            connection.close()
+    return {"connections": len(connections)}
+
+
+def warm_api_keys() -> Dict[str, Any]:
+    db = SessionLocal()
+    try:
+        return {"cached": api_key_cache.preload(db)}
+    finally:
+        db.close()
+
+
+def warm_models() -> Dict[str, Any]:
+    """Read the active models; with WARMUP_LOCAL_MODELS also load and exercise the local ones"""
+    db = SessionLocal()
+    try:
+        models = [(model.id, model.model_type) for model in db.query(AIModel).filter(AIModel.is_active.is_(True)).all()]
+    finally:
+        db.close()
+
+    result = {"active": len(models), "loaded": []}
+    if not WARMUP_LOCAL_MODELS:
+        return result
+    for model_id, model_type in models:
+        if model_type not in LOCAL_MODEL_TYPES:
+            continue
+        model_manager.generate_response(WARMUP_PROMPT, model_id, max_length=WARMUP_MAX_LENGTH)
+        result["loaded"].append(model_id)
+    return result
+
+
+def warm_stripe() -> Dict[str, Any]:
+    """Load the product catalog, which also opens the connection to the Stripe API"""
+    if not stripe.api_key:
+        return {"skipped": "no Stripe key"}
+    return {"products": len(stripe_catalog.get_products())}
+
+
+def warm_templates() -> Dict[str, Any]:
+    return {"templates": precompile_templates()}
+
+
+class WarmUp:
+    """
+    Startup work that must finish before a worker takes traffic.
+
+    Steps run one after another in the threadpool, in the background, so
+    the worker answers /health at once while /ready reports 503 until they
+    are done. A failed critical step keeps the worker unready; a failed
+    optional one (e.g. Stripe being unreachable) is recorded and skipped.
+    """
+
+    def __init__(self, steps: List[Tuple[str, Callable[[], Dict[str, Any]], bool]]):
+        self.steps = steps
+        self.ready = False
+        self.draining = False
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.results: Dict[str, Dict[str, Any]] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    async def run(self):
+        self.started_at = time.monotonic()
+        failed = False
+        for name, step, critical in self.steps:
+            started = time.monotonic()
+            try:
+                result = await run_in_threadpool(step)
+                self.results[name] = {"status": "ok", **result}
+            except Exception as e:
+                logger.error(f"Warm-up step {name} failed: {str(e)}")
+                self.results[name] = {"status": "failed", "error": str(e)}
+                failed = failed or critical
+            self.results[name]["seconds"] = round(time.monotonic() - started, 3)
+        self.finished_at = time.monotonic()
+        self.ready = not failed
+        logger.info(f"Warm-up {'finished' if self.ready else 'failed'} in {self.finished_at - self.started_at:.2f}s")
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self.run())
+
+    def stop(self):
+        """Report unready from now on, so load balancers stop routing here while the worker drains"""
+        self.draining = True
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+
+    def status(self) -> Dict[str, Any]:
+        if self.draining:
+            state = "draining"
+        elif self.ready:
+            state = "ready"
+        elif self.finished_at is not None:
+            state = "failed"
+        else:
+            state = "warming"
+        return {
+            "status": state,
+            "seconds": round((self.finished_at or time.monotonic()) - self.started_at, 3) if self.started_at else None,
+            "steps": self.results
+        }
+
+
+# Create global warm-up instance (name, step, whether its failure keeps the worker unready)
+warmup = WarmUp([
+    ("database", warm_database, True),
+    ("templates", warm_templates, True),
+    ("api_keys", warm_api_keys, False),
+    ("models", warm_models, False),
+    ("stripe", warm_stripe, False)
+])
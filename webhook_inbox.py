@@ -0,0 +1,258 @@
+import os
+import uuid
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Dict, Any, List, Optional
+
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+from database import SessionLocal, Customer, WebhookEvent
+from metered_reporting import metered_reporter
+from stripe_catalog import stripe_catalog
+from stripe_mirror import stripe_mirror
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Events processed per transaction
+WEBHOOK_BATCH_SIZE = int(os.getenv("WEBHOOK_BATCH_SIZE", "50"))
+# Failed events are retried on later drains until they have failed this often
+WEBHOOK_MAX_ATTEMPTS = int(os.getenv("WEBHOOK_MAX_ATTEMPTS", "5"))
+# A failed event is retried no sooner than this after its last attempt
+WEBHOOK_RETRY_SECONDS = float(os.getenv("WEBHOOK_RETRY_SECONDS", "60"))
+# The worker drains at least this often even without a new delivery
+WEBHOOK_POLL_SECONDS = float(os.getenv("WEBHOOK_POLL_SECONDS", "30"))
+# Events claimed by a worker that died are handed out again after this long
+WEBHOOK_CLAIM_TIMEOUT_SECONDS = float(os.getenv("WEBHOOK_CLAIM_TIMEOUT_SECONDS", "300"))
+
+SUBSCRIPTION_EVENTS = ("customer.subscription.created", "customer.subscription.updated", "customer.subscription.deleted")
+
+
+def _timestamp(value) -> Optional[datetime]:
+    return datetime.utcfromtimestamp(value) if value else None
+
+
+class WebhookInbox:
+    """
+    Durable inbox for Stripe webhook events.
+
+    The webhook endpoints only verify the signature and insert the event,
+    keyed by its Stripe id, so redeliveries are dropped by the unique
+    constraint and Stripe gets its 200 at once. A worker task claims
+    pending events in batches, in the order Stripe created them, and
+    applies each batch in one session and one commit. If a batch fails it
+    is replayed event by event, so one bad event is marked failed (and
+    retried later) without holding back the rest.
+    """
+
+    def __init__(
+        self,
+        batch_size: int = WEBHOOK_BATCH_SIZE,
+        max_attempts: int = WEBHOOK_MAX_ATTEMPTS,
+        retry_delay: float = WEBHOOK_RETRY_SECONDS,
+        claim_timeout: float = WEBHOOK_CLAIM_TIMEOUT_SECONDS
+    ):
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.retry_delay = timedelta(seconds=retry_delay)
+        self.claim_timeout = timedelta(seconds=claim_timeout)
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    # Receiving
+
+    def receive(self, db: Session, event: Dict[str, Any]) -> bool:
+        """Store a verified event; returns False if it was already received"""
+        db.add(WebhookEvent(
+            event_id=event["id"],
+            event_type=event.get("type") or "",
+            payload=event,
+            event_created=_timestamp(event.get("created")),
+            status="pending"
+        ))
+        try:
+            db.commit()
+        except IntegrityError:
+            db.rollback()
+            logger.info(f"Ignoring duplicate delivery of webhook event {event['id']}")
+            return False
+        return True
+
+    def notify(self):
+        """Wake the worker so a new event is processed without waiting for the next poll"""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    # Processing
+
+    def process_event(self, db: Session, event: Dict[str, Any]):
+        """Apply one event using the caller's session (the caller commits)"""
+        event_type = event.get("type") or ""
+        obj = event["data"]["object"]
+
+        stripe_catalog.handle_event(event)
+        stripe_mirror.handle_event(db, event)
+
+        if event_type in ("invoice.payment_succeeded", "invoice.payment_failed"):
+            self._record_payment(db, obj, succeeded=event_type == "invoice.payment_succeeded")
+        elif event_type in SUBSCRIPTION_EVENTS:
+            # Track the metered subscription item used for usage reporting
+            metered_reporter.sync_subscription(db, obj)
+        elif event_type == "payment_intent.succeeded":
+            logger.info(f"Payment succeeded! Amount: ${(obj.get('amount') or 0)/100:.2f} USD")
+            logger.info(f"Payment ID: {obj.get('id')}")
+            logger.info(f"Customer: {obj.get('customer')}")
+
+    def _record_payment(self, db: Session, invoice: Dict[str, Any], succeeded: bool):
+        stripe_customer_id = invoice.get("customer")
+        customer = db.query(Customer).filter(Customer.stripe_customer_id == stripe_customer_id).first()
+        if not customer:
+            logger.error(f"Customer not found for Stripe ID: {stripe_customer_id}")
+            return
+
+        # Create or update the invoice record
+        stripe_mirror.upsert_invoice(db, invoice, status="paid" if succeeded else "failed")
+        if succeeded:
+            logger.info(f"Recorded successful payment for customer {customer.id}")
+        else:
+            # Update customer subscription status
+            customer.subscription_active = False
+            logger.info(f"Recorded failed payment for customer {customer.id}")
+
+    def _claim(self, db: Session) -> List[WebhookEvent]:
+        """Mark the next batch of pending events as ours and load them in Stripe order"""
+        token = uuid.uuid4().hex
+        next_ids = db.query(WebhookEvent.id).filter(
+            WebhookEvent.status == "pending"
+        ).order_by(
+            WebhookEvent.event_created, WebhookEvent.id
+        ).limit(self.batch_size).subquery()
+        claimed = db.query(WebhookEvent).filter(
+            WebhookEvent.id.in_(next_ids.select()),
+            WebhookEvent.status == "pending"
+        ).update({
+            "status": "processing",
+            "claimed_by": token,
+            "claimed_at": datetime.utcnow()
+        }, synchronize_session=False)
+        db.commit()
+        if not claimed:
+            return []
+        return db.query(WebhookEvent).filter(
+            WebhookEvent.claimed_by == token,
+            WebhookEvent.status == "processing"
+        ).order_by(WebhookEvent.event_created, WebhookEvent.id).all()
+
+    def _finish(self, record: WebhookEvent, error: Optional[Exception] = None):
+        record.attempts = (record.attempts or 0) + 1
+        record.claimed_by = None
+        if error is None:
+            record.status = "processed"
+            record.error = None
+            record.processed_at = datetime.utcnow()
+        else:
+            record.status = "failed"
+            record.error = str(error)[:500]
+
+    def _process_batch(self, db: Session, batch: List[WebhookEvent]) -> Dict[str, int]:
+        try:
+            for record in batch:
+                self.process_event(db, record.payload)
+                self._finish(record)
+            db.commit()
+            return {"processed": len(batch), "failed": 0}
+        except Exception as e:
+            db.rollback()
+            logger.warning(f"Webhook batch of {len(batch)} failed ({str(e)}); processing its events one at a time")
+
+        processed = failed = 0
+        for record in batch:
+            try:
+                self.process_event(db, record.payload)
+                self._finish(record)
+                db.commit()
+                processed += 1
+            except Exception as e:
+                db.rollback()
+                logger.error(f"Error processing webhook event {record.event_id} ({record.event_type}): {str(e)}")
+                self._finish(record, e)
+                db.commit()
+                failed += 1
+        return {"processed": processed, "failed": failed}
+
+    def drain(self) -> Dict[str, int]:
+        """Process everything pending; returns how many events were processed and how many failed"""
+        db = SessionLocal()
+        try:
+            # Retry failed events, and take back events claimed by a worker that died
+            now = datetime.utcnow()
+            db.query(WebhookEvent).filter(
+                WebhookEvent.status == "failed",
+                WebhookEvent.attempts < self.max_attempts,
+                WebhookEvent.claimed_at < now - self.retry_delay
+            ).update({"status": "pending"}, synchronize_session=False)
+            db.query(WebhookEvent).filter(
+                WebhookEvent.status == "processing",
+                WebhookEvent.claimed_at < now - self.claim_timeout
+            ).update({"status": "pending", "claimed_by": None}, synchronize_session=False)
+            db.commit()
+
+            result = {"processed": 0, "failed": 0}
+            while True:
+                batch = self._claim(db)
+                if not batch:
+                    break
+                for key, value in self._process_batch(db, batch).items():
+                    result[key] += value
+            if result["processed"] or result["failed"]:
+                logger.info(f"Webhook inbox drained: {result}")
+            return result
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    # Worker
+
+    async def run(self, poll_seconds: float = WEBHOOK_POLL_SECONDS):
+        """Drain on every delivery, and every poll interval in case one was missed"""
+        self._wakeup = asyncio.Event()
+        while True:
+            self._wakeup.clear()
+            try:
+                await run_in_threadpool(self.drain)
+            except Exception as e:
+                logger.error(f"Error draining webhook inbox: {str(e)}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), poll_seconds)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        """Start the worker task on the running event loop (app startup)"""
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+# Create global webhook inbox instance
+webhook_inbox = WebhookInbox()
+
+
+if __name__ == "__main__":
+    # Usage: python webhook_inbox.py  (processes everything pending once)
+    import stripe
+    stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
+    logger.info(f"Webhook inbox result: {webhook_inbox.drain()}")